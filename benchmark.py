@@ -0,0 +1,247 @@
+import argparse
+import copy
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from evaluate import load_fold_models
+from model.dream import Encoder_ResNet, VAE
+from utils.util import read_json
+from model.inference import *
+from model.runtime import *
+from model.student import encoder_cost
+import model.metric as module_metric
+
+import torch
+
+
+def time_per_batch(fn, x, n_runs=20, n_warmup=3):
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            fn(x)
+        start = time.perf_counter()
+        for _ in range(n_runs):
+            fn(x)
+    return (time.perf_counter() - start) / n_runs
+
+
+def compare(candidates, x, n_runs):
+    """
+    candidates: ordered dict name -> callable returning emissions (batch_size, len, n_classes)
+    or stage labels (batch_size, len); the first entry is the reference for speedup and parity.
+    """
+    n_epochs = x.shape[0] * x.shape[1]
+    ref_name = next(iter(candidates))
+    with torch.no_grad():
+        ref = torch.as_tensor(candidates[ref_name](x))
+
+    print('{:12s} {:>12s} {:>12s} {:>8s} {:>12s} {:>8s}'.format('', 'ms/batch', 'ms/epoch', 'speedup', 'max |diff|', 'agree'))
+    ref_time = None
+    for name, fn in candidates.items():
+        elapsed = time_per_batch(fn, x, n_runs)
+        ref_time = ref_time or elapsed
+        with torch.no_grad():
+            out = torch.as_tensor(fn(x))
+
+        diff = (out - ref).abs().max().item() if out.dim() == 3 and ref.dim() == 3 else float('nan')
+        labels = out.argmax(-1) if out.dim() == 3 else out
+        ref_labels = ref.argmax(-1) if ref.dim() == 3 else ref
+        print('{:12s} {:12.2f} {:12.3f} {:8.2f} {:12.3e} {:8.4f}'.format(
+            name, 1000 * elapsed, 1000 * elapsed / n_epochs, ref_time / elapsed,
+            diff, (labels == ref_labels).float().mean().item()))
+
+
+def compare_blocks(runs, d_type, n_runs):
+    """
+    Encoder params, FLOPs and CPU ms/epoch of every Encoder_ResNet block variant or, given trained
+    fold directories, of their qzy encoders next to their test accuracy / macro-F1
+    """
+    sampling_rate = 125 if d_type == 'shhs' else 100
+    rows = []
+    if not runs:
+        for se in [False, True]:
+            for block in ['bottleneck', 'separable', 'grouped']:
+                row = {'block': block, 'se': se}
+                row.update(encoder_cost(Encoder_ResNet(256, sampling_rate, block, 4, se), sampling_rate, torch.device('cpu'), n_runs=n_runs))
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+    for run in runs:
+        feature_net, _, _ = load_fold_models(run, d_type, torch.device('cpu'))
+        row = {'run': Path(run).name, 'block': feature_net.qzy.block, 'se': feature_net.qzy.se}
+        row.update(encoder_cost(feature_net.qzy, sampling_rate, torch.device('cpu'), n_runs=n_runs))
+        row.update(test_scores(run))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def test_scores(run):
+    # accuracy / macro-F1 of the test_outs_<fold>.npy / test_trgs_<fold>.npy saved by the trainer
+    outs = np.concatenate([np.load(f) for f in sorted(Path(run).glob('test_outs_*.npy'))])
+    trgs = np.concatenate([np.load(f) for f in sorted(Path(run).glob('test_trgs_*.npy'))])
+    return {'accuracy': module_metric.accuracy(outs, trgs), 'f1': module_metric.f1(outs, trgs)}
+
+
+def train_step_cost(feature_net, x, y, d, n_runs, amp=False):
+    """
+    ms per stage-1 step (get_losses, backward, Adam) and MB of activations saved for backward
+    (peak allocated MB on CUDA); amp: bfloat16 autocast of get_losses as in Trainer
+    """
+    autocast = lambda: torch.autocast(x.device.type, dtype=torch.bfloat16, enabled=amp)
+    optimizer = torch.optim.Adam(feature_net.parameters())
+    feature_net.train()
+
+    storages = {}
+    def pack(tensor):
+        storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    if x.is_cuda:
+        torch.cuda.reset_peak_memory_stats()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor), autocast():
+        loss = feature_net.get_losses(x, y, d)
+    loss.backward()
+    optimizer.step()
+    memory = torch.cuda.max_memory_allocated() if x.is_cuda else sum(storages.values())
+
+    start = time.perf_counter()
+    for _ in range(n_runs):
+        optimizer.zero_grad()
+        with autocast():
+            loss = feature_net.get_losses(x, y, d)
+        loss.backward()
+        optimizer.step()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return {'ms/step': 1000 * (time.perf_counter() - start) / n_runs, 'MB': memory / 2**20}
+
+
+def compare_stage1(variants, runs, d_type, batch_size, n_runs, device, n_domains=10):
+    """
+    Stage-1 step time and memory of the VAE for each hyper_params override in variants or, given
+    trained fold directories, their settings of the same hyper_params and test accuracy per fold.
+    The key 'amp' stands for the trainer setting of the same name.
+    """
+    keys = sorted(set(key for variant in variants for key in variant))
+    config = read_json('config.json')
+    params = config['hyper_params']
+
+    rows = []
+    if runs:
+        for run in runs:
+            run_config = read_json(Path(run) / 'config.json')
+            run_params = dict(run_config['hyper_params'], amp=run_config['trainer'].get('amp', False))
+            row = {'run': Path(run).name}
+            row.update({key: run_params.get(key, params.get(key)) for key in keys})
+            row.update(test_scores(run))
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    sampling_rate = 125 if d_type == 'shhs' else 100
+    x = torch.randn(batch_size, params['seq_len'], sampling_rate*30, 1, device=device)
+    y = torch.randint(0, params['num_classes'], (batch_size, params['seq_len']), device=device)
+    d = torch.randint(0, n_domains, (batch_size,), device=device)
+
+    for variant in variants:
+        variant_config = copy.deepcopy(config)
+        variant_config['hyper_params'].update({key: value for key, value in variant.items() if key != 'amp'})
+        feature_net = VAE(params['zd_dim'], params['zy_dim'], n_domains, variant_config, d_type).to(device)
+
+        row = {key: variant.get(key, params.get(key)) for key in keys}
+        row['params'] = sum(p.numel() for p in feature_net.parameters())
+        row.update(train_step_cost(feature_net, x, y, d, n_runs, variant.get('amp', False)))
+        row['ms/epoch'] = row['ms/step'] / (batch_size * params['seq_len'])
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    if args.mode == 'blocks':
+        result = compare_blocks(args.runs, args.d_type, args.n_runs)
+        result['speedup'] = result['ms/epoch'][0] / result['ms/epoch']
+        print(result.to_string(index=False))
+        return
+    if args.mode in ['trunk', 'decoder', 'checkpoint', 'amp', 'contrast', 'domains', 'queue']:
+        variants = {'trunk': [{'shared_trunk': False}, {'shared_trunk': True}],
+                    'decoder': [{'decoder': 'dense', 'recon_downsample': 1},
+                                {'decoder': 'lowrank', 'recon_downsample': 1},
+                                {'decoder': 'conv', 'recon_downsample': 1},
+                                {'decoder': 'conv', 'recon_downsample': 4}],
+                    'checkpoint': [{'checkpoint': []},
+                                   {'checkpoint': ['layer1', 'layer2']},
+                                   {'checkpoint': ['layer1', 'layer2', 'layer3', 'layer4']},
+                                   {'checkpoint': ['layer1', 'layer2', 'layer3', 'layer4', 'decoder']}],
+                    'amp': [{'amp': False}, {'amp': True}],
+                    'contrast': [{'contrast_sequence': False}, {'contrast_sequence': True}],
+                    'domains': [{'domain_prior': 'onehot', 'domain_head': 'full'},
+                                {'domain_prior': 'embedding', 'domain_head': 'full'},
+                                {'domain_prior': 'embedding', 'domain_head': 'sampled'},
+                                {'domain_prior': 'embedding', 'domain_head': 'hashed'}],
+                    'queue': [{'queue_size': 0, 'queue_momentum': 0},
+                              {'queue_size': 4096, 'queue_momentum': 0},
+                              {'queue_size': 4096, 'queue_momentum': 0.999}]}[args.mode]
+        result = compare_stage1(variants, args.runs, args.d_type, args.batch_size, args.n_runs, torch.device(args.device), args.n_domains)
+        if not args.runs:
+            result['speedup'] = result['ms/step'][0] / result['ms/step']
+        print(result.to_string(index=False))
+        return
+
+    model = load_inference_model(args.model)
+    x = torch.randn(args.batch_size, model.seq_len, model.config['sampling_rate']*30, 1)
+
+    candidates = {'eager': model}
+    if args.mode == 'fuse':
+        candidates['fused'] = load_inference_model(args.model, fuse=True)
+    elif args.mode == 'quantize':
+        candidates['int8'] = load_inference_model(args.model, quantized=True)
+    elif args.mode == 'onnx':
+        candidates['onnx'] = OnnxScorer(args.model)
+    elif args.mode == 'numpy':
+        candidates['numpy'] = NumpyScorer(args.model)
+    elif args.mode == 'bf16':
+        candidates['bf16'] = load_inference_model(args.model).mixed_precision()
+        candidates['fused bf16'] = load_inference_model(args.model, fuse=True).mixed_precision()
+    elif args.mode == 'ensemble':
+        members = [load_inference_model(path, fuse=True) for path in [args.model] + args.members]
+        ensemble = EnsembleNet(members)
+        candidates = {'sequential': lambda x: ensemble.aggregate(torch.stack([member(x) for member in members])),
+                      'batched': ensemble.predict}
+    elif args.mode in ['script', 'compile']:
+        fused = load_inference_model(args.model, fuse=True)
+        candidates = {'eager': model.predict,
+                      'scripted': script_inference_model(fused)}
+        if args.mode == 'compile':
+            candidates['compiled'] = compile_inference_model(fused)
+
+    compare(candidates, x, args.n_runs)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='CPU inference benchmark of an exported model')
+    args.add_argument('-m', '--model', type=str,
+                      help='directory written by export.py')
+    args.add_argument('--mode', default='fuse', type=str, choices=['fuse', 'quantize', 'bf16', 'script', 'compile', 'onnx', 'numpy', 'ensemble', 'blocks', 'trunk', 'decoder', 'checkpoint', 'amp', 'contrast', 'domains', 'queue'],
+                      help='optimization to compare against eager (default: fuse)')
+    args.add_argument('--members', default=[], type=str, nargs='+',
+                      help='further export directories ensembled with --model (with --mode ensemble)')
+    args.add_argument('--runs', default=[], type=str, nargs='+',
+                      help='trained fold directories compared by test accuracy (with --mode blocks / trunk / decoder / checkpoint / amp / contrast / domains / queue)')
+    args.add_argument('-dt', '--d_type', default='edf', type=str, choices=['edf', 'shhs'],
+                      help='dataset type (with --mode blocks / trunk / decoder / checkpoint / amp / contrast / domains / queue, default: edf)')
+    args.add_argument('-d', '--device', default='cpu', type=str,
+                      help='torch device of the stage-1 step (with --mode trunk / decoder / checkpoint / amp / contrast / domains / queue, default: cpu)')
+    args.add_argument('--n_domains', default=10, type=int,
+                      help='training subjects of the stage-1 step (with --mode trunk / decoder / checkpoint / amp / contrast / domains / queue, default: 10)')
+    args.add_argument('-b', '--batch_size', default=64, type=int,
+                      help='windows per batch (default: 64)')
+    args.add_argument('-n', '--n_runs', default=20, type=int,
+                      help='timed runs (default: 20)')
+    args.add_argument('-t', '--threads', default=0, type=int,
+                      help='torch intra-op threads (default: torch default)')
+
+    args = args.parse_args()
+    main(args)
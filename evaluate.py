@@ -0,0 +1,170 @@
+import argparse
+import copy
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from data_loader.data_loader import *
+import model.metric as module_metric
+from utils.util import *
+from model.dream import *
+from model.inference import *
+from model.runtime import *
+from model.pruning import resize_to_state_dict
+
+import torch
+from torch.utils.data import DataLoader
+
+
+def load_fold_models(checkpoint_dir, d_type, device):
+    """
+    Rebuild feature_net and classifier of one fold from featurenet_best.pth / classifier_best.pth
+    """
+    checkpoint_dir = Path(checkpoint_dir)
+    config = read_json(checkpoint_dir / 'config.json')
+    params = config['hyper_params']
+
+    # the trainer's checkpoints also pickle the ConfigParser and the monitored metric
+    f_state = torch.load(checkpoint_dir / 'featurenet_best.pth', map_location=device, weights_only=False)['state_dict']
+    c_state = torch.load(checkpoint_dir / 'classifier_best.pth', map_location=device, weights_only=False)['state_dict']
+
+    prior = f_state['pzd.fc1.0.weight']  # Linear (zd_dim, n_domains) or Embedding (n_domains, zd_dim)
+    n_domains = prior.shape[0] if params.get('domain_prior', 'onehot') == 'embedding' else prior.shape[1]
+
+    feature_net = VAE(params['zd_dim'], params['zy_dim'], n_domains, config, d_type)
+    resize_to_state_dict(feature_net, f_state)  # pruned checkpoints (see prune.py)
+    feature_net.load_state_dict(f_state)
+    classifier = Transformer(input_size=params['zy_dim'], config=config)
+    classifier.load_state_dict(c_state)
+
+    return feature_net.to(device).eval(), classifier.to(device).eval(), config
+
+
+def load_split(config, np_data_dir, fold_id, d_type, phase):
+    if d_type == 'shhs':
+        folds_data = load_shhs_folds(np_data_dir, config["data_loader"]["args"]["num_folds"], fold_id)
+    else:
+        folds_data = load_edf_folds(np_data_dir, config["data_loader"]["args"]["num_folds"], fold_id)
+
+    dataset = SleepDataLoader(config, folds_data[fold_id][phase], d_type=d_type, phase=phase)
+    return DataLoader(dataset=dataset, shuffle=phase == 'train', batch_size=config["data_loader"]["args"]["batch_size"])
+
+
+def cascade_curve(feature_net, classifier, data_loader, thresholds, device):
+    """
+    Accuracy versus compute of cascade_predict for each threshold. Aux head and classifier
+    are run once over the whole split; each threshold only re-selects between their outputs.
+    """
+    aux_conf, aux_pred, clf_pred, trgs = [], [], [], []
+    time_aux, time_clf = 0., 0.
+    with torch.no_grad():
+        for x, y, _ in data_loader:
+            x = x.to(device)
+
+            start = time.time()
+            features, _ = feature_net.encode(x)
+            confidence, pred = F.softmax(feature_net.qy(features), dim=-1).max(-1)
+            time_aux += time.time() - start
+
+            start = time.time()
+            output = classifier.predict(features)
+            time_clf += time.time() - start
+
+            aux_conf.append(confidence.min(1)[0].cpu().numpy())
+            aux_pred.append(pred.cpu().numpy())
+            clf_pred.append(np.array(output))
+            trgs.append(y.numpy())
+
+    aux_conf, aux_pred = np.concatenate(aux_conf), np.concatenate(aux_pred)
+    clf_pred, trgs = np.concatenate(clf_pred), np.concatenate(trgs)
+
+    rows = []
+    for threshold in thresholds:
+        escalate = aux_conf < threshold
+        preds = np.where(escalate[:, None], clf_pred, aux_pred)
+        rows.append({'threshold': threshold,
+                     'escalated': escalate.mean(),
+                     'rel_compute': (time_aux + escalate.mean() * time_clf) / (time_aux + time_clf),
+                     'accuracy': module_metric.accuracy(preds.reshape(-1), trgs.reshape(-1)),
+                     'f1': module_metric.f1(preds.reshape(-1), trgs.reshape(-1))})
+    return pd.DataFrame(rows)
+
+
+def compare_models(models, data_loader):
+    """
+    Accuracy, macro-F1 and CPU throughput of each InferenceNet in models (name -> model),
+    with deltas against the first entry.
+    """
+    rows = []
+    for name, model in models.items():
+        outs, trgs, elapsed = [], [], 0.
+        for x, y, _ in data_loader:
+            start = time.time()
+            output = model.predict(x)
+            elapsed += time.time() - start
+
+            outs.append(np.array(output))
+            trgs.append(y.numpy())
+
+        outs, trgs = np.concatenate(outs).reshape(-1), np.concatenate(trgs).reshape(-1)
+        rows.append({'model': name,
+                     'accuracy': module_metric.accuracy(outs, trgs),
+                     'f1': module_metric.f1(outs, trgs),
+                     'epochs/s': len(trgs) / elapsed})
+
+    result = pd.DataFrame(rows)
+    result['d_accuracy'] = result['accuracy'] - result['accuracy'][0]
+    result['d_f1'] = result['f1'] - result['f1'][0]
+    return result
+
+
+def main(args, fold_id):
+    d_type = 'shhs' if 'shhs' in args.np_data_dir else 'edf'
+    device = torch.device(args.device if args.mode == 'cascade' else 'cpu')
+    feature_net, classifier, config = load_fold_models(args.checkpoint_dir, d_type, device)
+    test_loader = load_split(config, args.np_data_dir, fold_id, d_type, 'test')
+
+    if args.mode == 'cascade':
+        result = cascade_curve(feature_net, classifier, test_loader, args.thresholds, device)
+    elif args.mode == 'quantize':
+        model = build_inference_model(feature_net, classifier, feature_net.sampling_rate)
+        calibration_loader = load_split(config, args.np_data_dir, fold_id, d_type, 'train')
+        models = {'float': model,
+                  'int8': quantize_inference_model(model, calibration_loader, args.n_calibration)}
+        result = compare_models(models, test_loader)
+    elif args.mode == 'bf16':
+        model = build_inference_model(feature_net, classifier, feature_net.sampling_rate)
+        result = compare_models({'float32': model, 'bfloat16': copy.deepcopy(model).mixed_precision()}, test_loader)
+    elif args.mode == 'onnx':
+        model = build_inference_model(feature_net, classifier, feature_net.sampling_rate)
+        export_onnx_model(model, Path(args.checkpoint_dir) / 'onnx')
+        result = compare_models({'torch': model, 'onnx': OnnxScorer(Path(args.checkpoint_dir) / 'onnx')}, test_loader)
+    elif args.mode == 'numpy':
+        model = build_inference_model(feature_net, classifier, feature_net.sampling_rate)
+        export_numpy_model(model, Path(args.checkpoint_dir) / 'numpy')
+        result = compare_models({'torch': model, 'numpy': NumpyScorer(Path(args.checkpoint_dir) / 'numpy')}, test_loader)
+
+    print(result.to_string(index=False))
+    result.to_csv(Path(args.checkpoint_dir) / '{}_{}.csv'.format(args.mode, fold_id), index=False)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Evaluate a trained fold')
+    args.add_argument('-r', '--checkpoint_dir', type=str,
+                      help='fold directory containing featurenet_best.pth and classifier_best.pth')
+    args.add_argument('-f', '--fold_id', type=str,
+                      help='fold_id')
+    args.add_argument('-da', '--np_data_dir', type=str,
+                      help='Directory containing numpy files')
+    args.add_argument('-m', '--mode', default='cascade', type=str, choices=['cascade', 'quantize', 'bf16', 'onnx', 'numpy'],
+                      help='evaluation to run (default: cascade)')
+    args.add_argument('-d', '--device', default='cpu', type=str,
+                      help='torch device for cascade (default: cpu)')
+    args.add_argument('-t', '--thresholds', default=[0., 0.5, 0.7, 0.8, 0.9, 0.95, 0.99, 1.01], type=float, nargs='+',
+                      help='cascade confidence thresholds')
+    args.add_argument('--n_calibration', default=32, type=int,
+                      help='training batches used to calibrate int8 quantization (default: 32)')
+
+    args = args.parse_args()
+    main(args, int(args.fold_id))
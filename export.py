@@ -0,0 +1,80 @@
+import argparse
+import os
+import time
+
+from evaluate import load_fold_models, load_split
+from model.inference import *
+
+import torch
+
+
+def main(args):
+    device = torch.device('cpu')
+
+    start = time.time()
+    feature_net, classifier, config = load_fold_models(args.checkpoint_dir, args.d_type, device)
+    full_load = time.time() - start
+    full_params = sum(p.numel() for p in feature_net.parameters()) + sum(p.numel() for p in classifier.parameters())
+
+    model = build_inference_model(feature_net, classifier, feature_net.sampling_rate, aux_head=not args.no_aux)
+    export_inference_model(model, args.output)
+
+    start = time.time()
+    model = load_inference_model(args.output)
+    slim_load = time.time() - start
+    slim_params = sum(p.numel() for p in model.parameters())
+
+    full_size = sum(os.path.getsize(os.path.join(args.checkpoint_dir, f)) for f in ['featurenet_best.pth', 'classifier_best.pth'])
+    slim_size = os.path.getsize(os.path.join(args.output, 'model.pth'))
+
+    print('{:10s} {:>12s} {:>10s} {:>10s}'.format('', 'params', 'MB', 'load (s)'))
+    print('{:10s} {:12d} {:10.1f} {:10.3f}'.format('full', full_params, full_size / 2**20, full_load))
+    print('{:10s} {:12d} {:10.1f} {:10.3f}'.format('slim', slim_params, slim_size / 2**20, slim_load))
+
+    if args.script:
+        script_inference_model(load_inference_model(args.output, fuse=True), args.output)
+
+    if args.onnx:
+        export_onnx_model(model, args.output)
+
+    if args.numpy:
+        export_numpy_model(model, args.output)
+
+    if args.quantize:
+        calibration_loader = load_split(config, args.np_data_dir, int(args.fold_id), args.d_type, 'train')
+        export_inference_model(quantize_inference_model(model, calibration_loader, args.n_calibration), args.output)
+
+        start = time.time()
+        load_inference_model(args.output, quantized=True)
+        int8_load = time.time() - start
+        int8_size = os.path.getsize(os.path.join(args.output, 'model_int8.pth'))
+        print('{:10s} {:>12s} {:10.1f} {:10.3f}'.format('int8', '-', int8_size / 2**20, int8_load))
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Export an inference-only model from a trained fold')
+    args.add_argument('-r', '--checkpoint_dir', type=str,
+                      help='fold directory containing featurenet_best.pth and classifier_best.pth')
+    args.add_argument('-o', '--output', type=str,
+                      help='output directory for model.pth and config.json')
+    args.add_argument('-dt', '--d_type', default='edf', type=str, choices=['edf', 'shhs'],
+                      help='dataset type of the checkpoint (default: edf)')
+    args.add_argument('--no_aux', action='store_true',
+                      help='drop the qy aux head')
+    args.add_argument('-s', '--script', action='store_true',
+                      help='also write model_scripted.pt, a frozen TorchScript encoder -> Transformer -> Viterbi pipeline')
+    args.add_argument('--onnx', action='store_true',
+                      help='also write model.onnx and crf.npz for model.runtime.OnnxScorer')
+    args.add_argument('--numpy', action='store_true',
+                      help='also write model.npz for the NumPy-only model.runtime.NumpyScorer')
+    args.add_argument('-q', '--quantize', action='store_true',
+                      help='also write model_int8.pth, calibrated on the training split of the fold')
+    args.add_argument('-f', '--fold_id', type=str,
+                      help='fold_id (with --quantize)')
+    args.add_argument('-da', '--np_data_dir', type=str,
+                      help='Directory containing numpy files (with --quantize)')
+    args.add_argument('--n_calibration', default=32, type=int,
+                      help='training batches used for calibration (default: 32)')
+
+    args = args.parse_args()
+    main(args)
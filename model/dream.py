@@ -1,24 +1,117 @@
+import contextlib
+import copy
+import math
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 import torch.distributions as dist
+from torch.utils.checkpoint import checkpoint
 import random
 import numpy as np
 from TorchCRF import CRF
-from pytorch_metric_learning import losses
 
 ##################### Supervised contrastive loss
 class SupervisedContrastiveLoss(nn.Module):
-    def __init__(self):
+    """
+    Supervised NT-Xent from one cosine-similarity matrix: every pair of embeddings with the same
+    label is a positive, contrasted with all embeddings of other labels; mean over positive pairs
+    (same loss as pytorch_metric_learning NTXentLoss with labels).
+    feature_vectors: (..., N, n_feat), labels: (..., N); one loss per leading index
+    queue: (features, labels) of a FeatureQueue, further keys of every anchor
+    """
+    def __init__(self, tau=0.07):
         super(SupervisedContrastiveLoss, self).__init__()
-        self.tau = 0.07
+        self.tau = tau
+
+    def forward(self, feature_vectors, labels, queue=None):
+        # Normalize feature vectors (float32 under bfloat16 autocast)
+        z = F.normalize(feature_vectors.float(), p=2, dim=-1)
+        keys, key_labels = z, labels
+        if queue is not None:
+            keys = torch.cat([z, queue[0].expand(z.shape[:-2] + queue[0].shape)], dim=-2)
+            key_labels = torch.cat([labels, queue[1].expand(labels.shape[:-1] + queue[1].shape)], dim=-1)
+        logits = torch.matmul(z, keys.transpose(-1, -2)) / self.tau
+
+        same = labels.unsqueeze(-1) == key_labels.unsqueeze(-2)
+        positives = same & ~torch.eye(*same.shape[-2:], dtype=torch.bool, device=labels.device)
+        negatives = torch.logsumexp(logits.masked_fill(same, float('-inf')), dim=-1, keepdim=True)
+
+        # -log(exp(s_ap) / (exp(s_ap) + sum_n exp(s_an))) for every positive pair (a, p)
+        losses = torch.where(positives, torch.logaddexp(logits, negatives) - logits, 0.)
+        return losses.sum((-1, -2)) / positives.sum((-1, -2)).clamp(min=1)
+
+
+class FeatureQueue(nn.Module):
+    """
+    FIFO of the (normalized) embeddings and labels of the last size windows of previous batches,
+    contrasted as further keys by the contrastive losses; not saved in the state_dict
+    """
+    def __init__(self, size, n_feat):
+        super(FeatureQueue, self).__init__()
+        self.size = size
+        self.register_buffer('features', torch.zeros(size, n_feat), persistent=False)
+        self.register_buffer('labels', torch.zeros(size, dtype=torch.long), persistent=False)
+        self.ptr, self.count = 0, 0
+
+    @torch.no_grad()
+    def push(self, features, labels=None):
+        features = F.normalize(features.detach().float(), p=2, dim=-1)[-self.size:]
+        index = (self.ptr + torch.arange(len(features), device=features.device)) % self.size
+        self.features[index] = features
+        if labels is not None:
+            self.labels[index] = labels[-self.size:]
+        self.ptr = (self.ptr + len(features)) % self.size
+        self.count = min(self.count + len(features), self.size)
+
+    def get(self):
+        # copy of the valid entries: (count, n_feat), (count,), or None while empty; a copy so that
+        # pushing before backward does not modify tensors saved for it
+        if self.count == 0:
+            return None
+        return self.features[:self.count].clone(), self.labels[:self.count].clone()
+
+
+class MomentumEncoder(nn.Module):
+    """
+    Exponential moving average of an encoder whose (detached) embeddings fill a FeatureQueue,
+    so that queued keys drift slowly; always in eval mode, BN statistics copied from the encoder.
+    The copy is kept out of the module tree, so it is not saved in the state_dict: it (re)starts from
+    the encoder at the first update after construction or load_state_dict, or once their shapes differ
+    (pruned encoder), and follows the encoder's device.
+    """
+    def __init__(self, encoder, momentum=0.999):
+        super(MomentumEncoder, self).__init__()
+        self.momentum = momentum
+        self.restart(encoder)
+
+    def restart(self, encoder=None):
+        # a list, to keep the copy out of the module tree; None: restart at the next update
+        self.encoder = [] if encoder is None else [copy.deepcopy(encoder).requires_grad_(False).eval()]
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # nothing stored; keys of checkpoints that did save the copy are ignored
+        self.restart()
+
+    @torch.no_grad()
+    def update(self, encoder):
+        params = list(encoder.parameters())
+        if not self.encoder or [p.shape for p in self.encoder[0].parameters()] != [p.shape for p in params]:
+            self.restart(encoder)
+        key_encoder = self.encoder[0].to(params[0].device)
+        for key, query in zip(key_encoder.parameters(), params):
+            key.lerp_(query, 1 - self.momentum)
+        for key, query in zip(key_encoder.buffers(), encoder.buffers()):
+            key.copy_(query)
+
+    @torch.no_grad()
+    def forward(self, x):
+        return self.encoder[0](x)[0].float()
+
+
+def queue_args(config):
+    params = config['hyper_params']
+    return params.get('queue_size', 0), params.get('queue_momentum', 0)
 
-    def forward(self, feature_vectors, labels):
-        # Normalize feature vectors
-        logits = F.normalize(feature_vectors, p=2, dim=1)
-                
-        return losses.NTXentLoss(temperature=self.tau)(logits, torch.squeeze(labels))
-    
 ##################### ResNet block
 def conv3(in_planes, out_planes, stride=1):
     return nn.Conv1d(in_planes, out_planes, kernel_size=3, stride=stride, padding=1, bias=False)
@@ -62,30 +155,112 @@ class Bottleneck(nn.Module):
         return out
 
 
+class SqueezeExcitation(nn.Module):
+    def __init__(self, planes, reduction=4):
+        super(SqueezeExcitation, self).__init__()
+        self.fc1 = nn.Conv1d(planes, max(1, planes // reduction), kernel_size=1)
+        self.fc2 = nn.Conv1d(max(1, planes // reduction), planes, kernel_size=1)
+
+    def forward(self, x):
+        w = F.relu(self.fc1(x.mean(-1, keepdim=True)))
+        return x * torch.sigmoid(self.fc2(w))
+
+
+def channel_shuffle(x, groups):
+    # type: (Tensor, int) -> Tensor
+    batch_size, channels, length = x.shape
+    return x.view(batch_size, groups, channels // groups, length).transpose(1, 2).reshape(batch_size, channels, length)
+
+
+class LightBottleneck(nn.Module):
+    """
+    Bottleneck with a depthwise 3-wide conv ('separable'), additionally grouped 1x1 convs with a
+    channel shuffle ('grouped', ShuffleNet-style), and optional squeeze-excitation before the residual add
+    """
+    expansion = 4
+
+    def __init__(self, inplanes, planes, stride=1, downsample=None, block='separable', groups=4, se=False):
+        super(LightBottleneck, self).__init__()
+        self.groups = groups if block == 'grouped' else 1
+        self.conv1 = nn.Conv1d(inplanes, planes, kernel_size=1, groups=self.groups, bias=False)
+        self.bn1 = nn.BatchNorm1d(planes)
+        self.conv2 = nn.Conv1d(planes, planes, kernel_size=3, stride=stride,
+                               padding=1, groups=1 if block == 'bottleneck' else planes, bias=False)
+        self.bn2 = nn.BatchNorm1d(planes)
+        self.conv3 = nn.Conv1d(planes, planes * self.expansion, kernel_size=1, groups=self.groups, bias=False)
+        self.bn3 = nn.BatchNorm1d(planes * self.expansion)
+        self.se = SqueezeExcitation(planes * self.expansion) if se else None
+        self.relu = nn.ReLU(inplace=True)
+        self.downsample = downsample
+        self.stride = stride
+
+    def forward(self, x):
+        residual = x
+
+        out = self.conv1(x)
+        out = self.bn1(out)
+        out = self.relu(out)
+        if self.groups > 1:
+            out = channel_shuffle(out, self.groups)
+
+        out = self.conv2(out)
+        out = self.bn2(out)
+        out = self.relu(out)
+
+        out = self.conv3(out)
+        out = self.bn3(out)
+        if self.se is not None:
+            out = self.se(out)
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        out += residual
+        out = self.relu(out)
+
+        return out
+
+
+def block_args(config):
+    """
+    Encoder_ResNet block settings of hyper_params: block ('bottleneck', 'separable', 'grouped'), groups, se
+    """
+    params = config['hyper_params']
+    return {'block': params.get('block', 'bottleneck'), 'groups': params.get('groups', 4), 'se': params.get('se', False)}
 
     
 ##################### Decoder of VAE
 
 class Decoder_ResNet(nn.Module):
-    def __init__(self, zd_dim, zy_dim, sampling_rate):
+    """
+    decoder: 'dense' (z -> 6016 -> 32*94 fully connected; 7552 -> 32*117 at 125 Hz), 'lowrank' (the second
+    layer factorized through rank) or 'conv' (z -> 32*94 directly, the transposed convolutions upsample).
+    downsample: reconstruct the signal average-pooled by 2, 4 or 8, dropping the last x2 upsamplings
+    """
+    def __init__(self, zd_dim, zy_dim, sampling_rate, decoder='dense', rank=256, downsample=1):
         super(Decoder_ResNet, self).__init__()
         
         self.upsample1=nn.Upsample(scale_factor=2)
-        
+        self.out_len = sampling_rate*30 // downsample
+        self.n_upsample = 3 - int(math.log2(downsample))
+        hidden, length = (6016, 94) if sampling_rate == 100 else (7552, 117)
+
+        self.dfc2, self.bn2 = None, None
+        if decoder != 'conv':
+            self.dfc2 = nn.Linear(zd_dim + zy_dim, hidden)
+            self.bn2 = nn.BatchNorm1d(hidden)
+        in_dim = zd_dim + zy_dim if decoder == 'conv' else hidden
+        if decoder == 'lowrank':
+            self.dfc1 = nn.Sequential(nn.Linear(in_dim, rank, bias=False), nn.Linear(rank, 32*1*length))
+        else:
+            self.dfc1 = nn.Linear(in_dim, 32*1*length)
+        self.bn1 = nn.BatchNorm1d(32*1*length)
+
         if sampling_rate == 100:
-            self.dfc2 = nn.Linear(zd_dim + zy_dim, 6016)
-            self.bn2 = nn.BatchNorm1d(6016)
-            self.dfc1 = nn.Linear(6016, 32*1*94)
-            self.bn1 = nn.BatchNorm1d(32*1*94)
             self.dconv3 = nn.ConvTranspose1d(32, 16, 3, padding = 1)
             self.dconv2 = nn.ConvTranspose1d(16, 16, 5, padding = 3)
             self.dconv1 = nn.ConvTranspose1d(16, 1, 12, stride = 4, padding =0)
         else: 
-            self.dfc2 = nn.Linear(zd_dim + zy_dim, 7552)
-            self.bn2 = nn.BatchNorm1d(7552)
-            self.dfc1 = nn.Linear(7552, 32*1*117)
-            self.bn1 = nn.BatchNorm1d(32*1*117)
-            self.upsample1=nn.Upsample(scale_factor=2)
             self.dconv3 = nn.ConvTranspose1d(32, 16, 3, padding = 1)
             self.dconv2 = nn.ConvTranspose1d(16, 16, 5, padding = 2)
             self.dconv1 = nn.ConvTranspose1d(16, 1, 12, stride = 4, padding = 1)
@@ -98,35 +273,88 @@ class Decoder_ResNet(nn.Module):
                 nn.init.constant_(m.bias, 0)
             elif isinstance(m, nn.Linear):
                 nn.init.xavier_uniform_(m.weight)
-                nn.init.constant_(m.bias, 0)
+                if m.bias is not None:
+                    nn.init.constant_(m.bias, 0)
                 
 
+    def _upsample(self, x, i):
+        return self.upsample1(x) if i < self.n_upsample else x
+
     def forward(self, zy, zd): 
         x = torch.cat((zd, zy), dim=-1)
 
         batch_size = x.shape[0]
-        x = self.dfc2(x)
-        x = F.relu(self.bn2(x))
+        if self.dfc2 is not None:
+            x = self.dfc2(x)
+            x = F.relu(self.bn2(x))
         x = self.dfc1(x)
         x = F.relu(self.bn1(x))
         x = x.view(batch_size,32,-1)
-        x = self.upsample1(x)
+        x = self._upsample(x, 0)
         x = F.relu(self.dconv3(x))
-        x = self.upsample1(x)
+        x = self._upsample(x, 1)
         x = F.relu(self.dconv2(x))
-        x = self.upsample1(x)
+        x = self._upsample(x, 2)
         x = torch.sigmoid(self.dconv1(x))
+        if x.shape[-1] != self.out_len:
+            x = F.interpolate(x, size=self.out_len, mode='linear')
         return x
 
 
+def decoder_args(config):
+    """
+    Decoder_ResNet settings of hyper_params: decoder ('dense', 'lowrank', 'conv'), decoder_rank, recon_downsample
+    """
+    params = config['hyper_params']
+    return {'decoder': params.get('decoder', 'dense'), 'rank': params.get('decoder_rank', 256),
+            'downsample': params.get('recon_downsample', 1)}
+
+
+##################### Activation checkpointing
+@contextlib.contextmanager
+def _keep_bn_stats(module):
+    # the recomputation in backward must not update the BatchNorm running statistics a second time
+    bns = [m for m in module.modules() if isinstance(m, nn.BatchNorm1d) and m.track_running_stats]
+    stats = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in bns]
+    try:
+        yield
+    finally:
+        for m, (mean, var, n) in zip(bns, stats):
+            m.running_mean.copy_(mean)
+            m.running_var.copy_(var)
+            m.num_batches_tracked.copy_(n)
+
+
+def checkpoint_module(module, function, *args):
+    """
+    function(*args) with its activations recomputed during backward instead of kept;
+    module: the module whose BatchNorm statistics function updates
+    """
+    return checkpoint(function, *args, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), _keep_bn_stats(module)))
+
+
+class CheckpointSequential(nn.Sequential):
+    """
+    nn.Sequential whose activations are recomputed during backward instead of kept (training only);
+    same state_dict keys as nn.Sequential
+    """
+    def forward(self, x):
+        if self.training and torch.is_grad_enabled():
+            return checkpoint_module(self, super(CheckpointSequential, self).forward, x)
+        return super(CheckpointSequential, self).forward(x)
+
+
 ##################### Encoder of VAE
       
 class Encoder_ResNet(nn.Module):
 
-    def __init__(self, out_dim, sampling_rate):
+    def __init__(self, out_dim, sampling_rate, block='bottleneck', groups=4, se=False, checkpoint_layers=[]):
 
         super(Encoder_ResNet, self).__init__()
 
+        self.sampling_rate = sampling_rate
+        self.block, self.groups, self.se = block, groups, se
         self.inplanes = 16
         self.layers = [3, 4, 6, 3]
 
@@ -141,6 +369,8 @@ class Encoder_ResNet(nn.Module):
         self.layer3 = self._make_layer(Bottleneck, 32, self.layers[2], stride=2)
         self.layer4 = self._make_layer(Bottleneck, 32, self.layers[3], stride=2)
         self.maxpool = nn.MaxPool1d(3, 2, 1)
+        for name in checkpoint_layers:
+            setattr(self, name, CheckpointSequential(*getattr(self, name)))
 
         self.dropout = nn.Dropout(p=0.01)
         
@@ -180,19 +410,28 @@ class Encoder_ResNet(nn.Module):
             )
 
         layers = []
-        layers.append(block(self.inplanes, planes, stride, downsample))
+        layers.append(self._block(block, self.inplanes, planes, stride, downsample))
         self.inplanes = planes * block.expansion
         for _ in range(1, blocks):
-            layers.append(block(self.inplanes, planes))
+            layers.append(self._block(block, self.inplanes, planes))
 
         return nn.Sequential(*layers)
 
-    def forward(self, x):
-        batch_size = x.shape[0]
+    def _block(self, block, inplanes, planes, stride=1, downsample=None):
+        # the plain Bottleneck unless a lightweight variant is configured (see block_args)
+        if self.block == 'bottleneck' and not self.se:
+            return block(inplanes, planes, stride, downsample)
+        return LightBottleneck(inplanes, planes, stride, downsample, self.block, self.groups, self.se)
+
+    def stem(self, x):
+        # initial_layer, layer1 and layer2: the part qzd and qzy share with hyper_params shared_trunk
         x = self.initial_layer(x)
         x = self.layer1(x)
         x = self.layer2(x)
-        x = self.maxpool(x)
+        return self.maxpool(x)
+
+    def head(self, x):
+        batch_size = x.shape[0]
         x = self.layer3(x)
         x = self.layer4(x)
         x = self.dropout(x)
@@ -203,14 +442,19 @@ class Encoder_ResNet(nn.Module):
 
         return loc, scale   # (batch_size, out_dim)
 
+    def forward(self, x):
+        return self.head(self.stem(x))
+
 
 ##################### Prior encoder of VAE
 
 
 class p_decoder(nn.Module):
-    def __init__(self, in_dim, out_dim):
+    def __init__(self, in_dim, out_dim, embedding=False):
         super(p_decoder, self).__init__()
-        self.fc1 = nn.Sequential(nn.Linear(in_dim, out_dim, bias=False), nn.BatchNorm1d(out_dim), nn.ReLU())
+        # embedding: x holds class indices instead of one-hot rows (same map, as a table lookup)
+        first = nn.Embedding(in_dim, out_dim) if embedding else nn.Linear(in_dim, out_dim, bias=False)
+        self.fc1 = nn.Sequential(first, nn.BatchNorm1d(out_dim), nn.ReLU())
         self.fc21 = nn.Sequential(nn.Linear(out_dim, out_dim))
         self.fc22 = nn.Sequential(nn.Linear(out_dim, out_dim), nn.Softplus())
 
@@ -243,6 +487,54 @@ class aux_layer(nn.Module):
 
         return loc
 
+
+class DomainHead(aux_layer):
+    """
+    aux_layer predicting the domain (subject) of zd, for up to thousands of domains:
+    'full': softmax over all domains
+    'sampled': in training, softmax over the batch domains and n_samples uniformly drawn ones
+    'hashed': softmax over n_buckets, domain d in bucket d % n_buckets
+    """
+    def __init__(self, in_dim, n_domains, head='full', n_samples=512, n_buckets=1024):
+        out_dim = min(n_domains, n_buckets) if head == 'hashed' else n_domains
+        super(DomainHead, self).__init__(in_dim, out_dim)
+        self.head = head
+        self.n_samples = n_samples
+
+    def loss(self, x, d):
+        # summed cross-entropy of the domains d (in float32 under bfloat16 autocast)
+        if self.head == 'hashed':
+            return F.cross_entropy(self(x).float(), d % self.fc.out_features, reduction='sum')
+        if self.head == 'sampled' and self.training:
+            negatives = torch.randint(self.fc.out_features, (self.n_samples,), device=d.device)
+            classes = torch.cat([d, negatives]).unique()   # sorted
+            logits = F.linear(F.relu(x), self.fc.weight[classes], self.fc.bias[classes])
+            return F.cross_entropy(logits.float(), torch.searchsorted(classes, d), reduction='sum')
+        return F.cross_entropy(self(x).float(), d, reduction='sum')
+
+
+def domain_args(config):
+    params = config['hyper_params']
+    return {'head': params.get('domain_head', 'full'),
+            'n_samples': params.get('domain_samples', 512),
+            'n_buckets': params.get('domain_buckets', 1024)}
+
+##################### Uncertainty
+def predictive_uncertainty(probs):
+    """
+    probs: (n_samples, ..., n_classes) class probabilities of each Monte-Carlo sample
+    """
+    mean_probs = probs.mean(0)
+    entropy = -torch.sum(mean_probs * torch.log(mean_probs + 1e-12), dim=-1)
+    expected_entropy = -torch.sum(probs * torch.log(probs + 1e-12), dim=-1).mean(0)
+    confidence, pred = mean_probs.max(-1)
+
+    return {'probs': mean_probs,                       # (..., n_classes)
+            'pred': pred,                              # (...)
+            'confidence': confidence,
+            'entropy': entropy,
+            'mutual_info': entropy - expected_entropy}
+
 ##################### Feature Net
 class VAE(nn.Module):
     def __init__(self, zd_dim, zy_dim, n_domains, config, d_type):
@@ -264,18 +556,40 @@ class VAE(nn.Module):
             self.sampling_rate = 125
             
         self.contrastive_loss = SupervisedContrastiveLoss()
+        # contrast the B*len embeddings of the whole batch at once instead of B per position
+        self.contrast_sequence = config['hyper_params'].get('contrast_sequence', False)
             
-        self.px = Decoder_ResNet(self.zd_dim, self.zx_dim, self.zy_dim, self.sampling_rate)
-        self.pzd = p_decoder(self.d_dim, self.zd_dim)
+        self.px = Decoder_ResNet(self.zd_dim, self.zy_dim, self.sampling_rate, **decoder_args(config))
+        self.recon_downsample = config['hyper_params'].get('recon_downsample', 1)
+        # domain prior: one-hot into a Linear, or an embedding table indexed by d
+        self.domain_prior = config['hyper_params'].get('domain_prior', 'onehot')
+        self.pzd = p_decoder(self.d_dim, self.zd_dim, embedding=self.domain_prior == 'embedding')
         self.pzy = p_decoder(self.y_dim, self.zy_dim)
 
-        self.qzd = Encoder_ResNet(self.zd_dim, self.sampling_rate)
-        self.qzy = Encoder_ResNet(self.zy_dim, self.sampling_rate)
+        # activation checkpointing: any of 'layer1'..'layer4' (both encoders) and 'decoder'
+        checkpoint_layers = config['hyper_params'].get('checkpoint', [])
+        self.checkpoint_decoder = 'decoder' in checkpoint_layers
+        checkpoint_layers = [name for name in checkpoint_layers if name != 'decoder']
+
+        self.qzd = Encoder_ResNet(self.zd_dim, self.sampling_rate, checkpoint_layers=checkpoint_layers, **block_args(config))
+        self.qzy = Encoder_ResNet(self.zy_dim, self.sampling_rate, checkpoint_layers=checkpoint_layers, **block_args(config))
+
+        # shared trunk: qzd reuses the stem modules of qzy, only layer3/layer4 and the fc heads are separate
+        self.shared_trunk = config['hyper_params'].get('shared_trunk', False)
+        if self.shared_trunk:
+            for name in ['initial_layer', 'layer1', 'layer2']:
+                setattr(self.qzd, name, getattr(self.qzy, name))
 
         # auxiliary
-        self.qd = aux_layer(self.zd_dim, self.d_dim)
+        self.qd = DomainHead(self.zd_dim, self.d_dim, **domain_args(config))
         self.qy = aux_layer(self.zy_dim, self.y_dim)
 
+        # queue of the zy embeddings of previous batches for the contrastive loss (queue_size 0: off),
+        # filled by an EMA copy of qzy if queue_momentum > 0
+        queue_size, queue_momentum = queue_args(config)
+        self.queue = FeatureQueue(queue_size, self.zy_dim) if queue_size else None
+        self.key_encoder = MomentumEncoder(self.qzy, queue_momentum) if queue_size and queue_momentum else None
+
         self.aux_loss_multiplier_y = config['hyper_params']['aux_loss_y']
         self.aux_loss_multiplier_d = config['hyper_params']['aux_loss_d']
 
@@ -285,53 +599,74 @@ class VAE(nn.Module):
 
     def forward(self, x, y, d):
         # Encode
-        zd_q_loc, zd_q_scale = self.qzd(x)
-        zy_q_loc, zy_q_scale = self.qzy(x)
+        if self.shared_trunk:
+            h = self.qzy.stem(x)
+            zd_q_loc, zd_q_scale = self.qzd.head(h)
+            zy_q_loc, zy_q_scale = self.qzy.head(h)
+        else:
+            zd_q_loc, zd_q_scale = self.qzd(x)
+            zy_q_loc, zy_q_scale = self.qzy(x)
 
-        # Reparameterization trick
-        qzd = dist.Normal(zd_q_loc, zd_q_scale)
+        # Reparameterization trick (latents and log_probs in float32 under bfloat16 autocast)
+        qzd = dist.Normal(zd_q_loc.float(), zd_q_scale.float())
         zd_q = qzd.rsample()
 
-        qzy = dist.Normal(zy_q_loc, zy_q_scale)
+        qzy = dist.Normal(zy_q_loc.float(), zy_q_scale.float())
         zy_q = qzy.rsample()
 
         # Decode
-        x_recon = self.px(zy=zy_q, zd=zd_q)
+        if self.checkpoint_decoder and self.training and torch.is_grad_enabled():
+            x_recon = checkpoint_module(self.px, self.px, zy_q, zd_q)
+        else:
+            x_recon = self.px(zy=zy_q, zd=zd_q)
+        x_recon = x_recon.float()
 
         zd_p_loc, zd_p_scale = self.pzd(d)
         zy_p_loc, zy_p_scale = self.pzy(y)
 
         # Reparameterization trick
-        pzd = dist.Normal(zd_p_loc, zd_p_scale)
-        pzy = dist.Normal(zy_p_loc, zy_p_scale)
+        pzd = dist.Normal(zd_p_loc.float(), zd_p_scale.float())
+        pzy = dist.Normal(zy_p_loc.float(), zy_p_scale.float())
 
-        # Auxiliary losses
-        d_hat = self.qd(zd_q)
-        y_hat = self.qy(zy_q)
+        # Auxiliary losses (the domain head is applied in get_losses, see DomainHead.loss)
+        y_hat = self.qy(zy_q).float()
 
-        return x_recon, d_hat, y_hat, qzd, pzd, zd_q, qzy, pzy, zy_q, zy_q_loc
+        return x_recon, y_hat, qzd, pzd, zd_q, qzy, pzy, zy_q, zy_q_loc.float()
 
-    def get_losses(self, x, y, d):        
+    def get_losses(self, x, y, d, return_logits=False):
+        # return_logits: also return the qy logits of the zy means, (batch_size, len, n_class),
+        # i.e. what predict computes, from the same encoder pass
         DIVA_losses, conts_losses = 0, 0
+        f_seq, keys, logits = [], [], []
+
+        use_queue = self.queue is not None and self.training
+        queue = self.queue.get() if use_queue else None
+        if use_queue and self.key_encoder is not None:
+            self.key_encoder.update(self.qzy)
         
         d_target = d
-        d_input = F.one_hot(d, num_classes= self.d_dim).float()
+        d_input = d if self.domain_prior == 'embedding' else F.one_hot(d, num_classes= self.d_dim).float()
 
         for i in range(self.seq_len):
             x_input = x[:, i].view(x.size(0),1, -1)  
             y_target = y[:, i]
             y_input = F.one_hot(y_target, num_classes= self.y_dim).float() 
                   
-            x_recon, d_hat, y_hat, qzd, pzd, zd_q, qzy, pzy, zy_q, features = self.forward(x_input, y_input, d_input)
+            x_recon, y_hat, qzd, pzd, zd_q, qzy, pzy, zy_q, features = self.forward(x_input, y_input, d_input)
 
-            CE_x = F.mse_loss(x_recon, x_input, reduction='sum')
+            if self.recon_downsample > 1:
+                # summed over recon_downsample times fewer samples: rescaled to keep the weight against the KL terms
+                x_target = F.avg_pool1d(x_input, self.recon_downsample)
+                CE_x = F.mse_loss(x_recon, x_target, reduction='sum') * self.recon_downsample
+            else:
+                CE_x = F.mse_loss(x_recon, x_input, reduction='sum')
 
 
             zd_p_minus_zd_q = torch.sum(pzd.log_prob(zd_q) - qzd.log_prob(zd_q))
 
             zy_p_minus_zy_q = torch.sum(pzy.log_prob(zy_q) - qzy.log_prob(zy_q))
 
-            CE_d = F.cross_entropy(d_hat, d_target, reduction='sum')
+            CE_d = self.qd.loss(zd_q, d_target)
             CE_y = F.cross_entropy(y_hat, y_target, reduction='sum')
 
             DIVA_losses += CE_x \
@@ -341,13 +676,28 @@ class VAE(nn.Module):
                + self.aux_loss_multiplier_y * CE_y
             
             
-            conts_losses += self.contrastive_loss(features, y_target)*self.const_weight
+            if self.contrast_sequence:
+                f_seq.append(features)
+            else:
+                conts_losses += self.contrastive_loss(features, y_target, queue)*self.const_weight
+            if use_queue:
+                keys.append(features if self.key_encoder is None else self.key_encoder(x_input))
+            if return_logits:
+                with torch.no_grad():
+                    logits.append(self.qy(features).float())
+
+        if self.contrast_sequence:
+            # same weight as the sum over positions
+            conts_losses = self.contrastive_loss(torch.cat(f_seq), y.t().reshape(-1), queue)*self.const_weight*self.seq_len
+        if use_queue:
+            self.queue.push(torch.cat(keys), y.t().reshape(-1))
             
    
         
         all_losses = (DIVA_losses+conts_losses)/self.seq_len
         
-
+        if return_logits:
+            return all_losses, torch.stack(logits, dim=1)
         return all_losses
 
 
@@ -378,7 +728,30 @@ class VAE(nn.Module):
                 f_seq.append(y.view(batch_size,1, -1))
                 
             out = torch.cat(f_seq, dim=1)
-            out = out.permute(0,2,1)           # (batch_size, n_class, len)      
+            out = out.permute(0,2,1)           # (batch_size, n_class, len)
+        return out
+
+    def encode(self, x):
+        # qzy over all batch_size*len epochs in a single pass
+        batch_size = x.size(0)
+        x_input = x.reshape(batch_size*self.seq_len, 1, -1)
+        loc, scale = self.qzy.forward(x_input)
+        return loc.view(batch_size, self.seq_len, -1), scale.view(batch_size, self.seq_len, -1) # (batch_size, len, n_feat)
+
+    def predict_uncertainty(self, x, n_samples=50, classifier=None):
+        """
+        Monte-Carlo uncertainty: the encoder runs once, n_samples latents are drawn from qzy
+        and pushed through qy (and the classifier, if given) as one batch.
+        """
+        batch_size = x.size(0)
+        with torch.no_grad():
+            loc, scale = self.encode(x)
+            zy = dist.Normal(loc.float(), scale.float()).sample((n_samples,))   # (n_samples, batch_size, len, n_feat)
+
+            out = {'aux': predictive_uncertainty(F.softmax(self.qy(zy).float(), dim=-1))}
+            if classifier is not None:
+                probs = classifier.marginals(zy.view(n_samples*batch_size, self.seq_len, -1))
+                out['classifier'] = predictive_uncertainty(probs.view(n_samples, batch_size, self.seq_len, -1))
         return out
 
 
@@ -395,10 +768,9 @@ class Transformer(nn.Module):
         self.batch_size = config["data_loader"]["args"]["batch_size"]
         self.dim_feedforward = config['hyper_params']['dim_feedforward']
         self.is_CFR =  config['hyper_params']['is_CFR']
-         self.n_layer = n_layer
+        self.n_layer = n_layer
 
         if self.is_CFR  is True:
-            self.mask = torch.ones((self.batch_size, config['hyper_params']['seq_len'])).byte().cuda()
             self.crf = CRF(n_classes)
         else: 
             self.criterion = nn.CrossEntropyLoss()
@@ -414,10 +786,10 @@ class Transformer(nn.Module):
         return x  # (batch_size, seq_len, n_classes)
         
     def get_loss(self, x, y): 
-        x = self.forward(x)
+        x = self.forward(x).float()  # CRF partition function in float32 under bfloat16 autocast
 
         if self.is_CFR is True:
-            mask = self.mask[:len(y)]
+            mask = y.new_ones(y.shape, dtype=torch.bool)
             loss = self.crf.forward(x, y, mask)  # y: (batch_size, sequence_size), mask: (batch_size, sequence_size), out: (batch_size, sequence_size, num_labels)
             loss = -loss.mean()
         else:
@@ -428,13 +800,50 @@ class Transformer(nn.Module):
         return loss
     
     def predict(self, x):
-        x = self.forward(x) # out: (N_batch, Length, Class)
+        x = self.forward(x).float() # out: (N_batch, Length, Class)
         if self.is_CFR is True:
-            mask = self.mask[:len(x)]
+            mask = x.new_ones(x.shape[:2], dtype=torch.bool)
             x = self.crf.viterbi_decode(x, mask)
         else:
             x = self.softmax(x)  
             x = x.permute(0,2,1) 
             x = x.data.max(1)[1].cpu()
         return x
+
+    def marginals(self, x):
+        x = self.forward(x).float() # out: (N_batch, Length, Class)
+        if self.is_CFR is not True:
+            return F.softmax(x, dim=2)
+        return crf_marginals(x, self.crf.trans_matrix, self.crf.start_trans, self.crf.end_trans)
+
+
+def crf_marginals(emissions, trans, start, end):
+    """
+    Posterior marginals of a linear-chain CRF (forward-backward).
+    emissions: (N_batch, Length, Class), returns: (N_batch, Length, Class)
+    """
+    alpha = [start + emissions[:, 0]]
+    for t in range(1, emissions.size(1)):
+        alpha.append(torch.logsumexp(alpha[-1].unsqueeze(2) + trans, dim=1) + emissions[:, t])
+    beta = [end.expand_as(emissions[:, -1])]
+    for t in range(emissions.size(1)-1, 0, -1):
+        beta.insert(0, torch.logsumexp(trans + (emissions[:, t] + beta[0]).unsqueeze(1), dim=2))
+
+    return F.softmax(torch.stack(alpha, dim=1) + torch.stack(beta, dim=1), dim=2)
+
+
+##################### Cascade inference
+def cascade_predict(feature_net, classifier, x, threshold=0.9):
+    """
+    Aux head (qy) first; only windows with an epoch below the confidence threshold are sent to the classifier.
+    returns: predictions (batch_size, len), escalated windows (batch_size,)
+    """
+    with torch.no_grad():
+        features, _ = feature_net.encode(x)
+        confidence, pred = F.softmax(feature_net.qy(features), dim=-1).max(-1)
+        escalate = (confidence < threshold).any(dim=1)
+        if escalate.any():
+            out = classifier.predict(features[escalate])
+            pred[escalate] = torch.as_tensor(out).to(pred.device)
+    return pred, escalate
        
@@ -5,101 +5,108 @@ import torch.distributions as dist
 import random
 import numpy as np
 from TorchCRF import CRF
-from pytorch_metric_learning import losses
+from model.dream import SupervisedContrastiveLoss, FeatureQueue, MomentumEncoder, queue_args, DomainHead, domain_args
 
 import numpy as np
 import torch
 import math
-import cv2
 
 
 ################### Get augmentations
 class Transform:
-    def __init__(self, sampling_rate=100):
+    """
+    Batched augmentations of x (..., length) on the device of x, drawn independently for every
+    signal: random crop resized back to the full length, and random permutation of segments
+    """
+    def __init__(self, sampling_rate=100, crop=(0.25, 0.75), pieces=(5, 20)):
         self.size = sampling_rate*30
-        
-    def permute(self,signal, pieces):
+        self.crop = crop
+        self.pieces = pieces
+
+    def permute(self, signal):
         """
-        signal: numpy array (batch x window)
-        pieces: number of segments along time
+        signal: (..., length); each signal is cut into randint(*pieces) equal segments which are
+        shuffled, the remainder (length % segment) stays at the end
         """
-        signal = signal.cpu().numpy()
-        signal = signal.T
-        pieces = int(np.ceil(np.shape(signal)[0] / (np.shape(signal)[0] // pieces)).tolist()) 
-        piece_length = int(np.shape(signal)[0] // pieces)
-        sequence = list(range(0, pieces))
-        np.random.shuffle(sequence)
-
-        permuted_signal = np.reshape(signal[:(np.shape(signal)[0] // pieces * pieces)],
-                                     (pieces, piece_length,-1)).tolist()
-
-        tail = signal[(np.shape(signal)[0] // pieces * pieces):]
-        permuted_signal = np.asarray(permuted_signal)[sequence]
-        permuted_signal = np.concatenate(permuted_signal, axis=0)
-        permuted_signal = np.concatenate((permuted_signal,tail[:,0]), axis=0)
-        permuted_signal = permuted_signal[:,None]
-        permuted_signal = permuted_signal.T
-        return permuted_signal
-    
-    def crop_resize(self, signal, size):
-        signal = signal.cpu().numpy()
-        signal = signal.T
-        signal_shape = signal.shape
-        size = signal.shape[0] * size
-        size = int(size)
-        start = random.randint(0, signal.shape[0]-size)
-        crop_signal = signal[start:start + size,:]
+        shape = signal.shape
+        signal = signal.reshape(-1, shape[-1])
+        n, length = signal.shape
+        device = signal.device
 
-        crop_signal = cv2.resize(crop_signal, (1, self.size), interpolation=cv2.INTER_LINEAR)
+        pieces = torch.randint(self.pieces[0], self.pieces[1] + 1, (n, 1), device=device)
+        piece_length = length // pieces
+        # random permutation of the first `pieces` segments of every row (unused slots sort last)
+        slots = torch.arange(self.pieces[1], device=device)
+        order = torch.rand(n, self.pieces[1], device=device).masked_fill(slots >= pieces, 2.).argsort(dim=1)
 
-        crop_signal = crop_signal.T
-        return crop_signal
+        t = torch.arange(length, device=device).expand(n, -1)
+        segment = torch.div(t, piece_length, rounding_mode='floor').clamp(max=self.pieces[1] - 1)
+        source = order.gather(1, segment) * piece_length + t - segment * piece_length
+        source = torch.where(t < pieces * piece_length, source, t)
 
-      
-################### Self-supervised contrastive loss
-def Self_SupervisedContrastiveLoss(x, criterion):
-    LARGE_NUM = 1e9
-    temperature = 0.1
-    x = F.normalize(x, dim=-1)
-
-    num = int(x.shape[0] / 2)
-    hidden1, hidden2 = torch.split(x, num)
-
-    hidden1_large = hidden1
-    hidden2_large = hidden2
-    labels = torch.arange(0,num).to('cuda')
-    masks = F.one_hot(torch.arange(0,num), num).to('cuda')
-
-
-    logits_aa = torch.matmul(hidden1, hidden1_large.T) / temperature
-    logits_aa = logits_aa - masks * LARGE_NUM
-    logits_bb = torch.matmul(hidden2, hidden2_large.T) / temperature
-    logits_bb = logits_bb - masks * LARGE_NUM
-    logits_ab = torch.matmul(hidden1, hidden2_large.T) / temperature
-    logits_ba = torch.matmul(hidden2, hidden1_large.T) / temperature
-
-
-    loss_a = criterion(torch.cat([logits_ab, logits_aa], 1),
-        labels)
-    loss_b = criterion(torch.cat([logits_ba, logits_bb], 1),
-        labels)
-    loss = torch.mean(loss_a + loss_b)
-    return loss
-    
+        return signal.gather(1, source).reshape(shape)
 
-################### Supervised contrastive loss
-class SupervisedContrastiveLoss(nn.Module):
-    def __init__(self):
-        super(SupervisedContrastiveLoss, self).__init__()
-        self.tau = 0.07
+    def crop_resize(self, signal):
+        """
+        signal: (..., length); a uniform(*crop) fraction of each signal at a random offset,
+        linearly resized to self.size samples
+        """
+        shape = signal.shape
+        signal = signal.reshape(-1, 1, 1, shape[-1])
+        n, length = signal.shape[0], shape[-1]
+        device = signal.device
 
-    def forward(self, feature_vectors, labels):
-        # Normalize feature vectors
-        logits = F.normalize(feature_vectors, p=2, dim=1)
-                
-        return losses.NTXentLoss(temperature=self.tau)(logits, torch.squeeze(labels))
+        size = (torch.empty(n, device=device).uniform_(*self.crop) * length).floor()
+        start = (torch.rand(n, device=device) * (length - size + 1)).floor()
+
+        # affine map of the output onto [start, start + size) in normalized coordinates
+        theta = signal.new_zeros(n, 2, 3)
+        theta[:, 0, 0] = size / length
+        theta[:, 0, 2] = (2*start + size) / length - 1
+        theta[:, 1, 1] = 1
+        grid = F.affine_grid(theta, (n, 1, 1, self.size), align_corners=False)
+        out = F.grid_sample(signal, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+        return out.reshape(shape[:-1] + (self.size,))
 
       
+################### Self-supervised contrastive loss
+class Self_SupervisedContrastiveLoss(nn.Module):
+    """
+    NT-Xent between two views of N samples stacked as x = (view 1, view 2), (..., 2N, n_feat): each row
+    is contrasted against the other 2N-1 rows of one 2N x 2N similarity matrix, its positive being the
+    other view of the same sample; one loss per leading index.
+    Self-similarity mask and targets are cached per (N, device).
+    queue: (features, labels) of a FeatureQueue, further negatives of every row
+    """
+    def __init__(self, temperature=0.1):
+        super(Self_SupervisedContrastiveLoss, self).__init__()
+        self.temperature = temperature
+        self.masks = {}
+
+    def _masks(self, num, device):
+        if (num, device) not in self.masks:
+            self_mask = torch.eye(2*num, dtype=torch.bool, device=device)
+            targets = torch.arange(2*num, device=device).roll(num)  # i <-> i+num
+            self.masks[(num, device)] = (self_mask, targets)
+        return self.masks[(num, device)]
+
+    def forward(self, x, queue=None):
+        x = F.normalize(x.float(), dim=-1)
+        num = x.shape[-2] // 2
+        self_mask, targets = self._masks(num, x.device)
+
+        logits = torch.matmul(x, x.transpose(-1, -2)) / self.temperature
+        logits = logits.masked_fill(self_mask, float('-inf'))
+        if queue is not None:
+            logits = torch.cat([logits, torch.matmul(x, queue[0].t()) / self.temperature], dim=-1)
+
+        # sum of the mean losses of both views
+        log_probs = F.log_softmax(logits, dim=-1)
+        losses = -log_probs.gather(-1, targets.expand(logits.shape[:-1]).unsqueeze(-1)).squeeze(-1)
+        return losses.mean(-1) * 2
+    
+
 ################### ResNet block
 def conv3(in_planes, out_planes, stride=1):
     return nn.Conv1d(in_planes, out_planes, kernel_size=3, stride=stride, padding=1, bias=False)
@@ -285,9 +292,11 @@ class Encoder_ResNet(nn.Module):
     
 ################### Prior encoder of VAE
 class p_decoder(nn.Module):
-    def __init__(self, in_dim, out_dim):
+    def __init__(self, in_dim, out_dim, embedding=False):
         super(p_decoder, self).__init__()
-        self.fc1 = nn.Sequential(nn.Linear(in_dim, out_dim, bias=False), nn.BatchNorm1d(out_dim), nn.ReLU())
+        # embedding: x holds class indices instead of one-hot rows (same map, as a table lookup)
+        first = nn.Embedding(in_dim, out_dim) if embedding else nn.Linear(in_dim, out_dim, bias=False)
+        self.fc1 = nn.Sequential(first, nn.BatchNorm1d(out_dim), nn.ReLU())
         self.fc21 = nn.Sequential(nn.Linear(out_dim, out_dim))
         self.fc22 = nn.Sequential(nn.Linear(out_dim, out_dim), nn.Softplus())
 
@@ -340,17 +349,19 @@ class VAE(nn.Module):
             self.sampling_rate = 125
             
         self.contrastive_loss = SupervisedContrastiveLoss()
-        self.transformer= Transform()
-        self.criterion = nn.CrossEntropyLoss()
+        self.self_contrastive_loss = Self_SupervisedContrastiveLoss()
+        self.transformer= Transform(self.sampling_rate)
         
-        self.px = Decoder_ResNet(self.zd_dim, self.zx_dim, self.zy_dim, self.sampling_rate)
+        self.px = Decoder_ResNet(self.zd_dim, self.zy_dim, self.sampling_rate)
         self.pzy = p_decoder(self.y_dim, self.zy_dim)
-        self.pzd = p_decoder(self.d_dim, self.zd_dim)
+        # domain prior: one-hot into a Linear, or an embedding table indexed by d
+        self.domain_prior = config['hyper_params'].get('domain_prior', 'onehot')
+        self.pzd = p_decoder(self.d_dim, self.zd_dim, embedding=self.domain_prior == 'embedding')
         
         self.qzy = Encoder_ResNet(self.zy_dim, self.sampling_rate)
         self.qzd = Encoder_ResNet(self.zd_dim, self.sampling_rate)
 
-        self.qd = aux_layer(self.zd_dim, self.d_dim)
+        self.qd = DomainHead(self.zd_dim, self.d_dim, **domain_args(config))
         self.qy = aux_layer(self.zy_dim, self.y_dim)
 
         self.aux_loss_multiplier_y = config['hyper_params']['aux_loss_y']
@@ -360,14 +371,25 @@ class VAE(nn.Module):
         self.beta_y = config['hyper_params']['beta_y']
         self.const_weight = config['hyper_params']['const_weight']*config['hyper_params']['const_weight_ratio']
 
+        # queues of the zy (supervised) and zd (self-supervised) embeddings of previous batches for the
+        # contrastive losses (queue_size 0: off), filled by EMA copies of qzy / qzd if queue_momentum > 0
+        queue_size, queue_momentum = queue_args(config)
+        self.queue_y = FeatureQueue(queue_size, self.zy_dim) if queue_size else None
+        self.queue_d = FeatureQueue(queue_size, self.zd_dim) if queue_size else None
+        self.key_encoder_y = MomentumEncoder(self.qzy, queue_momentum) if queue_size and queue_momentum else None
+        self.key_encoder_d = MomentumEncoder(self.qzd, queue_momentum) if queue_size and queue_momentum else None
+
         
     def forward(self, x, y, d):
+        # y labels the first y.size(0) windows of x, the remaining ones only go through qzd
         zd_q_loc, zd_q_scale = self.qzd(x)        # Encode
-        qzd = dist.Normal(zd_q_loc, zd_q_scale)   # Reparameterization trick
-        zd_q = qzd.rsample() 
-        
         if y is None:
           return zd_q_loc
+
+        n_labeled = y.size(0)
+        x, d = x[:n_labeled], d[:n_labeled]
+        qzd = dist.Normal(zd_q_loc[:n_labeled], zd_q_scale[:n_labeled])   # Reparameterization trick
+        zd_q = qzd.rsample() 
         
         zy_q_loc, zy_q_scale = self.qzy(x)          # Encode
         qzy = dist.Normal(zy_q_loc, zy_q_scale)     # Reparameterization trick
@@ -378,80 +400,89 @@ class VAE(nn.Module):
         
         zd_p_loc, zd_p_scale = self.pzd(d)
         pzd = dist.Normal(zd_p_loc, zd_p_scale)
-        d_hat = self.qd(zd_q)
             
         zy_p_loc, zy_p_scale = self.pzy(y)
 
         pzy = dist.Normal(zy_p_loc, zy_p_scale)
         y_hat = self.qy(zy_q)
 
-        return x_recon, d_hat, y_hat, qzd, pzd, zd_q, qzy, pzy, zy_q, zy_q_loc, zd_q_loc
+        # the domain head is applied in get_losses, see DomainHead.loss
+        return x_recon, y_hat, qzd, pzd, zd_q, qzy, pzy, zy_q, zy_q_loc, zd_q_loc
 
-    def get_losses(self, x, y, d):        
-        DIVA_losses, conts_losses = 0, 0
-        
-        d_target = d
-        d_input = F.one_hot(d, num_classes= self.d_dim).float()
-
-        for i in range(self.seq_len):
-            x_input = x[:, i].view(x.size(0),1, -1)
-            if y is not None:  # Supervised
-                y_target = y[:, i]
-                y_input = F.one_hot(y_target, num_classes= self.y_dim).float() 
-                
-                # Make transformed copies
-                x_croped = self.transformer.crop_resize(x_input,random.uniform(0.25,0.75))
-                x_croped  = torch.FloatTensor(x_croped).cuda()
-                
-                x_permuted = self.transformer.permute(x_input,random.randint(5,20))
-                x_permuted  = torch.FloatTensor(x_permuted).cuda()
-                 
-                feature_set = torch.tensor([]).cuda()
-                for x_transformed in [x_croped, x_permuted]:
-                    x_recon, d_hat, y_hat, qzd, pzd, zd_q, qzy, pzy, zy_q, features_class, features_domain = self.forward(x=x_transformed, y=y_input, d=d_input)
-                    feature_set = torch.cat((feature_set,features_domain), dim=0)
-                    
-                    CE_x = F.mse_loss(x_recon, x_transformed, reduction='sum')
-                    CE_d = F.cross_entropy(d_hat, d_target, reduction='sum')
-        
-                    zd_p_minus_zd_q = torch.sum(pzd.log_prob(zd_q) - qzd.log_prob(zd_q))
+    def get_losses(self, x, y, d, return_logits=False):
+        """
+        Both augmented views of all positions go through a single forward pass of
+        2*len*batch_size windows (view-major, then position, then batch).
+        y may label only the first y.size(0) sequences of x (mixed batch): their windows come
+        first and get the supervised terms, all windows get the self-supervised term.
+        return_logits: also return the qy logits of the zy means of the labeled sequences, averaged
+        over both views, (y.size(0), len, n_class); None without y
+        """
+        batch_size = x.size(0)
+        n_labeled = 0 if y is None else y.size(0)
+        n_windows = 2*self.seq_len*n_labeled
 
-                
-                    CE_y = F.cross_entropy(y_hat, y_target, reduction='sum')
-                    zy_p_minus_zy_q = torch.sum(pzy.log_prob(zy_q) - qzy.log_prob(zy_q))
-                    
-                    DIVA_losses += (CE_x \
-                       - self.beta_d * zd_p_minus_zd_q \
-                       - self.beta_y * zy_p_minus_zy_q \
-                       + self.aux_loss_multiplier_d * CE_d \
-                       + self.aux_loss_multiplier_y * CE_y)*0.5
-      
-                    conts_losses += self.contrastive_loss(features_class, y_target)*self.const_weight*0.5. # supervised Contrastive loss
-                    
-                conts_losses += Self_SupervisedContrastiveLoss(feature_set, self.criterion)*self.const_weight # Self-supervised Contrastive loss
-                
-            else:   # Unsupervised
-                y_input = None
-                
-                # Make transformed copies
-                x_croped = self.transformer.crop_resize(x_input,random.uniform(0.25,0.75))
-                x_croped  = torch.FloatTensor(x_croped).cuda()
-                
-                x_permuted = self.transformer.permute(x_input,random.randint(5,20))
-                x_permuted  = torch.FloatTensor(x_permuted).cuda()
-                 
-                feature_set = torch.tensor([]).cuda()
-                for x_transformed in [x_croped, x_permuted]:
-                    features = self.forward(x=x_transformed, y=y_input, d=d_input)
-                    
-                    feature_set = torch.cat((feature_set,features), dim=0)
-
-                conts_losses += Self_SupervisedContrastiveLoss(feature_set, self.criterion)*self.const_weight # Self-supervised Contrastive loss
-                
+        # Make transformed copies: (2, len, batch_size, 1, size)
+        x_seq = x.reshape(batch_size, self.seq_len, 1, -1).transpose(0, 1)
+        views = torch.stack([self.transformer.crop_resize(x_seq), self.transformer.permute(x_seq)])
+        x_views = torch.cat([views[:, :, :n_labeled].reshape(-1, 1, views.shape[-1]),
+                             views[:, :, n_labeled:].reshape(-1, 1, views.shape[-1])])
+
+        d_target = torch.cat([d[:n_labeled].repeat(2*self.seq_len), d[n_labeled:].repeat(2*self.seq_len)])
+        d_input = d_target if self.domain_prior == 'embedding' else F.one_hot(d_target, num_classes= self.d_dim).float()
+
+        use_queue = self.queue_y is not None and self.training
+        if use_queue and self.key_encoder_y is not None:
+            self.key_encoder_y.update(self.qzy)
+            self.key_encoder_d.update(self.qzd)
+
+        DIVA_losses, conts_losses = 0, 0
+        if y is not None:  # Supervised
+            y_target = y.t().repeat(2, 1).reshape(-1)
+            y_input = F.one_hot(y_target, num_classes= self.y_dim).float()
+
+            x_recon, y_hat, qzd, pzd, zd_q, qzy, pzy, zy_q, features_class, features_domain = self.forward(x=x_views, y=y_input, d=d_input)
+
+            CE_x = F.mse_loss(x_recon, x_views[:n_windows], reduction='sum')
+            CE_d = self.qd.loss(zd_q, d_target[:n_windows])
+            zd_p_minus_zd_q = torch.sum(pzd.log_prob(zd_q) - qzd.log_prob(zd_q))
+
+            CE_y = F.cross_entropy(y_hat, y_target, reduction='sum')
+            zy_p_minus_zy_q = torch.sum(pzy.log_prob(zy_q) - qzy.log_prob(zy_q))
+
+            DIVA_losses = (CE_x \
+               - self.beta_d * zd_p_minus_zd_q \
+               - self.beta_y * zy_p_minus_zy_q \
+               + self.aux_loss_multiplier_d * CE_d \
+               + self.aux_loss_multiplier_y * CE_y)*0.5
+
+            # supervised Contrastive loss, per view and position
+            conts_losses = self.contrastive_loss(features_class.view(2*self.seq_len, n_labeled, -1),
+                                                 y_target.view(2*self.seq_len, n_labeled),
+                                                 self.queue_y.get() if use_queue else None).sum()*self.const_weight*0.5
+            if use_queue:
+                keys = features_class if self.key_encoder_y is None else self.key_encoder_y(x_views[:n_windows])
+                self.queue_y.push(keys, y_target)
+            if return_logits:
+                with torch.no_grad():
+                    logits = self.qy(features_class).view(2, self.seq_len, n_labeled, -1).mean(0).transpose(0, 1)
+
+        else:   # Unsupervised
+            features_domain = self.forward(x=x_views, y=None, d=d_input)
+            logits = None
+
+        # Self-supervised Contrastive loss between the two views, per position: (len, 2*batch_size, n_feat)
+        features_domain = torch.cat([features_domain[:n_windows].view(2, self.seq_len, n_labeled, self.zd_dim),
+                                     features_domain[n_windows:].view(2, self.seq_len, batch_size - n_labeled, self.zd_dim)], dim=2)
+        feature_set = features_domain.transpose(0, 1).reshape(self.seq_len, 2*batch_size, -1)
+        conts_losses += self.self_contrastive_loss(feature_set, self.queue_d.get() if use_queue else None).sum()*self.const_weight
+        if use_queue:
+            self.queue_d.push(features_domain.reshape(-1, self.zd_dim) if self.key_encoder_d is None else self.key_encoder_d(x_views))
 
         all_losses = (DIVA_losses+conts_losses)/self.seq_len
         
-
+        if return_logits:
+            return all_losses, logits
         return all_losses
 
   
@@ -0,0 +1,424 @@
+import contextlib
+import copy
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from model.dream import Encoder_ResNet, aux_layer, Transformer, crf_marginals, channel_shuffle
+from model.pruning import resize_to_state_dict
+
+
+##################### Conv-BN folding
+class FusedBottleneck(nn.Module):
+    """
+    Bottleneck / LightBottleneck with every BatchNorm folded into the preceding convolution (eval only)
+    """
+    def __init__(self, block):
+        super(FusedBottleneck, self).__init__()
+        self.conv1 = fuse_conv_bn_eval(block.conv1, block.bn1)
+        self.conv2 = fuse_conv_bn_eval(block.conv2, block.bn2)
+        self.conv3 = fuse_conv_bn_eval(block.conv3, block.bn3)
+        self.groups = getattr(block, 'groups', 1)
+        self.se = getattr(block, 'se', None)
+        self.downsample = None
+        if block.downsample is not None:
+            self.downsample = fuse_conv_bn_eval(block.downsample[0], block.downsample[1])
+
+    def forward(self, x):
+        out = F.relu(self.conv1(x), inplace=True)
+        if self.groups > 1:
+            out = channel_shuffle(out, self.groups)
+        out = F.relu(self.conv2(out), inplace=True)
+        out = self.conv3(out)
+        if self.se is not None:
+            out = self.se(out)
+
+        out += x if self.downsample is None else self.downsample(x)
+        return F.relu(out, inplace=True)
+
+
+def fuse_encoder(encoder, check=True):
+    """
+    Inference copy of an Encoder_ResNet with BatchNorm folded into the convolutions of the
+    initial_layer stem, every Bottleneck and the downsample paths. Dropout is removed and the
+    stem ReLU moved behind the max-pool (both are monotone, so the result is unchanged).
+    """
+    training = encoder.training
+    encoder.eval()
+
+    fused = copy.deepcopy(encoder)
+    conv, bn, relu, maxpool = fused.initial_layer
+    fused.initial_layer = nn.Sequential(fuse_conv_bn_eval(conv, bn), maxpool, relu)
+    for name in ['layer1', 'layer2', 'layer3', 'layer4']:
+        setattr(fused, name, nn.Sequential(*[FusedBottleneck(block) for block in getattr(fused, name)]))
+    fused.dropout = nn.Identity()
+
+    if check:
+        x = torch.randn(4, 1, encoder.sampling_rate*30, device=encoder.fc11[0].weight.device)
+        with torch.no_grad():
+            ref, out = encoder(x)[0], fused(x)[0]
+        assert torch.allclose(out, ref, rtol=1e-4, atol=1e-4 * ref.abs().max().item()), \
+            'fused encoder deviates from the original (max abs diff {:.3e})'.format((out - ref).abs().max().item())
+
+    encoder.train(training)
+    return fused
+
+
+##################### Slim inference model
+@contextlib.contextmanager
+def mha_fastpath(enabled):
+    """
+    torch.backends.mha fast path (fused TransformerEncoderLayer kernels) set to enabled inside the
+    block, restored after
+    """
+    previous = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(enabled)
+    try:
+        yield
+    finally:
+        torch.backends.mha.set_fastpath_enabled(previous)
+
+
+@contextlib.contextmanager
+def quantized_engine(backend):
+    """
+    torch.backends.quantized.engine set to backend inside the block, restored after
+    """
+    previous = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    try:
+        yield
+    finally:
+        torch.backends.quantized.engine = previous
+
+
+class InferenceNet(nn.Module):
+    """
+    Inference-only DREAM: qzy encoder, optional qy aux head, Transformer and CRF.
+    Built from a plain dict (see export_inference_model), no training config needed.
+    """
+    def __init__(self, config):
+        super(InferenceNet, self).__init__()
+        self.config = config
+        self.seq_len = config['seq_len']
+        self.quantized = False
+        self.backend = None  # quantized engine of an int8 model
+        self.fused = False
+        self.amp = False
+
+        self.qzy = Encoder_ResNet(config['zy_dim'], config['sampling_rate'], config.get('block', 'bottleneck'),
+                                  config.get('groups', 4), config.get('se', False))
+        self.qy = aux_layer(config['zy_dim'], config['num_classes']) if config['aux_head'] else None
+
+        classifier_config = {'data_loader': {'args': {'batch_size': 1}},
+                             'hyper_params': {'dim_feedforward': config['dim_feedforward'],
+                                              'is_CFR': config['is_CFR'],
+                                              'seq_len': config['seq_len']}}
+        self.classifier = Transformer(config['zy_dim'], classifier_config,
+                                      n_layer=config['n_layers'], n_classes=config['num_classes'])
+        del self.classifier.encoder_layer  # template layer, deep-copied into transformer_encoder
+
+    def fuse(self):
+        if not self.fused:
+            self.qzy = fuse_encoder(self.qzy)
+            self.fused = True
+        return self
+
+    def mixed_precision(self, enabled=True):
+        # bfloat16 autocast of encoder and Transformer on CPU; emissions and CRF decoding stay float32
+        self.amp = enabled
+        return self
+
+    def encode(self, x):
+        batch_size = x.size(0)
+        loc, _ = self.qzy(x.reshape(batch_size*self.seq_len, 1, -1))
+        return loc.view(batch_size, self.seq_len, -1)  # (batch_size, len, n_feat)
+
+    def _int8(self):
+        # an int8 model runs on the engine it was quantized for, without the fused encoder-layer
+        # fast path (which cannot take the packed int8 Linear weights)
+        stack = contextlib.ExitStack()
+        if self.quantized:
+            stack.enter_context(quantized_engine(self.backend))
+            stack.enter_context(mha_fastpath(False))
+        return stack
+
+    def forward(self, x):
+        with self._int8(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.amp):
+            return self.classifier(self.encode(x)).float()  # (batch_size, len, n_classes)
+
+    def predict(self, x):
+        with torch.no_grad(), self._int8(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.amp):
+            return self.classifier.predict(self.encode(x))
+
+    def predict_aux(self, x):
+        if self.qy is None:
+            raise ValueError('model was exported without the aux head (aux_head=False)')
+        with torch.no_grad(), self._int8(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.amp):
+            return self.qy(self.encode(x)).argmax(-1)  # (batch_size, len)
+
+
+def build_inference_model(feature_net, classifier, sampling_rate, aux_head=True):
+    """
+    InferenceNet holding the qzy / qy weights of a trained VAE and the trained Transformer
+    """
+    config = {'sampling_rate': sampling_rate,
+              'seq_len': feature_net.seq_len,
+              'num_classes': feature_net.y_dim,
+              'zy_dim': feature_net.zy_dim,
+              'dim_feedforward': classifier.dim_feedforward,
+              'n_layers': classifier.n_layer,
+              'n_heads': classifier.transformer_encoder.layers[0].self_attn.num_heads,
+              'is_CFR': classifier.is_CFR,
+              'aux_head': aux_head,
+              'block': feature_net.qzy.block,
+              'groups': feature_net.qzy.groups,
+              'se': feature_net.qzy.se}
+
+    model = InferenceNet(config)
+    resize_to_state_dict(model.qzy, feature_net.qzy.state_dict())
+    model.qzy.load_state_dict(feature_net.qzy.state_dict())
+    if aux_head:
+        model.qy.load_state_dict(feature_net.qy.state_dict())
+    model.classifier.load_state_dict({k: v for k, v in classifier.state_dict().items()
+                                      if not k.startswith('encoder_layer.')})
+    return model.to(next(feature_net.parameters()).device).eval()
+
+
+def export_inference_model(model, path):
+    """
+    Write <path>/config.json and the weights of InferenceNet: <path>/model.pth (float) or
+    <path>/model_int8.pth (after quantize_inference_model)
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    filename = 'model_int8.pth' if model.quantized else 'model.pth'
+    torch.save(model.state_dict(), path / filename)
+    with (path / 'config.json').open('wt') as handle:
+        json.dump(model.config, handle, indent=4)
+
+
+def load_inference_model(path, device='cpu', fuse=False, quantized=False):
+    path = Path(path)
+    with (path / 'config.json').open('rt') as handle:
+        config = json.load(handle)
+
+    state_dict = torch.load(path / 'model.pth', map_location=device, weights_only=True)
+    model = resize_to_state_dict(InferenceNet(config), state_dict).eval()  # pruned encoders
+    if quantized:
+        model = quantize_inference_model(model)
+        with quantized_engine(model.backend):
+            model.load_state_dict(torch.load(path / 'model_int8.pth', map_location='cpu', weights_only=True))  # int8 kernels are CPU only
+        return model
+
+    model.load_state_dict(state_dict)
+    model = model.to(device)
+    if fuse:
+        model.fuse()
+    return model
+
+
+##################### Scripted pipeline
+def viterbi_decode(emissions, trans, start, end):
+    """
+    Batched Viterbi with tensor back-tracking, same scores as TorchCRF.CRF.viterbi_decode.
+    emissions: (batch_size, len, n_classes), returns: (batch_size, len)
+    """
+    score = start + emissions[:, 0]
+    history = []
+    for t in range(1, emissions.size(1)):
+        score, idx = (score.unsqueeze(2) + trans).max(1)
+        score = score + emissions[:, t]
+        history.append(idx)
+
+    best = (score + end).argmax(1)
+    path = [best]
+    for i in range(len(history) - 1, -1, -1):
+        best = history[i].gather(1, best.unsqueeze(1)).squeeze(1)
+        path.insert(0, best)
+    return torch.stack(path, dim=1)
+
+
+class InferencePipeline(nn.Module):
+    """
+    Encoder over batch_size*len epochs -> Transformer -> CRF Viterbi as one scriptable module,
+    returning stage labels (batch_size, len)
+    """
+    def __init__(self, model):
+        super(InferencePipeline, self).__init__()
+        self.seq_len = model.seq_len
+        self.qzy = model.qzy
+        self.transformer_encoder = model.classifier.transformer_encoder
+        self.fc = model.classifier.fc
+        self.is_CFR = model.classifier.is_CFR is True
+
+        n_classes = self.fc.out_features
+        crf = model.classifier.crf if self.is_CFR else None
+        self.register_buffer('trans', crf.trans_matrix.detach().clone() if self.is_CFR else torch.zeros(n_classes, n_classes))
+        self.register_buffer('start', crf.start_trans.detach().clone() if self.is_CFR else torch.zeros(n_classes))
+        self.register_buffer('end', crf.end_trans.detach().clone() if self.is_CFR else torch.zeros(n_classes))
+
+    def forward(self, x):
+        batch_size = x.size(0)
+        loc, _ = self.qzy(x.reshape(batch_size*self.seq_len, 1, -1))
+        emissions = self.fc(self.transformer_encoder(loc.view(batch_size, self.seq_len, -1)))
+        if self.is_CFR:
+            return viterbi_decode(emissions, self.trans, self.start, self.end)
+        return emissions.argmax(2)
+
+
+def script_inference_model(model, path=None):
+    """
+    Frozen TorchScript InferencePipeline; saved to <path>/model_scripted.pt if path is given and
+    loadable there with torch.jit.load alone.
+    """
+    scripted = torch.jit.freeze(torch.jit.script(InferencePipeline(model).eval()))
+    if path is not None:
+        torch.jit.save(scripted, str(Path(path) / 'model_scripted.pt'))
+    return scripted
+
+
+def compile_inference_model(model, **kwargs):
+    return torch.compile(InferencePipeline(model).eval(), **kwargs)
+
+
+##################### Multi-fold ensemble
+class EnsembleNet(nn.Module):
+    """
+    Identically-shaped InferenceNet members (e.g. the per-fold models) evaluated in one batched pass:
+    their weights are stacked along a leading member dim and the forward is vmapped over it.
+    Members are BatchNorm-folded first, so the vmapped encoder is only convolutions and ReLUs.
+    """
+    def __init__(self, models):
+        super(EnsembleNet, self).__init__()
+        self.config = models[0].config
+        self.seq_len = models[0].seq_len
+        self.n_members = len(models)
+        self.is_CFR = models[0].classifier.is_CFR is True
+
+        models = [copy.deepcopy(model).cpu().eval().fuse() for model in models]
+        params, buffers = torch.func.stack_module_state(models)
+        self.names = list(params) + list(buffers)
+        for name, value in list(params.items()) + list(buffers.items()):
+            self.register_buffer(name.replace('.', '__'), value.detach())
+
+        self.base = [copy.deepcopy(models[0]).to('meta')]  # structure only, kept out of the module tree
+
+    def _member(self, state, x):
+        return torch.func.functional_call(self.base[0], state, (x,))
+
+    def forward(self, x):
+        state = {name: getattr(self, name.replace('.', '__')) for name in self.names}
+        with mha_fastpath(False):  # the fused attention kernels have no vmap batching rule
+            return torch.func.vmap(self._member, in_dims=(0, None))(state, x)  # (n_members, batch_size, len, n_classes)
+
+    def aggregate(self, emissions, method='marginals'):
+        """
+        emissions: (n_members, batch_size, len, n_classes) -> stages (batch_size, len) by the mean of
+        the members' posterior marginals ('marginals') or the majority of their Viterbi paths ('vote')
+        """
+        if not self.is_CFR:
+            return F.softmax(emissions, dim=-1).mean(0).argmax(-1)
+
+        crf = [getattr(self, 'classifier__crf__' + name) for name in ['trans_matrix', 'start_trans', 'end_trans']]
+        if method == 'marginals':
+            return torch.func.vmap(crf_marginals)(emissions, *crf).mean(0).argmax(-1)
+        votes = torch.func.vmap(viterbi_decode)(emissions, *crf)
+        return F.one_hot(votes, emissions.size(-1)).sum(0).argmax(-1)
+
+    def predict(self, x, method='marginals'):
+        with torch.no_grad():
+            return self.aggregate(self.forward(x), method)
+
+
+##################### ONNX export
+class _OnnxGraph(nn.Module):
+    def __init__(self, model):
+        super(_OnnxGraph, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        features = self.model.encode(x)
+        emissions = self.model.classifier(features)
+        if self.model.qy is None:
+            return emissions
+        return emissions, self.model.qy(features)
+
+
+def export_onnx_model(model, path, opset_version=17):
+    """
+    Write <path>/model.onnx (qzy encoder, qy aux head and Transformer emissions, dynamic batch) and
+    <path>/crf.npz (CRF transitions) for model.runtime.OnnxScorer
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    model = copy.deepcopy(model).cpu().eval()
+
+    output_names = ['emissions'] if model.qy is None else ['emissions', 'aux']
+    x = torch.randn(2, model.seq_len, model.config['sampling_rate']*30, 1)
+    torch.onnx.export(_OnnxGraph(model), (x,), str(path / 'model.onnx'),
+                      input_names=['x'], output_names=output_names,
+                      dynamic_axes={name: {0: 'batch_size'} for name in ['x'] + output_names},
+                      opset_version=opset_version)
+
+    if model.classifier.is_CFR is True:
+        crf = model.classifier.crf
+        np.savez(path / 'crf.npz', trans=crf.trans_matrix.detach().numpy(),
+                 start=crf.start_trans.detach().numpy(), end=crf.end_trans.detach().numpy())
+    with (path / 'config.json').open('wt') as handle:
+        json.dump(model.config, handle, indent=4)
+
+
+##################### NumPy export
+def export_numpy_model(model, path):
+    """
+    Write <path>/model.npz (BatchNorm-folded encoder, qy and Transformer arrays) and
+    <path>/config.json for model.runtime.NumpyScorer
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    model = copy.deepcopy(model).cpu().eval().fuse()
+
+    arrays = {k: v.detach().numpy() for k, v in model.state_dict().items()}
+    np.savez(path / 'model.npz', **arrays)
+    with (path / 'config.json').open('wt') as handle:
+        json.dump(model.config, handle, indent=4)
+
+
+##################### Post-training quantization
+def quantize_inference_model(model, calibration_loader=None, n_batches=32, backend='x86'):
+    """
+    int8 copy of an InferenceNet for CPU serving. qzy is statically quantized (Conv1d/Linear, BatchNorm
+    folded by FX) with observers calibrated on calibration_loader batches; qy and the Transformer
+    Linear layers are dynamically quantized. Without a loader only the int8 structure is built,
+    to load a saved model_int8.pth into.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    with quantized_engine(backend):  # weights are packed for backend, the global engine is restored after
+        example = torch.randn(2, 1, model.config['sampling_rate']*30)
+        qzy = prepare_fx(model.qzy, get_default_qconfig_mapping(backend), (example,))
+        with torch.no_grad():
+            if calibration_loader is None:
+                qzy(example)
+            else:
+                for batch_idx, (x, _, _) in enumerate(calibration_loader):
+                    if batch_idx == n_batches:
+                        break
+                    qzy(x.reshape(-1, 1, example.shape[-1]))
+        model.qzy = convert_fx(qzy)
+
+        if model.qy is not None:
+            model.qy = quantize_dynamic(model.qy, {nn.Linear}, dtype=torch.qint8)
+        model.classifier = quantize_dynamic(model.classifier, {nn.Linear}, dtype=torch.qint8)
+
+    model.quantized = True
+    model.backend = backend
+    return model
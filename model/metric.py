@@ -1,12 +1,78 @@
-from sklearn.metrics import confusion_matrix, f1_score, accuracy_score
+import numpy as np
+import torch
 
 
+##################### Confusion matrix
+class ConfusionMatrix:
+    """
+    Streaming confusion matrix (rows: targets, columns: predictions), accumulated with one bincount
+    per batch on the device of the batch, so that metrics cost O(n_classes^2) at the end of an epoch
+    """
+    def __init__(self, n_classes):
+        self.n_classes = n_classes
+        self.reset()
 
-def accuracy(output, target):
-    return accuracy_score(target, output)
+    def reset(self):
+        self.matrix = None
 
-def confusion(output, target):
-    return confusion_matrix(target,output )
+    def update(self, output, target):
+        # output: predicted stages (tensor, array or nested list), target: true stages; returns the batch counts
+        target = torch.as_tensor(target)
+        output = torch.as_tensor(output, device=target.device)
+        index = target.reshape(-1).long() * self.n_classes + output.reshape(-1).long()
+        counts = torch.bincount(index, minlength=self.n_classes**2).view(self.n_classes, self.n_classes)
+        self.matrix = counts if self.matrix is None else self.matrix + counts
+        return counts
 
-def f1(output, target):
-    return f1_score(target,output, average='macro')
+    def result(self):
+        if self.matrix is None:
+            return np.zeros((self.n_classes, self.n_classes), dtype=np.int64)
+        return self.matrix.cpu().numpy()
+
+
+def confusion_matrix(output, target):
+    output, target = np.asarray(output, dtype=np.int64).reshape(-1), np.asarray(target, dtype=np.int64).reshape(-1)
+    n_classes = max(output.max(initial=0), target.max(initial=0)) + 1
+    return np.bincount(target * n_classes + output, minlength=n_classes**2).reshape(n_classes, n_classes)
+
+
+def _matrix(output, target):
+    # every metric takes predicted / true stages, or a confusion matrix as output with target None
+    return np.asarray(output) if target is None else confusion_matrix(output, target)
+
+
+##################### Metrics
+# accuracy, f1 and kappa return plain floats; confusion and the class_* metrics arrays
+def accuracy(output, target=None):
+    matrix = _matrix(output, target)
+    return float(np.trace(matrix) / max(matrix.sum(), 1))
+
+def confusion(output, target=None):
+    return _matrix(output, target)
+
+def class_precision(output, target=None):
+    matrix = _matrix(output, target)
+    return np.diag(matrix) / np.maximum(matrix.sum(0), 1)
+
+def class_recall(output, target=None):
+    matrix = _matrix(output, target)
+    return np.diag(matrix) / np.maximum(matrix.sum(1), 1)
+
+def class_f1(output, target=None):
+    matrix = _matrix(output, target)
+    tp = np.diag(matrix)
+    return 2 * tp / np.maximum(matrix.sum(0) + matrix.sum(1), 1)
+
+def f1(output, target=None):
+    # macro average over the stages that occur as target or prediction (as sklearn)
+    matrix = _matrix(output, target)
+    present = (matrix.sum(0) + matrix.sum(1)) > 0
+    return float(class_f1(matrix)[present].mean()) if present.any() else 0.
+
+def kappa(output, target=None):
+    # Cohen's kappa
+    matrix = _matrix(output, target)
+    total = max(matrix.sum(), 1)
+    observed = np.trace(matrix) / total
+    expected = (matrix.sum(0) * matrix.sum(1)).sum() / total**2
+    return float((observed - expected) / (1 - expected)) if expected < 1 else 0.
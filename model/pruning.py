@@ -0,0 +1,158 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+
+##################### Channel importance
+def bn_scores(module):
+    """
+    |gamma| of every BatchNorm1d in module (name -> per-channel importance)
+    """
+    return {name: m.weight.detach().abs() for name, m in module.named_modules() if isinstance(m, nn.BatchNorm1d)}
+
+
+def taylor_scores(feature_net, data_loader, device, n_batches=16):
+    """
+    First-order Taylor importance |gamma * dL/dgamma| of every BatchNorm1d in feature_net,
+    accumulated over n_batches of the VAE loss (BN statistics are not updated)
+    """
+    training = feature_net.training
+    feature_net.eval()
+    bns = {name: m for name, m in feature_net.named_modules() if isinstance(m, nn.BatchNorm1d)}
+    scores = {name: torch.zeros_like(m.weight) for name, m in bns.items()}
+
+    for batch_idx, (x, y, d) in enumerate(data_loader):
+        if batch_idx == n_batches:
+            break
+        x, y, d = x.to(device), y.to(device), d.to(device)
+
+        feature_net.zero_grad()
+        feature_net.get_losses(x, y, d).backward()
+        for name, m in bns.items():
+            scores[name] += (m.weight * m.weight.grad).detach().abs()
+
+    feature_net.zero_grad()
+    feature_net.train(training)
+    return scores
+
+
+##################### Physical channel removal
+def _keep(scores, ratio):
+    n_keep = max(1, int(round(scores.numel() * (1 - ratio))))
+    return scores.topk(n_keep)[1].sort()[0]
+
+
+def _slice_conv(conv, out_idx=None, in_idx=None):
+    weight = conv.weight.detach()
+    if out_idx is not None:
+        weight = weight[out_idx]
+    if in_idx is not None:
+        weight = weight[:, in_idx]
+
+    new = nn.Conv1d(weight.shape[1], weight.shape[0], conv.kernel_size, conv.stride, conv.padding,
+                    bias=conv.bias is not None)
+    new.weight.data.copy_(weight)
+    if conv.bias is not None:
+        new.bias.data.copy_(conv.bias.detach() if out_idx is None else conv.bias.detach()[out_idx])
+    return new.to(weight.device)
+
+
+def _slice_bn(bn, idx):
+    new = nn.BatchNorm1d(len(idx), bn.eps, bn.momentum)
+    new.weight.data.copy_(bn.weight.detach()[idx])
+    new.bias.data.copy_(bn.bias.detach()[idx])
+    new.running_mean.copy_(bn.running_mean[idx])
+    new.running_var.copy_(bn.running_var[idx])
+    new.num_batches_tracked.copy_(bn.num_batches_tracked)
+    return new.to(bn.weight.device)
+
+
+def _slice_fc(fc, idx, n_channels):
+    # fc applied on x.view(batch_size, -1) of a (batch_size, n_channels, length) map
+    weight = fc.weight.detach().view(fc.out_features, n_channels, -1)[:, idx].reshape(fc.out_features, -1)
+    new = nn.Linear(weight.shape[1], fc.out_features)
+    new.weight.data.copy_(weight)
+    new.bias.data.copy_(fc.bias.detach())
+    return new.to(weight.device)
+
+
+def prune_encoder(encoder, ratio, scores):
+    """
+    Dense copy of an Encoder_ResNet with a fraction ratio of the channels removed from every
+    Bottleneck (conv1/conv2 widths) and from the residual stream of every stage (conv3, the
+    downsample path and the inputs of the next stage / fc11, fc12), lowest scores first.
+    scores: BatchNorm1d name (relative to encoder) -> per-channel importance, see bn_scores / taylor_scores
+    """
+    assert encoder.block == 'bottleneck' and not encoder.se, 'only the plain Bottleneck encoder can be pruned'
+
+    pruned = copy.deepcopy(encoder)
+    in_idx = None   # kept channels of the residual stream entering the stage (None: all)
+
+    for name in ['layer1', 'layer2', 'layer3', 'layer4']:
+        layer = getattr(pruned, name)
+        if layer[0].downsample is None:
+            out_idx = in_idx  # identity shortcut: the stage keeps the incoming channels
+        else:
+            stream = [scores['{}.{}.bn3'.format(name, i)] for i in range(len(layer))]
+            out_idx = _keep(sum(stream) + scores['{}.0.downsample.1'.format(name)], ratio)
+
+        for i, block in enumerate(layer):
+            prefix = '{}.{}.'.format(name, i)
+            block_in = in_idx if i == 0 else out_idx
+            mid1 = _keep(scores[prefix + 'bn1'], ratio)
+            mid2 = _keep(scores[prefix + 'bn2'], ratio)
+
+            block.conv1, block.bn1 = _slice_conv(block.conv1, mid1, block_in), _slice_bn(block.bn1, mid1)
+            block.conv2, block.bn2 = _slice_conv(block.conv2, mid2, mid1), _slice_bn(block.bn2, mid2)
+            block.conv3 = _slice_conv(block.conv3, out_idx, mid2)
+            block.bn3 = block.bn3 if out_idx is None else _slice_bn(block.bn3, out_idx)
+            if block.downsample is not None:
+                block.downsample[0] = _slice_conv(block.downsample[0], out_idx, block_in)
+                block.downsample[1] = _slice_bn(block.downsample[1], out_idx)
+
+        in_idx = out_idx
+
+    if in_idx is not None:
+        n_channels = encoder.layer4[-1].conv3.out_channels
+        pruned.fc11[0] = _slice_fc(pruned.fc11[0], in_idx, n_channels)
+        pruned.fc12[0] = _slice_fc(pruned.fc12[0], in_idx, n_channels)
+    return pruned.train(encoder.training)
+
+
+def prune_feature_net(feature_net, ratio, scores):
+    """
+    Prune qzd and qzy of a VAE in place; scores are keyed by the BatchNorm1d names of feature_net
+    """
+    assert not getattr(feature_net, 'shared_trunk', False), 'encoders with a shared trunk cannot be pruned separately'
+    for name in ['qzd', 'qzy']:
+        prefix = name + '.'
+        encoder_scores = {k[len(prefix):]: v for k, v in scores.items() if k.startswith(prefix)}
+        setattr(feature_net, name, prune_encoder(getattr(feature_net, name), ratio, encoder_scores))
+    return feature_net
+
+
+##################### Loading pruned checkpoints
+def resize_to_state_dict(module, state_dict):
+    """
+    Replace every Conv1d / BatchNorm1d / Linear of module whose shape differs from state_dict
+    with an empty one of the stored shape, so that a pruned checkpoint can be loaded
+    """
+    for name, m in list(module.named_modules()):
+        key = name + '.weight'
+        if key not in state_dict or state_dict[key].shape == m.weight.shape:
+            continue
+
+        shape = state_dict[key].shape
+        if isinstance(m, nn.Conv1d):
+            new = nn.Conv1d(shape[1], shape[0], m.kernel_size, m.stride, m.padding, bias=m.bias is not None)
+        elif isinstance(m, nn.BatchNorm1d):
+            new = nn.BatchNorm1d(shape[0], m.eps, m.momentum)
+        elif isinstance(m, nn.Linear):
+            new = nn.Linear(shape[1], shape[0], bias=m.bias is not None)
+        else:
+            continue
+
+        parent, _, child = name.rpartition('.')
+        setattr(module.get_submodule(parent), child, new.to(m.weight.device))
+    return module
@@ -0,0 +1,226 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+##################### Viterbi
+def viterbi_decode(emissions, trans, start, end):
+    """
+    NumPy Viterbi, same scores as TorchCRF.CRF.viterbi_decode.
+    emissions: (batch_size, len, n_classes), returns: (batch_size, len)
+    """
+    score = start + emissions[:, 0]
+    history = []
+    for t in range(1, emissions.shape[1]):
+        step = score[:, :, None] + trans                   # (batch_size, prev, next)
+        idx = step.argmax(1)
+        score = np.take_along_axis(step, idx[:, None], 1)[:, 0] + emissions[:, t]
+        history.append(idx)
+
+    best = (score + end).argmax(1)
+    path = [best]
+    for idx in reversed(history):
+        best = np.take_along_axis(idx, best[:, None], 1)[:, 0]
+        path.insert(0, best)
+    return np.stack(path, axis=1)
+
+
+##################### ONNX Runtime scorer
+class OnnxScorer:
+    """
+    Scores a model written by model.inference.export_onnx_model with onnxruntime; Viterbi in NumPy.
+    Same interface as InferenceNet: forward (emissions), predict (stages), predict_aux.
+    """
+    def __init__(self, path, providers=('CPUExecutionProvider',)):
+        import onnxruntime
+
+        path = Path(path)
+        with (path / 'config.json').open('rt') as handle:
+            self.config = json.load(handle)
+        self.seq_len = self.config['seq_len']
+        self.is_CFR = self.config['is_CFR']
+
+        self.session = onnxruntime.InferenceSession(str(path / 'model.onnx'), providers=list(providers))
+        self.output_names = [o.name for o in self.session.get_outputs()]
+        if self.is_CFR:
+            crf = np.load(path / 'crf.npz')
+            self.trans, self.start, self.end = crf['trans'], crf['start'], crf['end']
+
+    def run(self, x):
+        outputs = self.session.run(None, {'x': np.asarray(x, dtype=np.float32)})
+        return dict(zip(self.output_names, outputs))
+
+    def __call__(self, x):
+        return self.forward(x)
+
+    def forward(self, x):
+        return self.run(x)['emissions']  # (batch_size, len, n_classes)
+
+    def predict(self, x):
+        emissions = self.forward(x)
+        if self.is_CFR:
+            return viterbi_decode(emissions, self.trans, self.start, self.end)
+        return emissions.argmax(2)
+
+    def predict_aux(self, x):
+        if 'aux' not in self.output_names:
+            raise ValueError('model was exported without the aux head (aux_head=False)')
+        return self.run(x)['aux'].argmax(2)
+
+
+##################### NumPy engine
+def conv1d(x, weight, bias, stride=1, groups=1):
+    """
+    x: (batch_size, in_channels, length), weight: (out_channels, in_channels // groups, kernel_size);
+    padding kernel_size//2
+    """
+    out_channels, in_channels, kernel_size = weight.shape
+    if groups > 1:
+        batch_size = x.shape[0]
+        pad = kernel_size // 2
+        x = np.pad(x, ((0, 0), (0, 0), (pad, pad)))
+        cols = np.lib.stride_tricks.sliding_window_view(x, kernel_size, axis=2)[:, :, ::stride]
+        cols = cols.reshape(batch_size, groups, in_channels, -1, kernel_size)               # (batch_size, g, in/g, out_len, k)
+        weight = weight.reshape(groups, out_channels // groups, in_channels, kernel_size)
+        out = np.einsum('bgilk,goik->bgol', cols, weight, optimize=True).reshape(batch_size, out_channels, -1)
+    elif kernel_size == 1:
+        out = np.matmul(weight[:, :, 0], x[:, :, ::stride])
+    else:
+        pad = kernel_size // 2
+        x = np.pad(x, ((0, 0), (0, 0), (pad, pad)))
+        cols = np.lib.stride_tricks.sliding_window_view(x, kernel_size, axis=2)[:, :, ::stride]  # (batch_size, in, out_len, k)
+        cols = cols.transpose(0, 2, 1, 3).reshape(x.shape[0], -1, in_channels * kernel_size)   # im2col
+        out = np.matmul(cols, weight.reshape(out_channels, -1).T).transpose(0, 2, 1)
+    return out + bias[:, None]
+
+
+def max_pool1d(x, kernel_size=3, stride=2, padding=1):
+    x = np.pad(x, ((0, 0), (0, 0), (padding, padding)), constant_values=-np.inf)
+    return np.lib.stride_tricks.sliding_window_view(x, kernel_size, axis=2)[:, :, ::stride].max(-1)
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def sigmoid(x):
+    return np.exp(-np.logaddexp(0, -x))  # no overflow for large negative x
+
+
+def channel_shuffle(x, groups):
+    batch_size, channels, length = x.shape
+    return x.reshape(batch_size, groups, channels // groups, length).transpose(0, 2, 1, 3).reshape(batch_size, channels, length)
+
+
+def layer_norm(x, weight, bias, eps=1e-5):
+    mean = x.mean(-1, keepdims=True)
+    var = x.var(-1, keepdims=True)
+    return (x - mean) / np.sqrt(var + eps) * weight + bias
+
+
+def softmax(x, axis=-1):
+    x = np.exp(x - x.max(axis, keepdims=True))
+    return x / x.sum(axis, keepdims=True)
+
+
+class NumpyScorer:
+    """
+    Dependency-free (NumPy only) forward of the exported inference path: Encoder_ResNet with
+    BatchNorm-folded Bottleneck / LightBottleneck blocks (grouped, depthwise, squeeze-excitation),
+    fc11, the Transformer encoder layers, fc and Viterbi.
+    Loads <path>/model.npz written by model.inference.export_numpy_model.
+    Same interface as InferenceNet: forward (emissions), predict (stages), predict_aux.
+    """
+    layers = [3, 4, 6, 3]
+    strides = [1, 2, 2, 2]
+
+    def __init__(self, path):
+        path = Path(path)
+        with (path / 'config.json').open('rt') as handle:
+            self.config = json.load(handle)
+        self.seq_len = self.config['seq_len']
+        self.is_CFR = self.config['is_CFR']
+        self.n_heads = self.config.get('n_heads', 8)  # attention heads, 8 in exports that predate the key
+
+        with np.load(path / 'model.npz') as weights:
+            self.w = {k: weights[k] for k in weights.files}
+
+    def __call__(self, x):
+        return self.forward(x)
+
+    def _conv(self, x, name, stride=1):
+        # the group count of a grouped / depthwise conv follows from its weight shape
+        weight = self.w[name + '.weight']
+        return conv1d(x, weight, self.w[name + '.bias'], stride, x.shape[1] // weight.shape[1])
+
+    def _bottleneck(self, x, prefix, stride):
+        w = self.w
+        out = relu(self._conv(x, prefix + 'conv1'))
+        groups = x.shape[1] // w[prefix + 'conv1.weight'].shape[1]
+        if groups > 1:
+            out = channel_shuffle(out, groups)
+        out = relu(self._conv(out, prefix + 'conv2', stride))
+        out = self._conv(out, prefix + 'conv3')
+        if prefix + 'se.fc1.weight' in w:
+            scale = relu(self._conv(out.mean(-1, keepdims=True), prefix + 'se.fc1'))
+            out = out * sigmoid(self._conv(scale, prefix + 'se.fc2'))
+
+        if prefix + 'downsample.weight' in w:
+            x = self._conv(x, prefix + 'downsample', stride)
+        return relu(out + x)
+
+    def _encoder_layer(self, x, prefix):
+        w = self.w
+        batch_size, seq_len, hidden_dim = x.shape
+        head_dim = hidden_dim // self.n_heads
+
+        qkv = x @ w[prefix + 'self_attn.in_proj_weight'].T + w[prefix + 'self_attn.in_proj_bias']
+        qkv = qkv.reshape(batch_size, seq_len, 3, self.n_heads, head_dim).transpose(2, 0, 3, 1, 4)   # (3, batch, head, len, head_dim)
+        attn = softmax(qkv[0] @ qkv[1].transpose(0, 1, 3, 2) / np.sqrt(head_dim))
+        h = (attn @ qkv[2]).transpose(0, 2, 1, 3).reshape(batch_size, seq_len, hidden_dim)
+        h = h @ w[prefix + 'self_attn.out_proj.weight'].T + w[prefix + 'self_attn.out_proj.bias']
+        x = layer_norm(x + h, w[prefix + 'norm1.weight'], w[prefix + 'norm1.bias'])
+
+        h = relu(x @ w[prefix + 'linear1.weight'].T + w[prefix + 'linear1.bias'])
+        h = h @ w[prefix + 'linear2.weight'].T + w[prefix + 'linear2.bias']
+        return layer_norm(x + h, w[prefix + 'norm2.weight'], w[prefix + 'norm2.bias'])
+
+    def encode(self, x):
+        w = self.w
+        x = np.asarray(x, dtype=np.float32)
+        batch_size = x.shape[0]
+        x = x.reshape(batch_size * self.seq_len, 1, -1)
+
+        x = relu(max_pool1d(conv1d(x, w['qzy.initial_layer.0.weight'], w['qzy.initial_layer.0.bias'], stride=2)))
+        for i, (blocks, stride) in enumerate(zip(self.layers, self.strides)):
+            if i == 2:
+                x = max_pool1d(x)
+            for j in range(blocks):
+                x = self._bottleneck(x, 'qzy.layer{}.{}.'.format(i + 1, j), stride if j == 0 else 1)
+
+        x = x.reshape(x.shape[0], -1) @ w['qzy.fc11.0.weight'].T + w['qzy.fc11.0.bias']
+        return x.reshape(batch_size, self.seq_len, -1)  # (batch_size, len, n_feat)
+
+    def classify(self, features):
+        x = features
+        for i in range(self.config['n_layers']):
+            x = self._encoder_layer(x, 'classifier.transformer_encoder.layers.{}.'.format(i))
+        return x @ self.w['classifier.fc.weight'].T + self.w['classifier.fc.bias']
+
+    def forward(self, x):
+        return self.classify(self.encode(x))  # (batch_size, len, n_classes)
+
+    def predict(self, x):
+        emissions = self.forward(x)
+        if self.is_CFR:
+            w = self.w
+            return viterbi_decode(emissions, w['classifier.crf.trans_matrix'],
+                                  w['classifier.crf.start_trans'], w['classifier.crf.end_trans'])
+        return emissions.argmax(2)
+
+    def predict_aux(self, x):
+        if 'qy.fc.weight' not in self.w:
+            raise ValueError('model was exported without the aux head (aux_head=False)')
+        features = relu(self.encode(x))
+        return (features @ self.w['qy.fc.weight'].T + self.w['qy.fc.bias']).argmax(2)
@@ -0,0 +1,138 @@
+import time
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from torch.utils.flop_counter import FlopCounterMode
+
+from model.dream import aux_layer
+
+
+##################### Student encoder
+class StudentEncoder(nn.Module):
+    """
+    Small plain CNN with the Encoder_ResNet interface: each stage is a strided
+    conv-BN-ReLU followed by a max-pool, then a linear layer to out_dim
+    """
+    def __init__(self, out_dim, sampling_rate, channels=[16, 32, 64, 128], kernel_size=7):
+        super(StudentEncoder, self).__init__()
+        self.sampling_rate = sampling_rate
+
+        layers, in_planes = [], 1
+        for planes in channels:
+            layers += [nn.Conv1d(in_planes, planes, kernel_size, 2, kernel_size//2, bias=False),
+                       nn.BatchNorm1d(planes),
+                       nn.ReLU(),
+                       nn.MaxPool1d(2, 2)]
+            in_planes = planes
+        self.features = nn.Sequential(*layers)
+
+        x = torch.rand((2, 1, sampling_rate*30))
+        x = self.features(x).view(2, -1)
+        self.fc11 = nn.Sequential(nn.Linear(x.shape[1], out_dim))
+
+        for m in self.modules():
+            if isinstance(m, nn.Conv1d):
+                nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+            elif isinstance(m, nn.BatchNorm1d):
+                nn.init.constant_(m.weight, 1)
+                nn.init.constant_(m.bias, 0)
+
+        torch.nn.init.xavier_uniform_(self.fc11[0].weight)
+        self.fc11[0].bias.data.zero_()
+
+    def forward(self, x):
+        batch_size = x.shape[0]
+        x = self.features(x).view(batch_size, -1)
+        return self.fc11(x), None   # (batch_size, out_dim); no scale, the student is deterministic
+
+
+##################### Student feature net
+class StudentNet(nn.Module):
+    """
+    Feature net distilled from a trained fold: a StudentEncoder in place of qzy and a qy aux head.
+    Trained to match the teacher's qzy embeddings and Transformer emissions (see DistillTrainer).
+    """
+    def __init__(self, zy_dim, config, d_type):
+        super(StudentNet, self).__init__()
+        SEED = 1111
+        torch.manual_seed(SEED)
+
+        self.zy_dim = zy_dim
+        self.y_dim = config['hyper_params']['num_classes']
+        self.seq_len = config['hyper_params']['seq_len']
+
+        if d_type == 'edf':
+            self.sampling_rate = 100
+        elif d_type == 'shhs':
+            self.sampling_rate = 125
+
+        params = config['distill']
+        self.qzy = StudentEncoder(self.zy_dim, self.sampling_rate, params['channels'], params['kernel_size'])
+        self.qy = aux_layer(self.zy_dim, self.y_dim)
+
+        self.temperature = params['temperature']
+        self.feature_weight = params['feature_weight']
+        self.emission_weight = params['emission_weight']
+        self.aux_weight = params['aux_weight']
+
+    def get_features(self, x):
+        batch_size = x.size(0)
+        features, _ = self.qzy(x.reshape(batch_size*self.seq_len, 1, -1))
+        return features.view(batch_size, self.seq_len, -1)   # (batch_size, len, n_feat)
+
+    def get_losses(self, x, y, teacher_features, teacher_emissions, classifier, return_logits=False):
+        """
+        MSE to the teacher's qzy embeddings, temperature-scaled KL between the emissions the
+        (frozen) teacher classifier gives for student and teacher features, and aux CE on y;
+        return_logits: also return the (detached) qy logits (batch_size, len, n_class)
+        """
+        features = self.get_features(x).float()  # losses in float32 under bfloat16 autocast
+        emissions = classifier(features).float()
+        T = self.temperature
+
+        loss_f = F.mse_loss(features, teacher_features)
+        loss_e = F.kl_div(F.log_softmax(emissions / T, dim=-1), F.softmax(teacher_emissions / T, dim=-1),
+                          reduction='sum') * T * T / (x.size(0) * self.seq_len)
+        logits = self.qy(features)
+        loss_y = F.cross_entropy(logits.reshape(-1, self.y_dim), y.reshape(-1))
+
+        loss = self.feature_weight * loss_f + self.emission_weight * loss_e + self.aux_weight * loss_y
+        if return_logits:
+            return loss, logits.detach()
+        return loss
+
+    def predict(self, x):
+        # same output as VAE.predict: one-hot aux predictions (batch_size, n_class, len)
+        with torch.no_grad():
+            out = F.one_hot(self.qy(self.get_features(x)).argmax(-1), self.y_dim).float()
+        return out.permute(0, 2, 1)
+
+
+##################### Cost report
+def encoder_cost(encoder, sampling_rate, device, batch_size=64, n_runs=10):
+    """
+    Parameters, forward FLOPs per 30-s epoch and latency (ms/epoch) of an encoder on device
+    """
+    training = encoder.training
+    encoder.eval()
+    x = torch.randn(batch_size, 1, sampling_rate*30, device=device)
+
+    with torch.no_grad():
+        with FlopCounterMode(display=False) as counter:
+            encoder(x)
+        encoder(x)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(n_runs):
+            encoder(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / n_runs
+
+    encoder.train(training)
+    return {'params': sum(p.numel() for p in encoder.parameters()),
+            'flops': counter.get_total_flops() / batch_size,
+            'ms/epoch': 1000 * elapsed / batch_size}
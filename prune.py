@@ -0,0 +1,107 @@
+import argparse
+import copy
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+import model.loss as module_loss
+import model.metric as module_metric
+from parse_config import ConfigParser
+from trainer.trainer import Trainer
+from evaluate import load_fold_models, load_split
+from model.pruning import *
+from model.student import encoder_cost
+
+import torch
+
+
+def test_predictions(feature_net, classifier, data_loader, device):
+    outs, trgs = [], []
+    with torch.no_grad():
+        for x, y, _ in data_loader:
+            output = classifier.predict(feature_net.get_features(x.to(device)))
+            outs.append(np.array(output).reshape(-1))
+            trgs.append(y.numpy().reshape(-1))
+    return np.concatenate(outs), np.concatenate(trgs)
+
+
+def main(args, fold_id):
+    d_type = 'shhs' if 'shhs' in args.np_data_dir else 'edf'
+    device = torch.device(args.device)
+    feature_net, classifier, config = load_fold_models(args.checkpoint_dir, d_type, device)
+    config['trainer']['epochs'] = args.epochs
+    loaders = {phase: load_split(config, args.np_data_dir, fold_id, d_type, phase) for phase in ['train', 'valid', 'test']}
+
+    if args.criterion == 'taylor':
+        scores = taylor_scores(feature_net, loaders['train'], device, args.n_batches)
+    else:
+        scores = bn_scores(feature_net)
+
+    criterion = getattr(module_loss, config['loss'])
+    metrics = [getattr(module_metric, met) for met in config['metrics']]
+
+    rows = []
+    for ratio in [0.] + args.ratios:
+        row = {'ratio': ratio}
+        if ratio == 0.:
+            outs, trgs = test_predictions(feature_net, classifier, loaders['test'], device)
+            row.update(encoder_cost(copy.deepcopy(feature_net.qzy).cpu(), feature_net.sampling_rate, torch.device('cpu')))
+        else:
+            pruned = prune_feature_net(copy.deepcopy(feature_net), ratio, scores)
+            row.update(encoder_cost(copy.deepcopy(pruned.qzy).cpu(), feature_net.sampling_rate, torch.device('cpu')))
+
+            # fine-tune the pruned feature net and the classifier with the regular two-stage trainer
+            run_id = 'prune{:.2f}_'.format(ratio) + datetime.now().strftime('%d_%m_%Y_%H_%M_%S')
+            run_config = ConfigParser(copy.deepcopy(config), fold_id, run_id=run_id)
+            fine_tuned = copy.deepcopy(classifier)
+            trainer = Trainer(pruned, fine_tuned,
+                              run_config.init_obj('optimizer', torch.optim, pruned.parameters()),
+                              run_config.init_obj('optimizer', torch.optim, fine_tuned.parameters()),
+                              criterion, metrics,
+                              config=run_config,
+                              data_loader=loaders['train'],
+                              fold_id=fold_id,
+                              valid_loader=loaders['valid'],
+                              test_loader=loaders['test'])
+            trainer.training_feature_net()
+
+            outs = np.load(run_config.save_dir / 'test_outs_{}.npy'.format(fold_id))
+            trgs = np.load(run_config.save_dir / 'test_trgs_{}.npy'.format(fold_id))
+            row['checkpoint_dir'] = str(run_config.save_dir)
+
+        row['accuracy'] = module_metric.accuracy(outs, trgs)
+        row['f1'] = module_metric.f1(outs, trgs)
+        rows.append(row)
+
+    result = pd.DataFrame(rows)
+    result['speedup'] = result['ms/epoch'][0] / result['ms/epoch']
+    result['d_accuracy'] = result['accuracy'] - result['accuracy'][0]
+    result['d_f1'] = result['f1'] - result['f1'][0]
+    result = result[[col for col in result.columns if col != 'checkpoint_dir'] + ['checkpoint_dir']]
+
+    print(result.to_string(index=False))
+    result.to_csv(Path(args.checkpoint_dir) / 'prune_{}_{}.csv'.format(args.criterion, fold_id), index=False)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Structured channel pruning of the feature net encoders of a trained fold')
+    args.add_argument('-r', '--checkpoint_dir', type=str,
+                      help='fold directory containing featurenet_best.pth and classifier_best.pth')
+    args.add_argument('-f', '--fold_id', type=str,
+                      help='fold_id')
+    args.add_argument('-da', '--np_data_dir', type=str,
+                      help='Directory containing numpy files')
+    args.add_argument('-p', '--ratios', default=[0.25, 0.5, 0.75], type=float, nargs='+',
+                      help='fractions of channels removed per layer (default: 0.25 0.5 0.75)')
+    args.add_argument('-s', '--criterion', default='bn', type=str, choices=['bn', 'taylor'],
+                      help='channel importance: BN |gamma| or first-order Taylor (default: bn)')
+    args.add_argument('--n_batches', default=16, type=int,
+                      help='training batches for the Taylor criterion (default: 16)')
+    args.add_argument('-e', '--epochs', default=10, type=int,
+                      help='fine-tuning epochs per stage (default: 10)')
+    args.add_argument('-d', '--device', default='cpu', type=str,
+                      help='torch device for scoring (default: cpu)')
+
+    args = args.parse_args()
+    main(args, int(args.fold_id))
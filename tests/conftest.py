@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the repository root holds the model / trainer / utils packages
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
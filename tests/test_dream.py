@@ -0,0 +1,307 @@
+import copy
+import itertools
+
+import pytest
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from model.dream import FeatureQueue, MomentumEncoder, SupervisedContrastiveLoss, DomainHead, aux_layer, p_decoder, Decoder_ResNet, \
+    Encoder_ResNet, checkpoint_module, VAE, Transformer, crf_marginals, predictive_uncertainty
+
+
+def test_feature_queue_keeps_the_last_entries():
+    queue = FeatureQueue(5, 3)
+    assert queue.get() is None
+
+    features, labels = torch.randn(7, 3), torch.arange(7)
+    queue.push(features[:3], labels[:3])
+    stored, stored_labels = queue.get()
+    torch.testing.assert_close(stored, F.normalize(features[:3], dim=-1))
+    assert stored_labels.tolist() == [0, 1, 2]
+
+    # wraps around: the 5 most recent entries are kept, the oldest are overwritten in place
+    queue.push(features[3:], labels[3:])
+    stored, stored_labels = queue.get()
+    assert sorted(stored_labels.tolist()) == [2, 3, 4, 5, 6]
+    torch.testing.assert_close(stored, F.normalize(features[stored_labels], dim=-1))
+
+
+def test_feature_queue_get_is_a_copy():
+    queue = FeatureQueue(4, 2)
+    queue.push(torch.randn(4, 2), torch.zeros(4, dtype=torch.long))
+    stored, _ = queue.get()
+    queue.push(torch.randn(4, 2), torch.ones(4, dtype=torch.long))
+    assert not torch.equal(stored, queue.get()[0])
+
+
+def test_feature_queue_is_not_saved():
+    assert FeatureQueue(4, 2).state_dict() == {}
+
+
+def reference_supervised_contrastive(features, labels, queue=None, tau=0.07):
+    # per-pair NT-Xent: -log(exp(s_ap) / (exp(s_ap) + sum_n exp(s_an))) averaged over the positive pairs (a, p)
+    z = F.normalize(features, dim=-1)
+    keys, key_labels = z, labels
+    if queue is not None:
+        keys, key_labels = torch.cat([z, queue[0]]), torch.cat([labels, queue[1]])
+    sim = z @ keys.t() / tau
+    terms = []
+    for a in range(len(z)):
+        negatives = sim[a][key_labels != labels[a]]
+        for p in range(len(keys)):
+            if p != a and key_labels[p] == labels[a]:
+                terms.append(-sim[a, p] + torch.logsumexp(torch.cat([sim[a, p:p + 1], negatives]), 0))
+    return torch.stack(terms).mean()
+
+
+@pytest.fixture
+def labelled_batch():
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(3, 10, 16, generator=generator), torch.randint(4, (3, 10), generator=generator)
+
+
+def test_supervised_contrastive_matches_ntxent(labelled_batch):
+    features, labels = labelled_batch
+    features = features.requires_grad_()
+    loss = SupervisedContrastiveLoss()(features, labels)
+    assert loss.shape == (3,)
+    grad, = torch.autograd.grad(loss.sum(), features)
+
+    baseline = pytest.importorskip('pytorch_metric_learning.losses').NTXentLoss(temperature=0.07)
+    reference = torch.stack([baseline(F.normalize(f, dim=-1), y) for f, y in zip(features, labels)])
+    reference_grad, = torch.autograd.grad(reference.sum(), features)
+    torch.testing.assert_close(loss, reference)
+    torch.testing.assert_close(grad, reference_grad)
+
+    torch.testing.assert_close(loss[0], reference_supervised_contrastive(features[0], labels[0]))
+
+
+def test_supervised_contrastive_with_queue(labelled_batch):
+    features, labels = labelled_batch
+    features = features.requires_grad_()
+    queue = FeatureQueue(12, 16)
+    queue.push(torch.randn(12, 16, generator=torch.Generator().manual_seed(1)), torch.arange(12) % 4)
+
+    loss = SupervisedContrastiveLoss()(features, labels, queue.get())
+    grad, = torch.autograd.grad(loss.sum(), features)
+    reference = torch.stack([reference_supervised_contrastive(f, y, queue.get()) for f, y in zip(features, labels)])
+    reference_grad, = torch.autograd.grad(reference.sum(), features)
+    torch.testing.assert_close(loss, reference)
+    torch.testing.assert_close(grad, reference_grad)
+
+
+@pytest.fixture
+def domain_batch():
+    generator = torch.Generator().manual_seed(2)
+    return torch.randn(32, 16, generator=generator), torch.randint(50, (32,), generator=generator)
+
+
+def test_full_domain_head_matches_aux_layer(domain_batch):
+    x, d = domain_batch
+    head = DomainHead(16, 50)
+    layer = aux_layer(16, 50)
+    layer.load_state_dict(head.state_dict())
+    torch.testing.assert_close(head.loss(x, d), F.cross_entropy(layer(x), d, reduction='sum'))
+
+
+def test_sampled_domain_head(domain_batch):
+    x, d = domain_batch
+    head = DomainHead(16, 50, head='sampled', n_samples=8)
+    torch.manual_seed(0)
+    loss = head.loss(x, d)
+    assert loss.shape == () and torch.isfinite(loss)
+    # a softmax over a subset of the domains that holds the targets: never above the full loss
+    full = F.cross_entropy(head(x), d, reduction='sum')
+    assert loss <= full
+
+    # every domain drawn: the full loss, as in eval mode
+    every = DomainHead(16, 50, head='sampled', n_samples=5000)
+    every.load_state_dict(head.state_dict())
+    torch.testing.assert_close(every.loss(x, d), full)
+    torch.testing.assert_close(head.eval().loss(x, d), full)
+
+
+def test_hashed_domain_head_buckets(domain_batch):
+    x, d = domain_batch
+    head = DomainHead(16, 5000, head='hashed', n_buckets=16)
+    assert head.fc.out_features == 16
+    loss = head.loss(x, d)
+    torch.testing.assert_close(head.loss(x, d), loss)
+    torch.testing.assert_close(head.loss(x, d + 16 * 7), loss)   # same buckets
+    torch.testing.assert_close(loss, F.cross_entropy(head(x), d % 16, reduction='sum'))
+    assert DomainHead(16, 10, head='hashed', n_buckets=16).fc.out_features == 10
+
+
+def test_embedding_prior_matches_one_hot():
+    d = torch.tensor([0, 3, 1, 3, 2, 0])
+    one_hot = p_decoder(4, 8)
+    embedding = p_decoder(4, 8, embedding=True)
+    state = one_hot.state_dict()
+    state['fc1.0.weight'] = state['fc1.0.weight'].t()
+    embedding.load_state_dict(state)
+    for out, ref in zip(embedding(d), one_hot(F.one_hot(d, 4).float())):
+        torch.testing.assert_close(out, ref)
+
+
+@pytest.mark.parametrize('sampling_rate', [100, 125])
+@pytest.mark.parametrize('decoder', ['dense', 'lowrank', 'conv'])
+@pytest.mark.parametrize('downsample', [1, 2, 4, 8])
+def test_decoder_reconstruction_shape(sampling_rate, decoder, downsample):
+    px = Decoder_ResNet(8, 16, sampling_rate, decoder=decoder, rank=32, downsample=downsample)
+    x_recon = px(zy=torch.randn(4, 16), zd=torch.randn(4, 8))
+    assert x_recon.shape == (4, 1, sampling_rate * 30 // downsample)
+    assert ((x_recon >= 0) & (x_recon <= 1)).all()
+
+
+def loss_and_grads(module, function, seed=0):
+    torch.manual_seed(seed)   # same dropout masks
+    loss = function()
+    grads = torch.autograd.grad(loss, list(module.parameters()))
+    return loss.detach(), grads
+
+
+def assert_same_bn_stats(module, reference):
+    for (name, buffer), ref in zip(module.named_buffers(), reference.buffers()):
+        assert torch.equal(buffer, ref), name
+
+
+def test_checkpointed_encoder_matches_plain():
+    torch.manual_seed(0)
+    encoder = Encoder_ResNet(16, 100).train()
+    checkpointed = Encoder_ResNet(16, 100, checkpoint_layers=['layer1', 'layer3']).train()
+    checkpointed.load_state_dict(encoder.state_dict())
+    n_batches = encoder.layer1[0].bn1.num_batches_tracked.item()
+    x = torch.randn(4, 1, 3000, generator=torch.Generator().manual_seed(1))
+
+    loss, grads = loss_and_grads(encoder, lambda: sum(out.square().sum() for out in encoder(x)))
+    ref_loss, ref_grads = loss_and_grads(checkpointed, lambda: sum(out.square().sum() for out in checkpointed(x)))
+    torch.testing.assert_close(loss, ref_loss)
+    for grad, ref in zip(grads, ref_grads):
+        torch.testing.assert_close(grad, ref)
+    # the recomputation in backward leaves running_mean / running_var / num_batches_tracked as one forward does
+    assert_same_bn_stats(checkpointed, encoder)
+    assert checkpointed.layer1[0].bn1.num_batches_tracked == n_batches + 1
+
+
+def test_checkpointed_decoder_matches_plain():
+    torch.manual_seed(0)
+    px = Decoder_ResNet(8, 16, 100).train()
+    reference = copy.deepcopy(px)
+    zy, zd = torch.randn(4, 16), torch.randn(4, 8)
+
+    loss, grads = loss_and_grads(px, lambda: checkpoint_module(px, px, zy, zd).sum())
+    ref_loss, ref_grads = loss_and_grads(reference, lambda: reference(zy, zd).sum())
+    torch.testing.assert_close(loss, ref_loss)
+    for grad, ref in zip(grads, ref_grads):
+        torch.testing.assert_close(grad, ref)
+    assert_same_bn_stats(px, reference)
+
+
+def vae_config(**hyper_params):
+    return {'hyper_params': dict({'num_classes': 5, 'seq_len': 3, 'aux_loss_y': 1., 'aux_loss_d': 1., 'beta_d': 1.,
+                                  'beta_y': 1., 'const_weight': 1.}, **hyper_params)}
+
+
+@pytest.fixture(scope='module')
+def sequences():
+    generator = torch.Generator().manual_seed(3)
+    return (torch.randn(4, 3, 3000, 1, generator=generator), torch.randint(5, (4, 3), generator=generator),
+            torch.randint(2, (4,), generator=generator))
+
+
+def test_get_losses_logits_match_predict(sequences):
+    x, y, d = sequences
+    model = VAE(8, 16, 2, vae_config(), 'edf').eval()
+    with torch.no_grad():
+        model.qy.fc.weight.mul_(20)   # away from ties
+    torch.manual_seed(0)
+    loss, logits = model.get_losses(x, y, d, return_logits=True)
+    assert logits.shape == (4, 3, 5) and not logits.requires_grad
+    torch.manual_seed(0)   # same latent samples
+    torch.testing.assert_close(loss, model.get_losses(x, y, d))
+
+    predictions = F.one_hot(logits.argmax(-1), 5).float().permute(0, 2, 1)
+    assert torch.equal(predictions, model.predict(x))
+
+
+def classifier_config(is_CFR=True):
+    return {'data_loader': {'args': {'batch_size': 4}}, 'hyper_params': {'dim_feedforward': 32, 'is_CFR': is_CFR}}
+
+
+def test_crf_marginals_match_path_enumeration():
+    generator = torch.Generator().manual_seed(4)
+    emissions, trans, start, end = (torch.randn(shape, generator=generator) for shape in [(2, 3, 4), (4, 4), (4,), (4,)])
+    marginals = crf_marginals(emissions, trans, start, end)
+    torch.testing.assert_close(marginals.sum(-1), torch.ones(2, 3))
+
+    # brute force: softmax over the scores of all 4**3 paths, summed per (position, class)
+    paths = torch.tensor(list(itertools.product(range(4), repeat=3)))
+    positions = torch.arange(3)
+    scores = torch.stack([start[paths[:, 0]] + emissions[b, positions, paths].sum(-1) + trans[paths[:, :-1], paths[:, 1:]].sum(-1)
+                          + end[paths[:, -1]] for b in range(2)])
+    reference = torch.einsum('bp,ptc->btc', F.softmax(scores, dim=-1), F.one_hot(paths, 4).float())
+    torch.testing.assert_close(marginals, reference)
+
+
+@pytest.mark.parametrize('is_CFR', [True, False])
+def test_classifier_marginals_sum_to_one(is_CFR):
+    classifier = Transformer(16, classifier_config(is_CFR), n_layer=1).eval()
+    with torch.no_grad():
+        marginals = classifier.marginals(torch.randn(4, 3, 16))
+    assert marginals.shape == (4, 3, 5) and (marginals >= 0).all()
+    torch.testing.assert_close(marginals.sum(-1), torch.ones(4, 3))
+
+
+def test_predictive_uncertainty_of_identical_samples():
+    probs = F.softmax(torch.randn(4, 3, 5), dim=-1)
+    out = predictive_uncertainty(probs.expand(10, -1, -1, -1))
+    torch.testing.assert_close(out['probs'], probs)
+    assert torch.equal(out['pred'], probs.argmax(-1))
+    torch.testing.assert_close(out['mutual_info'], torch.zeros(4, 3), atol=1e-5, rtol=0)
+
+
+def test_uncertainty_without_variance_is_the_deterministic_path(sequences):
+    # latents drawn from a zero-scale qzy are its means, i.e. what the mc_samples=0 test pass scores
+    x = sequences[0]
+    model = VAE(8, 16, 2, vae_config(), 'edf').eval()
+    classifier = Transformer(16, classifier_config(), n_layer=1).eval()
+    with torch.no_grad():
+        model.qzy.fc12[0].weight.zero_()
+        model.qzy.fc12[0].bias.fill_(-100.)
+        model.qy.fc.weight.mul_(20)
+
+    out = model.predict_uncertainty(x, 8, classifier)
+    with torch.no_grad():
+        features = model.get_features(x)
+        torch.testing.assert_close(out['classifier']['probs'], classifier.marginals(features), rtol=1e-4, atol=1e-4)
+    assert torch.equal(F.one_hot(out['aux']['pred'], 5).float().permute(0, 2, 1), model.predict(x))
+    for res in out.values():
+        torch.testing.assert_close(res['probs'].sum(-1), torch.ones(4, 3))
+        assert (res['mutual_info'].abs() < 1e-4).all()
+
+
+def test_momentum_encoder_is_not_saved(sequences):
+    x, y, d = sequences
+    model = VAE(8, 16, 2, vae_config(queue_size=16, queue_momentum=0.9), 'edf')
+    assert model.state_dict().keys() == VAE(8, 16, 2, vae_config(), 'edf').state_dict().keys()
+    model.get_losses(x, y, d)   # one update of the copy
+
+    # checkpoints that did save the copy still load; the copy restarts from the loaded qzy
+    state = dict(model.state_dict(), **{'key_encoder.encoder.' + k: v for k, v in model.qzy.state_dict().items()})
+    fresh = VAE(8, 16, 2, vae_config(queue_size=16, queue_momentum=0.9), 'edf')
+    with torch.no_grad():
+        fresh.qzy.fc11[0].weight.add_(1.)
+    fresh.load_state_dict(state)
+    fresh.key_encoder.update(fresh.qzy)
+    for key, query in zip(fresh.key_encoder.encoder[0].state_dict().values(), model.qzy.state_dict().values()):
+        torch.testing.assert_close(key, query)
+
+
+def test_momentum_encoder_follows_shape_changes():
+    encoder = Encoder_ResNet(16, 100)
+    key_encoder = MomentumEncoder(encoder, 0.5)
+    smaller = Encoder_ResNet(8, 100)
+    key_encoder.update(smaller)
+    assert key_encoder(torch.randn(2, 1, 3000)).shape == (2, 8)
+    assert not any(p.requires_grad for p in key_encoder.encoder[0].parameters())
@@ -0,0 +1,105 @@
+import pytest
+import torch
+from torch.nn import functional as F
+
+from model.dream_semi_sup import Transform, Self_SupervisedContrastiveLoss, VAE
+
+
+def is_segment_permutation(row, pieces):
+    # row: arange(length) cut into pieces equal segments, shuffled, the remainder unchanged at the end
+    length = len(row) // pieces
+    segments = row[:pieces * length].view(pieces, length)
+    starts = segments[:, 0]
+    return (torch.equal(segments, starts[:, None] + torch.arange(length))
+            and torch.equal(starts.sort()[0], torch.arange(0, pieces * length, length).float())
+            and torch.equal(row[pieces * length:], torch.arange(pieces * length, len(row)).float()))
+
+
+def test_permute_shuffles_equal_segments():
+    torch.manual_seed(0)
+    transform = Transform(pieces=(5, 20))
+    signal = torch.arange(3000.).expand(2, 4, 1, -1)
+    out = transform.permute(signal)
+    assert out.shape == signal.shape
+    assert not torch.equal(out, signal)
+
+    for row in out.reshape(-1, 3000):
+        assert any(is_segment_permutation(row, pieces) for pieces in range(5, 21))
+
+
+def test_crop_resize_takes_a_resized_window():
+    torch.manual_seed(0)
+    transform = Transform(sampling_rate=100, crop=(0.25, 0.75))
+    signal = torch.linspace(0, 1, 3000).expand(8, 1, -1)
+    out = transform.crop_resize(signal)
+    assert out.shape == (8, 1, 3000)
+
+    out = out.reshape(8, -1)
+    assert (out.diff(dim=1) >= -1e-6).all()   # a ramp stays a ramp
+    span = out[:, -1] - out[:, 0]
+    assert ((span > 0.25 - 1e-2) & (span < 0.75 + 1e-2)).all()
+
+    constant = torch.full((3, 3000), 2.)
+    torch.testing.assert_close(transform.crop_resize(constant), constant)
+
+
+def reference_self_supervised_contrastive(x, queue=None, temperature=0.1):
+    # the original two-view form: (ab | aa) and (ba | bb) logits, the positive at column i, the self-similarity masked
+    x = F.normalize(x, dim=-1)
+    num = x.shape[0] // 2
+    hidden1, hidden2 = torch.split(x, num)
+    labels = torch.arange(num)
+    masks = F.one_hot(labels, num) * 1e9
+
+    logits_aa = hidden1 @ hidden1.T / temperature - masks
+    logits_bb = hidden2 @ hidden2.T / temperature - masks
+    logits_ab = hidden1 @ hidden2.T / temperature
+    logits_ba = hidden2 @ hidden1.T / temperature
+    logits_a, logits_b = [logits_ab, logits_aa], [logits_ba, logits_bb]
+    if queue is not None:
+        logits_a.append(hidden1 @ queue[0].T / temperature)
+        logits_b.append(hidden2 @ queue[0].T / temperature)
+
+    return F.cross_entropy(torch.cat(logits_a, 1), labels) + F.cross_entropy(torch.cat(logits_b, 1), labels)
+
+
+@pytest.mark.parametrize('with_queue', [False, True])
+def test_self_supervised_contrastive_matches_two_view_form(with_queue):
+    generator = torch.Generator().manual_seed(0)
+    queue = (F.normalize(torch.randn(12, 16, generator=generator), dim=-1), torch.zeros(12)) if with_queue else None
+    criterion = Self_SupervisedContrastiveLoss()
+
+    # the batch size changes between calls: the cached mask and targets must follow it
+    for num in [5, 3, 5]:
+        x = torch.randn(4, 2*num, 16, generator=generator, requires_grad=True)
+        loss = criterion(x, queue)
+        assert loss.shape == (4,)
+        grad, = torch.autograd.grad(loss.sum(), x)
+
+        reference = torch.stack([reference_self_supervised_contrastive(views, queue) for views in x])
+        reference_grad, = torch.autograd.grad(reference.sum(), x)
+        torch.testing.assert_close(loss, reference)
+        torch.testing.assert_close(grad, reference_grad)
+    assert len(criterion.masks) == 2
+
+
+def vae_config(**hyper_params):
+    return {'hyper_params': dict({'num_classes': 5, 'seq_len': 2, 'aux_loss_y': 1., 'aux_loss_d': 1., 'beta_d': 1.,
+                                  'beta_y': 1., 'const_weight': 1., 'const_weight_ratio': 1.}, **hyper_params)}
+
+
+def test_get_losses_returns_labeled_logits():
+    model = VAE(8, 8, 3, vae_config(), 'edf')
+    generator = torch.Generator().manual_seed(0)
+    x, y, d = torch.randn(3, 2, 3000, 1, generator=generator), torch.randint(5, (2, 2), generator=generator), torch.tensor([0, 1, 2])
+
+    # mixed batch: the first two sequences are labeled
+    loss, logits = model.get_losses(x, y, d, return_logits=True)
+    assert logits.shape == (2, 2, 5) and not logits.requires_grad
+    assert torch.isfinite(loss)
+    assert model.get_losses(x, None, d, return_logits=True)[1] is None
+
+
+def test_momentum_encoders_are_not_saved():
+    model = VAE(8, 8, 3, vae_config(queue_size=16, queue_momentum=0.9), 'edf')
+    assert model.state_dict().keys() == VAE(8, 8, 3, vae_config(), 'edf').state_dict().keys()
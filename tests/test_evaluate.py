@@ -0,0 +1,55 @@
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+import model.metric as module_metric
+from evaluate import cascade_curve
+from model.dream import VAE, Transformer, cascade_predict
+
+
+@pytest.fixture(scope='module')
+def models():
+    config = {'data_loader': {'args': {'batch_size': 4}},
+              'hyper_params': {'num_classes': 5, 'seq_len': 3, 'aux_loss_y': 1., 'aux_loss_d': 1., 'beta_d': 1.,
+                               'beta_y': 1., 'const_weight': 1., 'dim_feedforward': 32, 'is_CFR': True}}
+    feature_net = VAE(8, 16, 2, config, 'edf').eval()
+    classifier = Transformer(16, config, n_layer=1).eval()
+    with torch.no_grad():
+        feature_net.qy.fc.weight.mul_(20)   # away from ties
+    return feature_net, classifier
+
+
+@pytest.fixture(scope='module')
+def data():
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(8, 3, 3000, 1, generator=generator), torch.randint(5, (8, 3), generator=generator)
+
+
+def aux_and_classifier_predictions(models, x):
+    feature_net, classifier = models
+    with torch.no_grad():
+        features, _ = feature_net.encode(x)
+        return feature_net.qy(features).argmax(-1), torch.as_tensor(classifier.predict(features))
+
+
+def test_cascade_predict_thresholds(models, data):
+    x, _ = data
+    aux, clf = aux_and_classifier_predictions(models, x)
+
+    pred, escalate = cascade_predict(*models, x, threshold=0.)
+    assert not escalate.any() and torch.equal(pred, aux)
+    pred, escalate = cascade_predict(*models, x, threshold=1.1)
+    assert escalate.all() and torch.equal(pred, clf)
+
+
+def test_cascade_curve_thresholds(models, data):
+    x, y = data
+    aux, clf = aux_and_classifier_predictions(models, x)
+    loader = DataLoader(TensorDataset(x, y, torch.zeros(len(x), dtype=torch.long)), batch_size=4)
+
+    curve = cascade_curve(*models, loader, [0., 1.1], torch.device('cpu'))
+    assert curve['escalated'].tolist() == [0., 1.]
+    assert curve['rel_compute'].iloc[1] == pytest.approx(1.)
+    for row, preds in zip(curve.itertuples(), [aux, clf]):
+        assert row.accuracy == module_metric.accuracy(preds.numpy().reshape(-1), y.numpy().reshape(-1))
+        assert row.f1 == module_metric.f1(preds.numpy().reshape(-1), y.numpy().reshape(-1))
@@ -0,0 +1,231 @@
+import copy
+import warnings
+
+import numpy as np
+import pytest
+import torch
+from TorchCRF import CRF
+
+from model.dream import SqueezeExcitation, crf_marginals
+from model.inference import InferenceNet, quantize_inference_model, export_inference_model, load_inference_model, mha_fastpath, \
+    viterbi_decode, script_inference_model, EnsembleNet, compile_inference_model, export_onnx_model, export_numpy_model
+from model.runtime import OnnxScorer, NumpyScorer, viterbi_decode as numpy_viterbi_decode
+
+
+def random_model(**config):
+    """
+    Randomly initialised InferenceNet in eval mode, with BatchNorm statistics and CRF transitions
+    drawn away from their identity / zero initialisation, and output layers scaled up and centred,
+    so that the decoded stages vary between windows
+    """
+    config = dict({'sampling_rate': 100, 'seq_len': 4, 'num_classes': 5, 'zy_dim': 64, 'dim_feedforward': 128,
+                   'n_layers': 2, 'n_heads': 8, 'is_CFR': True, 'aux_head': True}, **config)
+    torch.manual_seed(0)
+    generator = torch.Generator().manual_seed(0)
+    model = InferenceNet(config).eval()
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm1d):
+                module.running_mean.uniform_(-0.2, 0.2, generator=generator)
+                module.running_var.uniform_(0.5, 2., generator=generator)
+                module.weight.uniform_(0.5, 1.5, generator=generator)
+                module.bias.uniform_(-0.1, 0.1, generator=generator)
+        if config['is_CFR']:
+            crf = model.classifier.crf
+            for param in [crf.trans_matrix, crf.start_trans, crf.end_trans]:
+                param.copy_(torch.randn(param.shape, generator=generator))
+
+        x = torch.randn(16, config['seq_len'], config['sampling_rate']*30, generator=generator)
+        model.classifier.fc.weight.mul_(20)
+        model.classifier.fc.bias.sub_(model(x).mean((0, 1)))
+        if model.qy is not None:
+            model.qy.fc.weight.mul_(20)
+            model.qy.fc.bias.sub_(model.qy(model.encode(x)).mean((0, 1)))
+    return model
+
+
+@pytest.fixture(scope='module')
+def model():
+    return random_model()
+
+
+@pytest.fixture(scope='module')
+def x():
+    generator = torch.Generator().manual_seed(1)
+    return torch.randn(8, 4, 3000, 1, generator=generator) * 4 * torch.rand(8, 4, 1, 1, generator=generator)  # as the data loaders
+
+
+def assert_emissions_close(out, ref, rtol=1e-3):
+    out, ref = np.asarray(out), np.asarray(ref)
+    np.testing.assert_allclose(out, ref, rtol=rtol, atol=rtol * np.abs(ref).max())
+
+
+def test_fused_matches_eager(model, x):
+    fused = copy.deepcopy(model).fuse()
+    with torch.no_grad():
+        assert_emissions_close(fused(x), model(x))
+    assert fused.predict(x) == model.predict(x)
+    assert torch.equal(fused.predict_aux(x), model.predict_aux(x))
+
+
+@pytest.mark.parametrize('block, se', [('bottleneck', True), ('separable', False), ('grouped', True)])
+def test_fused_light_blocks_match_eager(x, block, se):
+    model = random_model(block=block, se=se)
+    fused = copy.deepcopy(model).fuse()
+    with torch.no_grad():
+        assert_emissions_close(fused(x), model(x))
+
+
+def relative_error(out, ref):
+    return (torch.linalg.norm(out - ref) / torch.linalg.norm(ref)).item()
+
+
+def test_quantized_encoder_close_to_float(model, x):
+    generator = torch.Generator().manual_seed(2)
+    calibration = [(torch.randn(x.shape, generator=generator) * 4 * torch.rand(*x.shape[:2], 1, 1, generator=generator), None, None)
+                   for _ in range(4)]
+    quantized = quantize_inference_model(model, calibration)
+    with torch.no_grad():
+        assert relative_error(quantized.encode(x), model.encode(x)) < 0.2
+
+
+def test_quantized_classifier_close_to_float(model, x):
+    # dynamic int8 Linear layers of the Transformer and qy, on the same float features
+    quantized = quantize_inference_model(model)
+    with torch.no_grad(), mha_fastpath(False):
+        features = model.encode(x)
+        assert relative_error(quantized.classifier(features), model.classifier(features)) < 0.15
+        assert relative_error(quantized.qy(features), model.qy(features)) < 0.05
+    assert torch.backends.mha.get_fastpath_enabled()
+
+
+def test_quantized_engine_is_restored(model, x):
+    engine = torch.backends.quantized.engine
+    quantized = quantize_inference_model(model, backend='qnnpack')
+    assert torch.backends.quantized.engine == engine
+    with torch.no_grad():
+        out = quantized(x)
+    assert torch.backends.quantized.engine == engine
+    assert out.shape == (x.size(0), 4, 5) and torch.isfinite(out).all()
+
+
+def test_quantized_export_round_trip(model, x, tmp_path):
+    quantized = quantize_inference_model(model)
+    export_inference_model(model, tmp_path)
+    export_inference_model(quantized, tmp_path)
+    loaded = load_inference_model(tmp_path, quantized=True)
+    with torch.no_grad():
+        assert torch.equal(loaded(x), quantized(x))
+    assert loaded.predict(x) == quantized.predict(x)
+
+
+def test_viterbi_matches_torchcrf():
+    generator = torch.Generator().manual_seed(3)
+    crf = CRF(5)
+    with torch.no_grad():
+        for param in [crf.trans_matrix, crf.start_trans, crf.end_trans]:
+            param.copy_(torch.randn(param.shape, generator=generator))
+    emissions = torch.randn(16, 10, 5, generator=generator)
+    mask = torch.ones(16, 10, dtype=torch.bool)
+
+    path = viterbi_decode(emissions, crf.trans_matrix, crf.start_trans, crf.end_trans)
+    assert path.tolist() == crf.viterbi_decode(emissions, mask)
+
+
+def test_scripted_matches_eager(model, x, tmp_path):
+    script_inference_model(model, tmp_path)
+    scripted = torch.jit.load(str(tmp_path / 'model_scripted.pt'))
+    with torch.no_grad():
+        assert scripted(x).tolist() == model.predict(x)
+
+
+def test_compiled_matches_eager(model, x):
+    compiled = compile_inference_model(model)
+    with torch.no_grad():
+        assert compiled(x).tolist() == model.predict(x)
+
+
+def test_onnx_matches_torch(model, x, tmp_path):
+    pytest.importorskip('onnxruntime')
+    export_onnx_model(model, tmp_path)
+    scorer = OnnxScorer(tmp_path)
+    with torch.no_grad():
+        assert_emissions_close(scorer(x.numpy()), model(x))
+    assert scorer.predict(x.numpy()).tolist() == model.predict(x)
+    np.testing.assert_array_equal(scorer.predict_aux(x.numpy()), model.predict_aux(x).numpy())
+
+
+def test_onnx_without_aux_head(x, tmp_path):
+    pytest.importorskip('onnxruntime')
+    export_onnx_model(random_model(aux_head=False), tmp_path)
+    with pytest.raises(ValueError):
+        OnnxScorer(tmp_path).predict_aux(x.numpy())
+
+
+def test_numpy_viterbi_matches_torch():
+    generator = torch.Generator().manual_seed(4)
+    emissions, trans, start, end = (torch.randn(shape, generator=generator) for shape in [(16, 10, 5), (5, 5), (5,), (5,)])
+    np.testing.assert_array_equal(numpy_viterbi_decode(emissions.numpy(), trans.numpy(), start.numpy(), end.numpy()),
+                                  viterbi_decode(emissions, trans, start, end).numpy())
+
+
+@pytest.mark.parametrize('block, se', [('bottleneck', False), ('bottleneck', True), ('separable', False), ('grouped', True)])
+def test_numpy_matches_torch(x, tmp_path, block, se):
+    model = random_model(block=block, se=se)
+    export_numpy_model(model, tmp_path)
+    scorer = NumpyScorer(tmp_path)
+    with torch.no_grad():
+        assert_emissions_close(scorer(x.numpy()), model(x))
+    assert scorer.predict(x.numpy()).tolist() == model.predict(x)
+    np.testing.assert_array_equal(scorer.predict_aux(x.numpy()), model.predict_aux(x).numpy())
+
+
+def test_torch_without_aux_head(x):
+    with pytest.raises(ValueError):
+        random_model(aux_head=False).predict_aux(x)
+
+
+def test_numpy_without_aux_head(x, tmp_path):
+    export_numpy_model(random_model(aux_head=False), tmp_path)
+    with pytest.raises(ValueError):
+        NumpyScorer(tmp_path).predict_aux(x.numpy())
+
+
+def test_numpy_squeeze_excitation_is_stable(x, tmp_path):
+    model = random_model(se=True)
+    with torch.no_grad():
+        for module in model.qzy.modules():
+            if isinstance(module, SqueezeExcitation):
+                module.fc2.bias.fill_(-1000.)   # gates saturate at 0
+    export_numpy_model(model, tmp_path)
+    scorer = NumpyScorer(tmp_path)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        out = scorer(x.numpy())
+    with torch.no_grad():
+        assert_emissions_close(out, model(x))
+
+
+def test_ensemble_matches_members(x):
+    members = []
+    for seed in range(3):
+        member = random_model()
+        generator = torch.Generator().manual_seed(10 + seed)
+        with torch.no_grad():
+            for param in member.parameters():
+                param.add_(torch.randn(param.shape, generator=generator) * 0.02 * param.abs().mean())
+        members.append(member)
+
+    ensemble = EnsembleNet(members)
+    with torch.no_grad():
+        emissions = ensemble(x)
+        reference = torch.stack([member(x) for member in members])
+    assert emissions.shape == (3, x.size(0), 4, 5)
+    assert_emissions_close(emissions, reference)
+
+    crf = [[getattr(member.classifier.crf, name) for name in ['trans_matrix', 'start_trans', 'end_trans']] for member in members]
+    marginals = torch.stack([crf_marginals(e, *params) for e, params in zip(reference, crf)]).mean(0)
+    stacked = [torch.stack(params) for params in zip(*crf)]
+    with torch.no_grad():
+        torch.testing.assert_close(torch.func.vmap(crf_marginals)(emissions, *stacked).mean(0), marginals, rtol=1e-3, atol=1e-3)
+    assert torch.equal(ensemble.predict(x), marginals.argmax(-1))
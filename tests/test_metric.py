@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import torch
+from sklearn import metrics as sk_metrics
+
+from model.metric import ConfusionMatrix, confusion_matrix, accuracy, f1, kappa, class_f1
+
+
+@pytest.fixture
+def stages():
+    rng = np.random.default_rng(0)
+    target = rng.integers(5, size=1000)
+    output = np.where(rng.random(1000) < 0.6, target, rng.integers(5, size=1000))
+    return output, target
+
+
+def test_confusion_matrix_matches_sklearn(stages):
+    output, target = stages
+    np.testing.assert_array_equal(confusion_matrix(output, target), sk_metrics.confusion_matrix(target, output))
+
+
+def test_streaming_confusion_matrix_matches_sklearn(stages):
+    output, target = stages
+    confusion = ConfusionMatrix(5)
+    for start in range(0, len(target), 64):
+        confusion.update(torch.as_tensor(output[start:start + 64]), torch.as_tensor(target[start:start + 64]))
+    np.testing.assert_array_equal(confusion.result(), sk_metrics.confusion_matrix(target, output, labels=range(5)))
+
+    confusion.reset()
+    np.testing.assert_array_equal(confusion.result(), np.zeros((5, 5)))
+
+
+def test_metrics_match_sklearn(stages):
+    output, target = stages
+    matrix = confusion_matrix(output, target)
+    for value in [accuracy(output, target), accuracy(matrix)]:
+        assert value == pytest.approx(sk_metrics.accuracy_score(target, output))
+    for value in [f1(output, target), f1(matrix)]:
+        assert value == pytest.approx(sk_metrics.f1_score(target, output, average='macro'))
+    for value in [kappa(output, target), kappa(matrix)]:
+        assert value == pytest.approx(sk_metrics.cohen_kappa_score(target, output))
+    np.testing.assert_allclose(class_f1(matrix), sk_metrics.f1_score(target, output, average=None))
+
+
+def test_f1_skips_absent_stages():
+    # stage 2 never occurs, as sklearn's macro average over the present labels
+    output, target = np.array([0, 1, 3, 3, 1]), np.array([0, 1, 3, 1, 1])
+    assert f1(output, target) == pytest.approx(sk_metrics.f1_score(target, output, average='macro'))
+
+
+def test_scalar_metrics_are_floats(stages):
+    output, target = stages
+    for metric in [accuracy, f1, kappa]:
+        assert type(metric(output, target)) is float
+    assert type(kappa(np.zeros(4), np.zeros(4))) is float
@@ -0,0 +1,77 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from model.dream import Encoder_ResNet, VAE
+from model.pruning import bn_scores, prune_encoder, prune_feature_net, resize_to_state_dict
+
+
+@pytest.fixture(scope='module')
+def encoder():
+    torch.manual_seed(0)
+    encoder = Encoder_ResNet(64, 100).eval()
+    with torch.no_grad():
+        for module in encoder.modules():
+            if isinstance(module, nn.BatchNorm1d):
+                module.weight.uniform_(0.1, 1.5)
+                module.running_mean.uniform_(-0.2, 0.2)
+                module.running_var.uniform_(0.5, 2.)
+    return encoder
+
+
+@pytest.fixture(scope='module')
+def x():
+    return torch.randn(6, 1, 3000, generator=torch.Generator().manual_seed(1))
+
+
+def test_prune_nothing_keeps_outputs(encoder, x):
+    pruned = prune_encoder(encoder, 0., bn_scores(encoder))
+    with torch.no_grad():
+        for out, ref in zip(pruned(x), encoder(x)):
+            torch.testing.assert_close(out, ref)
+
+
+@pytest.mark.parametrize('ratio', [0.25, 0.5, 0.75])
+def test_pruned_shapes_are_consistent(encoder, x, ratio):
+    pruned = prune_encoder(encoder, ratio, bn_scores(encoder))
+    for name in ['layer1', 'layer2', 'layer3', 'layer4']:
+        for block, ref in zip(getattr(pruned, name), getattr(encoder, name)):
+            for conv, bn, ref_conv in [(block.conv1, block.bn1, ref.conv1), (block.conv2, block.bn2, ref.conv2)]:
+                assert conv.out_channels == bn.num_features == round(ref_conv.out_channels * (1 - ratio))
+            assert block.conv2.in_channels == block.conv1.out_channels
+            assert block.conv3.in_channels == block.conv2.out_channels
+            assert block.bn3.num_features == block.conv3.out_channels
+
+    # the residual stream of the last stage feeds fc11 / fc12
+    n_channels = pruned.layer4[-1].conv3.out_channels
+    assert n_channels == round(encoder.layer4[-1].conv3.out_channels * (1 - ratio))
+    assert pruned.fc11[0].in_features * encoder.layer4[-1].conv3.out_channels == encoder.fc11[0].in_features * n_channels
+
+    with torch.no_grad():
+        loc, scale = pruned(x)
+    assert loc.shape == scale.shape == (x.size(0), 64)
+    assert sum(p.numel() for p in pruned.parameters()) < sum(p.numel() for p in encoder.parameters())
+
+
+def test_resize_to_state_dict_loads_pruned_checkpoint(encoder, x):
+    pruned = prune_encoder(encoder, 0.5, bn_scores(encoder))
+    fresh = Encoder_ResNet(64, 100)
+    resize_to_state_dict(fresh, pruned.state_dict())
+    fresh.load_state_dict(pruned.state_dict())
+    fresh.eval()
+    with torch.no_grad():
+        torch.testing.assert_close(fresh(x)[0], pruned(x)[0])
+
+
+def test_pruned_feature_net_trains_with_momentum_encoder():
+    config = {'hyper_params': {'num_classes': 5, 'seq_len': 2, 'aux_loss_y': 1., 'aux_loss_d': 1., 'beta_d': 1.,
+                               'beta_y': 1., 'const_weight': 1., 'queue_size': 16, 'queue_momentum': 0.9}}
+    feature_net = VAE(8, 16, 2, config, 'edf')
+    x, y, d = torch.randn(3, 2, 3000, 1), torch.randint(5, (3, 2)), torch.zeros(3, dtype=torch.long)
+    feature_net.get_losses(x, y, d)
+
+    # the momentum copy of the unpruned qzy restarts from the pruned one
+    prune_feature_net(feature_net, 0.5, bn_scores(feature_net))
+    assert torch.isfinite(feature_net.get_losses(x, y, d))
+    key_encoder = feature_net.key_encoder.encoder[0]
+    assert [p.shape for p in key_encoder.parameters()] == [p.shape for p in feature_net.qzy.parameters()]
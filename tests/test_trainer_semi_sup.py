@@ -0,0 +1,61 @@
+import logging
+
+import pytest
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, TensorDataset
+
+from trainer.trainer_semi_sup import Trainer
+
+
+class Config(dict):
+    resume = None
+
+    def __init__(self, save_dir, **trainer):
+        super().__init__(n_gpu=0, hyper_params={'num_classes': 5},
+                         trainer=dict({'epochs': 1, 'save_period': 1, 'verbosity': 2}, **trainer))
+        self.save_dir = save_dir
+
+    def get_logger(self, name, verbosity):
+        return logging.getLogger(name)
+
+
+def loader(n_batches, batch_size=2):
+    n = n_batches * batch_size
+    return DataLoader(TensorDataset(torch.randn(n, 3), torch.zeros(n, dtype=torch.long), torch.zeros(n, dtype=torch.long)),
+                      batch_size=batch_size)
+
+
+def make_trainer(tmp_path, n_sup=4, n_unsup=10, **trainer):
+    return Trainer(nn.Linear(3, 5), nn.Linear(5, 5), None, None, nn.CrossEntropyLoss(), [], Config(tmp_path, **trainer), 0,
+                   loader(n_sup), loader(n_unsup))
+
+
+def test_round_interleaves_uneven_ratio(tmp_path):
+    trainer = make_trainer(tmp_path, sup_unsup_ratio=[2, 5])
+    assert trainer._round() == ['supervised', 'unsupervised', 'unsupervised', 'unsupervised',
+                                'supervised', 'unsupervised', 'unsupervised']
+    # rounds until both loaders are seen once: 2 for the 4 supervised, 2 for the 10 unsupervised batches
+    assert trainer.n_trains_featurenet == 2 * 7
+
+
+def test_round_with_mixed_batches(tmp_path):
+    trainer = make_trainer(tmp_path, sup_unsup_ratio=[2, 5], mixed_batches=True)
+    assert trainer._round() == ['mixed', 'unsupervised', 'unsupervised', 'mixed', 'unsupervised']
+    assert trainer.n_trains_featurenet == 2 * 5
+
+    trainer = make_trainer(tmp_path, sup_unsup_ratio=[3, 1], mixed_batches=True)
+    assert trainer._round() == ['mixed', 'supervised', 'supervised']
+
+
+def test_round_defaults_to_loader_sizes(tmp_path):
+    trainer = make_trainer(tmp_path)
+    schedule = trainer._round()
+    assert schedule.count('supervised') == 4 and schedule.count('unsupervised') == 10
+    assert trainer.n_trains_featurenet == 14
+
+
+@pytest.mark.parametrize('ratio', [[0, 1], [1.5, 2], [1, 2, 3]])
+def test_invalid_ratio(tmp_path, ratio):
+    with pytest.raises(ValueError):
+        make_trainer(tmp_path, sup_unsup_ratio=ratio)
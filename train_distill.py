@@ -0,0 +1,98 @@
+import argparse
+import collections
+import copy
+import numpy as np
+
+from data_loader.data_loader import *
+import model.loss as module_loss
+import model.metric as module_metric
+from parse_config import ConfigParser
+from trainer.trainer_distill import DistillTrainer
+from utils.util import *
+from model.student import *
+from evaluate import load_fold_models
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+
+def main(config, fold_id, data_config, teacher_dir):
+    logger = config.get_logger('train')
+    batch_size = config["data_loader"]["args"]["batch_size"]
+
+    train_dataset = SleepDataLoader(config, folds_data[fold_id]['train'], d_type=data_config['d_type'], phase='train')
+    data_loader = DataLoader(dataset=train_dataset, shuffle=True, batch_size = batch_size)
+    valid_dataset = SleepDataLoader(config, folds_data[fold_id]['valid'], d_type=data_config['d_type'], phase='valid')
+    valid_loader = DataLoader(dataset=valid_dataset, shuffle=False, batch_size = batch_size)
+    test_dataset = SleepDataLoader(config, folds_data[fold_id]['test'], d_type=data_config['d_type'], phase='test')
+    test_loader = DataLoader(dataset=test_dataset, shuffle=False, batch_size = batch_size)
+
+    # teacher of the same fold, and the student to distill into
+    teacher_net, teacher_classifier, _ = load_fold_models(teacher_dir, data_config['d_type'], torch.device('cpu'))
+
+    student = StudentNet(teacher_net.zy_dim, config, data_config['d_type'])
+    classifier = copy.deepcopy(teacher_classifier).train()
+
+    logger.info(student)
+    logger.info("-"*100)
+
+    # get function of loss and metrics
+    criterion = getattr(module_loss, config['loss'])
+    metrics = [getattr(module_metric, met) for met in config['metrics']]
+
+    # build optimizer
+    student_parameters = filter(lambda p: p.requires_grad, student.parameters())
+    classifier_parameters = filter(lambda p: p.requires_grad, classifier.parameters())
+
+    student_optimizer = config.init_obj('optimizer', torch.optim, student_parameters)
+    classifier_optimizer = config.init_obj('optimizer', torch.optim, classifier_parameters)
+
+    trainer = DistillTrainer(student, classifier, teacher_net, teacher_classifier,
+                             student_optimizer, classifier_optimizer,
+                             criterion, metrics,
+                             config=config,
+                             data_loader=data_loader,
+                             fold_id=fold_id,
+                             valid_loader=valid_loader,
+                             test_loader=test_loader
+                            )
+
+    trainer.training_feature_net()
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Distill a trained fold into a small student encoder')
+    args.add_argument('-c', '--config', type=str,
+                      help='config file path (default: None)')
+    args.add_argument('-r', '--resume', default=None, type=str,
+                      help='path to latest checkpoint (default: None)')
+    args.add_argument('-d', '--device', default="0", type=str,
+                      help='indices of GPUs to enable (default: all)')
+    args.add_argument('-f', '--fold_id', type=str,
+                      help='fold_id')
+    args.add_argument('-da', '--np_data_dir', type=str,
+                      help='Directory containing numpy files')
+    args.add_argument('-t', '--teacher_dir', type=str,
+                      help='fold directory of the teacher (featurenet_best.pth and classifier_best.pth)')
+
+
+    CustomArgs = collections.namedtuple('CustomArgs', 'flags type target')
+
+    args2 = args.parse_args()
+    fold_id = int(args2.fold_id)
+
+    config = ConfigParser.from_args(args, fold_id)
+
+    data_config = dict()
+    if "shhs" in args2.np_data_dir:
+        folds_data = load_shhs_folds(args2.np_data_dir, config["data_loader"]["args"]["num_folds"], fold_id)
+        data_config['d_type'] = 'shhs'
+        data_config['sampling_rate'] = 125
+    else:
+        folds_data = load_edf_folds(args2.np_data_dir, config["data_loader"]["args"]["num_folds"], fold_id)
+        data_config['d_type'] = 'edf'
+        data_config['sampling_rate'] = 100
+
+
+    main(config, fold_id, data_config, args2.teacher_dir)
@@ -114,7 +114,7 @@ class BaseTrainer:
         self.mnt_best = inf if self.mnt_mode == 'min' else -inf
                 
         PATH = str(self.checkpoint_dir / 'featurenet_best.pth')
-        self.feature_net.load_state_dict(torch.load(PATH)['state_dict'])
+        self.feature_net.load_state_dict(torch.load(PATH, map_location=self.device, weights_only=False)['state_dict'])
         self.feature_net.eval()
         
         for name, child in self.feature_net.named_children():
@@ -168,6 +168,16 @@ class BaseTrainer:
         if self.do_test:      
             self._test_classifier()
         
+    def _metric_results(self, tracker, confusion):
+        """
+        Update tracker with every metric of metric_ftns computed from the accumulated confusion
+        matrix and return its results
+        """
+        matrix = confusion.result()
+        for met in self.metric_ftns:
+            tracker.update(met.__name__, met(matrix))
+        return tracker.result()
+
     def _prepare_device(self, n_gpu_use):
         """
         setup GPU device if available, move model into configured device
@@ -226,7 +236,7 @@ class BaseTrainer:
         """
         resume_path = str(resume_path)
         self.logger.info("Loading checkpoint: {} ...".format(resume_path))
-        checkpoint = torch.load(resume_path)
+        checkpoint = torch.load(resume_path, map_location=self.device, weights_only=False)
         self.start_epoch = checkpoint['epoch'] + 1
         self.mnt_best = checkpoint['monitor_best']
 
@@ -1,9 +1,10 @@
 import numpy as np
 import torch
-from base_trainer import BaseTrainer
+from trainer.base_trainer import BaseTrainer
 from utils import MetricTracker
 import torch.nn as nn
-from sklearn.metrics import accuracy_score
+from torch.nn import functional as F
+from model.metric import ConfusionMatrix, accuracy
 
 class Trainer(BaseTrainer):
     """
@@ -24,29 +25,35 @@ class Trainer(BaseTrainer):
         self.lr_scheduler_f = featurenet_optimizer
         self.lr_scheduler_c = classifier_optimizer
         self.log_step = int(data_loader.batch_size) * 1  # reduce this if you want more logs
+        self.mc_samples = config['trainer'].get('mc_samples', 0)  # Monte-Carlo samples for test uncertainty (0: off)
+        self.amp = config['trainer'].get('amp', False)  # bfloat16 autocast of forward passes (losses stay float32)
+        self.reduce_lr = config['trainer'].get('reduce_lr', True)  # classifier lr to 1e-4 after 10 epochs
 
         self.train_metrics = MetricTracker('loss', *[m.__name__ for m in self.metric_ftns])
         self.valid_metrics = MetricTracker('loss', *[m.__name__ for m in self.metric_ftns])
         self.test_metrics = MetricTracker('loss', *[m.__name__ for m in self.metric_ftns])
+        self.train_confusion = ConfusionMatrix(config['hyper_params']['num_classes'])
+        self.valid_confusion = ConfusionMatrix(config['hyper_params']['num_classes'])
+        self.test_confusion = ConfusionMatrix(config['hyper_params']['num_classes'])
         
 
     def _train_feature_net(self, epoch):
         self.feature_net.train()
         self.train_metrics.reset()
+        self.train_confusion.reset()
         
         self.feature_net.beta_d = min([self.config['hyper_params']['beta_d'], self.config['hyper_params']['beta_d'] * (epoch * 1.) / self.config['hyper_params']['warmup']])
         self.feature_net.beta_y = min([self.config['hyper_params']['beta_y'], self.config['hyper_params']['beta_y'] * (epoch * 1.) / self.config['hyper_params']['warmup']])
 
 
-        outs = np.array([])
-        trgs = np.array([])
         for batch_idx, (x, y, d) in enumerate(self.data_loader):
             x, y, d = x.to(self.device), y.to(self.device), d.to(self.device)
 
             self.featurenet_optimizer.zero_grad()
             
-            all_loss = self.feature_net.get_losses(x, y, d)
-            output = self.feature_net.predict(x)
+            with self._autocast():
+                all_loss, logits = self.feature_net.get_losses(x, y, d, return_logits=True)
+            output = self._aux_predictions(logits)
             loss = self.criterion(output, y)
 
             all_loss.backward()
@@ -63,15 +70,10 @@ class Trainer(BaseTrainer):
                     loss.item()
                 ))
                 
-            preds_ = output.data.max(1, keepdim=True)[1].cpu()    
-            outs = np.append(outs, preds_.numpy())
-            trgs = np.append(trgs, y.data.cpu().numpy())
+            self.train_confusion.update(output.argmax(1), y)
 
                             
-        for met in self.metric_ftns:
-            self.train_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
-            
-        log = self.train_metrics.result()
+        log = self._metric_results(self.train_metrics, self.train_confusion)
 
         if self.do_validation:
             val_log = self._valid_feature_net()
@@ -86,57 +88,48 @@ class Trainer(BaseTrainer):
         """
         self.feature_net.eval()
         self.valid_metrics.reset()
+        self.valid_confusion.reset()
         
         with torch.no_grad():
-            outs = np.array([])
-            trgs = np.array([])
             for batch_idx, (x, y, _) in enumerate(self.valid_loader):
                 x, y = x.to(self.device), y.to(self.device)
 
-                output = self.feature_net.predict(x)
+                with self._autocast():
+                    output = self.feature_net.predict(x)
                 loss = self.criterion(output, y)
 
                 self.valid_metrics.update('loss', loss.item())
                     
-                preds_ = output.data.max(1, keepdim=True)[1].cpu()
-                outs = np.append(outs, preds_.numpy())
-                trgs = np.append(trgs, y.data.cpu().numpy())
-                
-            for met in self.metric_ftns:
-                self.valid_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
+                self.valid_confusion.update(output.argmax(1), y)
 
-        return self.valid_metrics.result()
+        return self._metric_results(self.valid_metrics, self.valid_confusion)
     
     def _test_feature_net(self):
         """
         test 
         """
         PATH = str(self.checkpoint_dir / 'featurenet_best.pth')
-        self.feature_net.load_state_dict(torch.load(PATH)['state_dict'])
+        self.feature_net.load_state_dict(torch.load(PATH, map_location=self.device, weights_only=False)['state_dict'])
         self.feature_net.eval()
         
         val_log = self._valid_feature_net()
         
         self.test_metrics.reset()
+        self.test_confusion.reset()
         with torch.no_grad():
-            outs = np.array([])
-            trgs = np.array([])
             for batch_idx, (x, y, _) in enumerate(self.test_loader):
                 x, y = x.to(self.device), y.to(self.device)
 
-                output = self.feature_net.predict(x)
+                with self._autocast():
+                    output = self.feature_net.predict(x)
                 loss = self.criterion(output, y)
 
                 self.test_metrics.update('loss', loss.item())
                     
-                preds_ = output.data.max(1, keepdim=True)[1].cpu()
-                outs = np.append(outs, preds_.numpy())
-                trgs = np.append(trgs, y.data.cpu().numpy())
+                self.test_confusion.update(output.argmax(1), y)
             
         
-        for met in self.metric_ftns:
-            self.test_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
-        test_log = self.test_metrics.result()
+        test_log = self._metric_results(self.test_metrics, self.test_confusion)
         
         log = {}
         log.update(**{'val_' + k: v for k, v in val_log.items()})
@@ -155,42 +148,36 @@ class Trainer(BaseTrainer):
         
         self.classifier.train()
         self.train_metrics.reset()
+        self.train_confusion.reset()
 
-        outs = np.array([])
-        trgs = np.array([])
         for batch_idx, (x, y, _) in enumerate(self.data_loader):
             x, y = x.to(self.device), y.to(self.device)
 
             self.classifier_optimizer.zero_grad()
             
-            features = self.feature_net.get_features(x)
-            loss = self.classifier.get_loss(features, y)
-            output = self.classifier.predict(features)
+            with self._autocast():
+                features = self.feature_net.get_features(x)
+                loss = self.classifier.get_loss(features, y)
+                output = self.classifier.predict(features)
             
             loss.backward()
             self.classifier_optimizer.step()
                 
             self.train_metrics.update('loss', loss.item())
                 
-            outs = np.append(outs, np.array(output))
-            trgs = np.append(trgs, y.data.cpu().numpy())
-            
-            accuracy = accuracy_score(y.data.cpu().numpy().reshape(-1,1), np.array(output).reshape(-1,1))
+            batch_confusion = self.train_confusion.update(output, y)
             
             if batch_idx % self.log_step == 0:
                 self.logger.debug('Train Epoch: {} {} Loss: {:.6f} Accuracy: {:.6f}'.format(
                     epoch,
                     self._progress(batch_idx),
                     loss.item(),
-                    accuracy
+                    accuracy(batch_confusion.cpu().numpy())
                     
                 ))
                 
     
-        for met in self.metric_ftns:
-            self.train_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
-            
-        log = self.train_metrics.result()
+        log = self._metric_results(self.train_metrics, self.train_confusion)
         
         if self.do_validation:
             val_log = self._valid_classifier()
@@ -208,64 +195,69 @@ class Trainer(BaseTrainer):
         self.feature_net.eval()
         self.classifier.eval()
         self.valid_metrics.reset()
+        self.valid_confusion.reset()
         
         with torch.no_grad():
-            outs = np.array([])
-            trgs = np.array([])
             for batch_idx, (x, y, _) in enumerate(self.valid_loader):
                 x, y = x.to(self.device), y.to(self.device)
                 
-                features = self.feature_net.get_features(x)
-                
-                loss = self.classifier.get_loss(features, y)
-                output = self.classifier.predict(features)
+                with self._autocast():
+                    features = self.feature_net.get_features(x)
+                    loss = self.classifier.get_loss(features, y)
+                    output = self.classifier.predict(features)
 
                 self.valid_metrics.update('loss', loss.item())
                     
-                outs = np.append(outs, np.array(output) )
-                trgs = np.append(trgs, y.data.cpu().numpy())
-                
-            for met in self.metric_ftns:
-                self.valid_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
+                self.valid_confusion.update(output, y)
 
-        return self.valid_metrics.result()
+        return self._metric_results(self.valid_metrics, self.valid_confusion)
     
     def _test_classifier(self):
 
         PATH_f = str(self.checkpoint_dir / 'featurenet_best.pth')
-        self.feature_net.load_state_dict(torch.load(PATH_f)['state_dict'])
+        self.feature_net.load_state_dict(torch.load(PATH_f, map_location=self.device, weights_only=False)['state_dict'])
         self.feature_net.eval()
             
         PATH_c = str(self.checkpoint_dir / 'classifier_best.pth')
-        self.classifier.load_state_dict(torch.load(PATH_c)['state_dict'])
+        self.classifier.load_state_dict(torch.load(PATH_c, map_location=self.device, weights_only=False)['state_dict'])
         self.classifier.eval()
         
         val_log = self._valid_classifier()
         
         self.test_metrics.reset()
+        self.test_confusion.reset()
+        # per-batch arrays, concatenated once at the end
+        uncertainty = {'confidence': [], 'entropy': [], 'mutual_info': []}
         with torch.no_grad():
-            outs = np.array([])
-            trgs = np.array([])
+            outs, trgs = [], []
             for batch_idx, (x, y, _) in enumerate(self.test_loader):
                 x, y = x.to(self.device), y.to(self.device)
-                features = self.feature_net.get_features(x)
-
-                loss = self.classifier.get_loss(features, y)
-                output = self.classifier.predict(features)
+                with self._autocast():
+                    features = self.feature_net.get_features(x)
+                    loss = self.classifier.get_loss(features, y)
+                    output = self.classifier.predict(features)
 
                 self.test_metrics.update('loss', loss.item())
                     
-                outs = np.append(outs, np.array(output))
-                trgs = np.append(trgs, y.data.cpu().numpy())
+                self.test_confusion.update(output, y)
+                outs.append(np.array(output).reshape(-1))
+                trgs.append(y.data.cpu().numpy().reshape(-1))
+
+                if self.mc_samples > 0:
+                    with self._autocast():
+                        res = self.feature_net.predict_uncertainty(x, self.mc_samples, self.classifier)['classifier']
+                    for key in uncertainty:
+                        uncertainty[key].append(res[key].cpu().numpy().reshape(-1))
             
         outs_name = "test_outs_" + str(self.fold_id)
         trgs_name = "test_trgs_" + str(self.fold_id)
-        np.save(self.checkpoint_dir / outs_name, outs)
-        np.save(self.checkpoint_dir / trgs_name, trgs)   
+        np.save(self.checkpoint_dir / outs_name, np.concatenate(outs).astype(float))
+        np.save(self.checkpoint_dir / trgs_name, np.concatenate(trgs).astype(float))   
+        if self.mc_samples > 0:
+            for key, value in uncertainty.items():
+                np.save(self.checkpoint_dir / "test_{}_{}".format(key, self.fold_id), np.concatenate(value))
         
-        for met in self.metric_ftns:
-            self.test_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
-        test_log = self.test_metrics.result()
+        test_log = self._metric_results(self.test_metrics, self.test_confusion)
         
         log = {}
         log.update(**{'val_' + k: v for k, v in val_log.items()})
@@ -277,9 +269,16 @@ class Trainer(BaseTrainer):
         for key, value in log.items():
             self.logger.info('    {:15s}: {}'.format(str(key), value))            
             
+    def _aux_predictions(self, logits):
+        # one-hot aux predictions (batch_size, n_class, len) from logits (batch_size, len, n_class), as feature_net.predict
+        return F.one_hot(logits.argmax(-1), logits.size(-1)).float().permute(0, 2, 1)
+
+    def _autocast(self):
+        return torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.amp)
+
     def _progress(self, batch_idx):
         base = '[{}/{} ({:.0f}%)]'
         current = batch_idx * self.data_loader.batch_size
-        total = self.data_loader.n_samples
+        total = len(self.data_loader.dataset)
 
         return base.format(current, total, 100.0 * current / total)
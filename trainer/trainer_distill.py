@@ -0,0 +1,118 @@
+import pandas as pd
+import torch
+from trainer.trainer import Trainer
+from model.student import encoder_cost
+import model.metric as module_metric
+
+
+class DistillTrainer(Trainer):
+    """
+    Distillation trainer: the feature-net stage trains a StudentNet against the qzy embeddings
+    and Transformer emissions of a frozen teacher (VAE, Transformer) of the same fold, the
+    classifier stage fine-tunes a copy of the teacher Transformer on the student features.
+    """
+    def __init__(self, student, classifier, teacher_net, teacher_classifier,
+                 featurenet_optimizer, classifier_optimizer,
+                 criterion, metric_ftns, config, data_loader, fold_id,
+                 valid_loader=None, test_loader=None):
+        super().__init__(student, classifier, featurenet_optimizer, classifier_optimizer,
+                         criterion, metric_ftns, config, data_loader, fold_id,
+                         valid_loader=valid_loader, test_loader=test_loader)
+        self.mc_samples = 0  # the student encoder is deterministic
+
+        self.teacher_net = teacher_net.to(self.device).eval()
+        self.teacher_classifier = teacher_classifier.to(self.device).eval()
+        for param in list(self.teacher_net.parameters()) + list(self.teacher_classifier.parameters()):
+            param.requires_grad = False
+
+
+##################### distill feature net ####################
+
+    def _train_feature_net(self, epoch):
+        self.feature_net.train()
+        self.train_metrics.reset()
+        self.train_confusion.reset()
+
+        for batch_idx, (x, y, _) in enumerate(self.data_loader):
+            x, y = x.to(self.device), y.to(self.device)
+
+            with torch.no_grad(), self._autocast():
+                teacher_features, _ = self.teacher_net.encode(x)
+                teacher_emissions = self.teacher_classifier(teacher_features)
+
+            self.featurenet_optimizer.zero_grad()
+
+            with self._autocast():
+                all_loss, logits = self.feature_net.get_losses(x, y, teacher_features.float(), teacher_emissions.float(),
+                                                               self.teacher_classifier, return_logits=True)
+            output = self._aux_predictions(logits)
+            loss = self.criterion(output, y)
+
+            all_loss.backward()
+            self.featurenet_optimizer.step()
+
+            self.train_metrics.update('loss', loss.item())
+
+            if batch_idx % self.log_step == 0:
+                self.logger.debug('Train Epoch: {} {} Loss: {:.6f} ClassLoss: {:.6f} '.format(
+                    epoch,
+                    self._progress(batch_idx),
+                    all_loss.item(),
+                    loss.item()
+                ))
+
+            self.train_confusion.update(output.argmax(1), y)
+
+        log = self._metric_results(self.train_metrics, self.train_confusion)
+
+        if self.do_validation:
+            val_log = self._valid_feature_net()
+            log.update(**{'val_' + k: v for k, v in val_log.items()})
+
+        return log
+
+
+##################### test ####################
+
+    def _test_classifier(self):
+        super()._test_classifier()
+        self._report()
+
+    def _report(self):
+        """
+        Encoder FLOPs / latency of teacher (qzy) and student against their test accuracy and
+        macro-F1, saved as distill_<fold_id>.csv
+        """
+        self.feature_net.eval()
+        self.classifier.eval()
+
+        n_classes = self.config['hyper_params']['num_classes']
+        confusion = {'teacher': module_metric.ConfusionMatrix(n_classes), 'student': module_metric.ConfusionMatrix(n_classes)}
+        with torch.no_grad():
+            for x, y, _ in self.test_loader:
+                x, y = x.to(self.device), y.to(self.device)
+                features, _ = self.teacher_net.encode(x)
+                confusion['teacher'].update(self.teacher_classifier.predict(features), y)
+                confusion['student'].update(self.classifier.predict(self.feature_net.get_features(x)), y)
+
+        encoders = {'teacher': self.teacher_net.qzy, 'student': self.feature_net.qzy}
+        rows = []
+        for name, encoder in encoders.items():
+            row = {'model': name}
+            row.update(encoder_cost(encoder, self.feature_net.sampling_rate, self.device))
+            row['accuracy'] = module_metric.accuracy(confusion[name].result())
+            row['f1'] = module_metric.f1(confusion[name].result())
+            rows.append(row)
+
+        result = pd.DataFrame(rows)
+        result['rel_flops'] = result['flops'] / result['flops'][0]
+        result['speedup'] = result['ms/epoch'][0] / result['ms/epoch']
+        result['d_accuracy'] = result['accuracy'] - result['accuracy'][0]
+        result['d_f1'] = result['f1'] - result['f1'][0]
+        result.to_csv(self.checkpoint_dir / 'distill_{}.csv'.format(self.fold_id), index=False)
+
+        self.logger.info('='*100)
+        self.logger.info('Distillation report')
+        self.logger.info('-'*100)
+        for line in result.to_string(index=False).split('\n'):
+            self.logger.info('    ' + line)
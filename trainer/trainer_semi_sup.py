@@ -1,9 +1,11 @@
+import math
 import numpy as np
 import torch
-from base_trainer import BaseTrainer
-from utils import MetricTracker
+from trainer.base_trainer import BaseTrainer
+from utils import MetricTracker, Prefetcher
 import torch.nn as nn
-from sklearn.metrics import confusion_matrix, f1_score, accuracy_score
+from torch.nn import functional as F
+from model.metric import ConfusionMatrix, accuracy
 
 class Trainer(BaseTrainer):
     """
@@ -16,7 +18,20 @@ class Trainer(BaseTrainer):
                          criterion, metric_ftns, config, fold_id)
         self.supervised_loader = supervised_loader
         self.unsupervised_loader = unsupervised_loader
-        self.n_trains_featurenet = len(supervised_loader)+len(unsupervised_loader)
+
+        # feature-net schedule: rounds of sup_ratio supervised and unsup_ratio unsupervised batches,
+        # interleaved; by default one round per epoch in proportion to the loader sizes
+        cfg_trainer = config['trainer']
+        ratio = cfg_trainer.get('sup_unsup_ratio') or [len(supervised_loader), len(unsupervised_loader)]
+        if len(ratio) != 2 or not all(isinstance(n, int) and n > 0 for n in ratio):
+            raise ValueError('sup_unsup_ratio must be two positive integers [n_sup, n_unsup], got {}'.format(ratio))
+        self.sup_ratio, self.unsup_ratio = ratio
+        self.mixed_batches = cfg_trainer.get('mixed_batches', False)  # one supervised + one unsupervised batch per forward
+        self.n_rounds = max(math.ceil(len(supervised_loader) / self.sup_ratio), math.ceil(len(unsupervised_loader) / self.unsup_ratio))
+        self.n_trains_featurenet = self.n_rounds * len(self._round())
+
+        # during each feature-net epoch both loaders are streamed, each prefetched by its own thread
+        self.n_prefetch = cfg_trainer.get('prefetch', 2)
 
         self.valid_loader = valid_loader
         self.do_validation = self.valid_loader is not None
@@ -30,6 +45,9 @@ class Trainer(BaseTrainer):
         self.train_metrics = MetricTracker('loss', *[m.__name__ for m in self.metric_ftns])
         self.valid_metrics = MetricTracker('loss', *[m.__name__ for m in self.metric_ftns])
         self.test_metrics = MetricTracker('loss', *[m.__name__ for m in self.metric_ftns])
+        self.train_confusion = ConfusionMatrix(config['hyper_params']['num_classes'])
+        self.valid_confusion = ConfusionMatrix(config['hyper_params']['num_classes'])
+        self.test_confusion = ConfusionMatrix(config['hyper_params']['num_classes'])
        
 
 ##################### Train Feature Net            
@@ -37,64 +55,49 @@ class Trainer(BaseTrainer):
     def _train_feature_net(self, epoch):
         self.feature_net.train()
         self.train_metrics.reset()
+        self.train_confusion.reset()
         
         self.feature_net.beta_d = min([self.config['hyper_params']['beta_d'], self.config['hyper_params']['beta_d'] * (epoch * 1.) / self.config['hyper_params']['warmup']])
         self.feature_net.beta_y = min([self.config['hyper_params']['beta_y'], self.config['hyper_params']['beta_y'] * (epoch * 1.) / self.config['hyper_params']['warmup']])
 
-        outs, trgs = np.array([]), np.array([])
-        if self.predict_d:
-            outs_d, trgs_d = np.array([]), np.array([])
-        
-        sup_iter = iter(self.supervised_loader)
-        unsup_iter = iter(self.unsupervised_loader)
-        
-        unsupervised_exist = True
-        for iter_ in range(self.n_trains_featurenet):
-            if unsupervised_exist: 
-                try:
-                    (x, y, d) = next(unsup_iter)
-                    x, y, d = x.to(self.device), None, d.to(self.device)
-                    phase = 'UnSupervised learning'
-                except:
-                    (x, y, d) = next(sup_iter)
-                    x, y, d = x.to(self.device), y.to(self.device), d.to(self.device)
-                    phase = 'Supervised learning'
-                    unsupervised_exist = False
-            else:
-                (x, y, d) = next(sup_iter)
-                x, y, d = x.to(self.device), y.to(self.device), d.to(self.device)
-                phase = 'Supervised learning'
-
-
-            self.featurenet_optimizer.zero_grad()
-            all_loss = self.feature_net.get_losses(x=x, y=y, d=d)
-            all_loss.backward()
-            self.featurenet_optimizer.step()
-
-            if phase == 'Supervised learning':
-                output = self.feature_net.predict(x)
-                loss = self.criterion(output, y)
-                self.train_metrics.update('loss', loss.item())
-                preds_ = output.data.max(1, keepdim=True)[1].cpu().numpy() 
-                outs = np.append(outs, preds_)
-                trgs = np.append(trgs, y.data.cpu().numpy())
-                acc_class = accuracy_score(y.data.cpu().numpy().reshape(-1,1), preds_.reshape(-1,1))    
-  
-             
-            if iter_ % 25 == 0:
-                self.logger.debug('Train Epoch: {} {}  {} - Loss: {:.6f} ContLoss: {:.6f}'.format(
-                    epoch,
-                    self._progress(iter_),
-                    phase,
-                    all_loss.item(),
-                    Conts_loss.item()
-                ))
+        schedule = self._round()
+        with Prefetcher(self.supervised_loader, self.device, self.n_prefetch) as supervised_stream, \
+             Prefetcher(self.unsupervised_loader, self.device, self.n_prefetch) as unsupervised_stream:
+            for iter_ in range(self.n_trains_featurenet):
+                phase = schedule[iter_ % len(schedule)]
+                if phase == 'unsupervised':
+                    x, _, d = next(unsupervised_stream)
+                    y = None
+                else:
+                    x, y, d = next(supervised_stream)
+                    if phase == 'mixed':
+                        # labeled sequences first, see VAE.get_losses
+                        x_unsup, _, d_unsup = next(unsupervised_stream)
+                        x, d = torch.cat([x, x_unsup]), torch.cat([d, d_unsup])
+
+                self.featurenet_optimizer.zero_grad()
+                all_loss, logits = self.feature_net.get_losses(x=x, y=y, d=d, return_logits=True)
+                all_loss.backward()
+                self.featurenet_optimizer.step()
+
+                if y is not None:
+                    # train metrics on the augmented views of the same pass, no second forward
+                    output = self._aux_predictions(logits)
+                    loss = self.criterion(output, y)
+                    self.train_metrics.update('loss', loss.item())
+                    self.train_confusion.update(output.argmax(1), y)
+      
+                 
+                if iter_ % 25 == 0:
+                    self.logger.debug('Train Epoch: {} {}  {} - Loss: {:.6f}'.format(
+                        epoch,
+                        self._progress(iter_),
+                        phase,
+                        all_loss.item()
+                    ))
 
                     
-        for met in self.metric_ftns:
-            self.train_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
-        
-        log = self.train_metrics.result()
+        log = self._metric_results(self.train_metrics, self.train_confusion)
 
 
         if self.do_validation:
@@ -107,10 +110,9 @@ class Trainer(BaseTrainer):
 
         self.feature_net.eval()
         self.valid_metrics.reset()
+        self.valid_confusion.reset()
         
         with torch.no_grad():
-            outs = np.array([])
-            trgs = np.array([])
             for batch_idx, (x, y, _) in enumerate(self.valid_loader):
                 x, y = x.to(self.device), y.to(self.device)
 
@@ -119,27 +121,21 @@ class Trainer(BaseTrainer):
 
                 self.valid_metrics.update('loss', loss.item())
                     
-                preds_ = output.data.max(1, keepdim=True)[1].cpu()
-                outs = np.append(outs, preds_.numpy())
-                trgs = np.append(trgs, y.data.cpu().numpy())
-                
-            for met in self.metric_ftns:
-                self.valid_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
+                self.valid_confusion.update(output.argmax(1), y)
 
-        return self.valid_metrics.result()
+        return self._metric_results(self.valid_metrics, self.valid_confusion)
     
     def _test_feature_net(self):
 
         PATH = str(self.checkpoint_dir / 'featurenet_best.pth')
-        self.feature_net.load_state_dict(torch.load(PATH)['state_dict'])
+        self.feature_net.load_state_dict(torch.load(PATH, map_location=self.device, weights_only=False)['state_dict'])
         self.feature_net.eval()
         
         val_log = self._valid_feature_net()
         
         self.test_metrics.reset()
+        self.test_confusion.reset()
         with torch.no_grad():
-            outs = np.array([])
-            trgs = np.array([])
             for batch_idx, (x, y, _) in enumerate(self.test_loader):
                 x, y = x.to(self.device), y.to(self.device)
 
@@ -148,14 +144,10 @@ class Trainer(BaseTrainer):
 
                 self.test_metrics.update('loss', loss.item())
                     
-                preds_ = output.data.max(1, keepdim=True)[1].cpu()
-                outs = np.append(outs, preds_.numpy())
-                trgs = np.append(trgs, y.data.cpu().numpy())
+                self.test_confusion.update(output.argmax(1), y)
             
         
-        for met in self.metric_ftns:
-            self.test_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
-        test_log = self.test_metrics.result()
+        test_log = self._metric_results(self.test_metrics, self.test_confusion)
         
         log = {}
         log.update(**{'val_' + k: v for k, v in val_log.items()})
@@ -175,9 +167,8 @@ class Trainer(BaseTrainer):
         
         self.classifier.train()
         self.train_metrics.reset()
+        self.train_confusion.reset()
 
-        outs = np.array([])
-        trgs = np.array([])
         for batch_idx, (x, y, _) in enumerate(self.supervised_loader):
             x, y = x.to(self.device), y.to(self.device)
 
@@ -193,25 +184,19 @@ class Trainer(BaseTrainer):
                 
             self.train_metrics.update('loss', loss.item())
                 
-            outs = np.append(outs, np.array(output))
-            trgs = np.append(trgs, y.data.cpu().numpy())
-            
-            accuracy = accuracy_score(y.data.cpu().numpy().reshape(-1,1), np.array(output).reshape(-1,1))
+            batch_confusion = self.train_confusion.update(output, y)
             
             if batch_idx % self.log_step == 0:
                 self.logger.debug('Train Epoch: {} {} Loss: {:.6f} Accuracy: {:.6f}'.format(
                     epoch,
                     self._progress(batch_idx),
                     loss.item(),
-                    accuracy
+                    accuracy(batch_confusion.cpu().numpy())
                     
                 ))
                 
                             
-        for met in self.metric_ftns:
-            self.train_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
-            
-        log = self.train_metrics.result()
+        log = self._metric_results(self.train_metrics, self.train_confusion)
         
         if self.do_validation:
             val_log = self._valid_classifier()
@@ -224,10 +209,9 @@ class Trainer(BaseTrainer):
         self.feature_net.eval()
         self.classifier.eval()
         self.valid_metrics.reset()
+        self.valid_confusion.reset()
         
         with torch.no_grad():
-            outs = np.array([])
-            trgs = np.array([])
             for batch_idx, (x, y, _) in enumerate(self.valid_loader):
                 x, y = x.to(self.device), y.to(self.device)
                 
@@ -238,31 +222,26 @@ class Trainer(BaseTrainer):
 
                 self.valid_metrics.update('loss', loss.item())
                     
-                preds_ = np.array(output) 
-                outs = np.append(outs, preds_)
-                trgs = np.append(trgs, y.data.cpu().numpy())
-                
-            for met in self.metric_ftns:
-                self.valid_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
+                self.valid_confusion.update(output, y)
 
-        return self.valid_metrics.result()
+        return self._metric_results(self.valid_metrics, self.valid_confusion)
     
     def _test_classifier(self):
 
         PATH_f = str(self.checkpoint_dir / 'featurenet_best.pth')
-        self.feature_net.load_state_dict(torch.load(PATH_f)['state_dict'])
+        self.feature_net.load_state_dict(torch.load(PATH_f, map_location=self.device, weights_only=False)['state_dict'])
         self.feature_net.eval()
             
         PATH_c = str(self.checkpoint_dir / 'classifier_best.pth')
-        self.classifier.load_state_dict(torch.load(PATH_c)['state_dict'])
+        self.classifier.load_state_dict(torch.load(PATH_c, map_location=self.device, weights_only=False)['state_dict'])
         self.classifier.eval()
         
         val_log = self._valid_classifier()
         
         self.test_metrics.reset()
+        self.test_confusion.reset()
         with torch.no_grad():
-            outs = np.array([])
-            trgs = np.array([])
+            outs, trgs = [], []  # per-batch arrays, concatenated once at the end
             for batch_idx, (x, y, _) in enumerate(self.test_loader):
                 x, y = x.to(self.device), y.to(self.device)
                 features = self.feature_net.get_features(x)
@@ -272,18 +251,16 @@ class Trainer(BaseTrainer):
 
                 self.test_metrics.update('loss', loss.item())
                     
-                preds_ = np.array(output) 
-                outs = np.append(outs, preds_)
-                trgs = np.append(trgs, y.data.cpu().numpy())
+                self.test_confusion.update(output, y)
+                outs.append(np.array(output).reshape(-1))
+                trgs.append(y.data.cpu().numpy().reshape(-1))
             
         outs_name = "test_outs_" + str(self.fold_id)
         trgs_name = "test_trgs_" + str(self.fold_id)
-        np.save(self.checkpoint_dir / outs_name, outs)
-        np.save(self.checkpoint_dir / trgs_name, trgs)   
+        np.save(self.checkpoint_dir / outs_name, np.concatenate(outs).astype(float))
+        np.save(self.checkpoint_dir / trgs_name, np.concatenate(trgs).astype(float))   
         
-        for met in self.metric_ftns:
-            self.test_metrics.update(met.__name__, met(outs.reshape(-1,1), trgs.reshape(-1,1)))
-        test_log = self.test_metrics.result()
+        test_log = self._metric_results(self.test_metrics, self.test_confusion)
         
         log = {}
         log.update(**{'val_' + k: v for k, v in val_log.items()})
@@ -295,6 +272,19 @@ class Trainer(BaseTrainer):
         for key, value in log.items():
             self.logger.info('    {:15s}: {}'.format(str(key), value))            
             
+    def _round(self):
+        """
+        Batch kinds of one round of the feature-net schedule, evenly interleaved: 'supervised',
+        'unsupervised', and with mixed_batches 'mixed' (one batch of each in one forward)
+        """
+        n_mixed = min(self.sup_ratio, self.unsup_ratio) if self.mixed_batches else 0
+        counts = {'mixed': n_mixed, 'supervised': self.sup_ratio - n_mixed, 'unsupervised': self.unsup_ratio - n_mixed}
+        return [phase for _, phase in sorted((k / n, phase) for phase, n in counts.items() for k in range(n))]
+
+    def _aux_predictions(self, logits):
+        # one-hot aux predictions (batch_size, n_class, len) from logits (batch_size, len, n_class), as feature_net.predict
+        return F.one_hot(logits.argmax(-1), logits.size(-1)).float().permute(0, 2, 1)
+
     def _progress(self, batch_idx):
         base = '[{}/{} ({:.0f}%)]'
         current = batch_idx
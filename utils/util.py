@@ -1,10 +1,13 @@
 import json
 from pathlib import Path
 from collections import OrderedDict
-import pandas as pd
 import os
 import numpy as np
 from glob import glob
+import queue
+import threading
+import torch
+from torch.utils.data import DataLoader, RandomSampler
 
 
 SEED = 123
@@ -185,27 +188,100 @@ def write_json(content, fname):
 
 
 
+class Prefetcher:
+    """
+    Endless stream of batches of data_loader (restarted when exhausted), loaded and moved to device
+    by a background thread up to n_prefetch batches ahead. Shuffling draws from a generator of its
+    own, seeded from the global torch RNG at construction, so the thread leaves the main thread's
+    random stream alone. Stop the thread with close(), or use the stream as a context manager.
+    """
+    def __init__(self, data_loader, device, n_prefetch=2):
+        self.device = device
+        seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self.data_loader = DataLoader(data_loader.dataset, batch_size=data_loader.batch_size,
+                                      shuffle=isinstance(data_loader.sampler, RandomSampler),
+                                      num_workers=data_loader.num_workers, collate_fn=data_loader.collate_fn,
+                                      drop_last=data_loader.drop_last, generator=torch.Generator().manual_seed(seed))
+        self.queue = queue.Queue(maxsize=max(1, n_prefetch))
+        self.stop = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        try:
+            while not self.stop.is_set():
+                for batch in self.data_loader:
+                    if not self._put([t.to(self.device, non_blocking=True) for t in batch]):
+                        return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # blocks while the queue is full, gives up once stopped
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self):
+        self.stop.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.error is not None:
+            raise self.error
+        if self.stop.is_set():
+            raise StopIteration
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            self.error = batch
+            raise batch
+        return batch
+
+    def __len__(self):
+        return len(self.data_loader)
+
 class MetricTracker:
     def __init__(self, *keys, writer=None):
         self.writer = writer
-        self._data = pd.DataFrame(index=keys, columns=['total', 'counts', 'average'])
+        self.keys = keys
         self.reset()
 
     def reset(self):
-        for col in self._data.columns:
-            self._data[col].values[:] = 0
+        # plain dicts: metric values may be arrays (confusion), which DataFrame cells do not update in place
+        self._total = {key: 0 for key in self.keys}
+        self._counts = {key: 0 for key in self.keys}
+        self._average = {key: 0 for key in self.keys}
 
     def update(self, key, value, n=1):
         if self.writer is not None:
             self.writer.add_scalar(key, value)
-        self._data.total[key] += value * n
-        self._data.counts[key] += n
-        self._data.average[key] = self._data.total[key] / self._data.counts[key]
+        self._total[key] += value * n
+        self._counts[key] += n
+        self._average[key] = self._total[key] / self._counts[key]
 
     def avg(self, key):
-        return self._data.average[key]
+        return self._average[key]
 
     def result(self):
-        return dict(self._data.average)
+        return dict(self._average)
         
         